@@ -65,6 +65,36 @@ class IMemoryMapping(object):
         """
         raise NotImplementedError(self)
 
+    def read_bytes_many(self, addresses, size):
+        """Reads size bytes at each of these addresses.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param size: long the size of each read.
+        :return: the memory content at each address
+        :rtype: list of bytes str
+        """
+        raise NotImplementedError(self)
+
+    def read_record_array(self, addresses, record_type):
+        """Reads the records at these addresses, in one numpy structured array.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param record_type: a ctypes record class.
+        :return: the records, with the dtype of Model.get_numpy_dtype(record_type)
+        :rtype: numpy.ndarray
+        """
+        raise NotImplementedError(self)
+
+    def read_struct_many(self, addresses, record_type):
+        """Reads a ctypes record instance at each of these addresses.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param record_type: a ctypes class.
+        :return: the memory content at each address, in an ctypes record form
+        :rtype: list of (record_type) ctypes class
+        """
+        raise NotImplementedError(self)
+
     def read_word(self, address):
         """Reads the memory content at address <address> and returns an word worth of it.
         Usually 4 or 8 bytes.
@@ -75,6 +105,16 @@ class IMemoryMapping(object):
         """
         raise NotImplementedError(self)
 
+    def read_words(self, addresses, word_size=None):
+        """Reads a word at each of these addresses.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param word_size: the size of a word, the target word size by default
+        :return: the words, unsigned integers of the word size
+        :rtype: numpy.ndarray
+        """
+        raise NotImplementedError(self)
+
     def search(self, bytestr):
         """Search the memory for this particular sequence of bytes and iterates over the starting
         address of the results.
@@ -85,6 +125,23 @@ class IMemoryMapping(object):
         """
         raise NotImplementedError(self)
 
+    def get_page_presence(self):
+        """Returns the page presence map of the mapping.
+        A page is absent when it only holds zeroes, and the backend knows it without reading the page.
+        All the pages of the other backends are present.
+
+        :return: numpy array of bool, one item per page
+        """
+        raise NotImplementedError(self)
+
+    def get_present_ranges(self, margin=0):
+        """Returns the address ranges of present pages.
+
+        :param margin: int, each range is extended backwards by margin bytes
+        :return: sorted list of (start, end) virtual addresses
+        """
+        raise NotImplementedError(self)
+
     def __contains__(self, address):
         raise NotImplementedError(self)
 
@@ -149,6 +206,34 @@ class IMemoryHandler(object):
         """Returns the IMemoryMapping _memory_handler with the name pathname"""
         raise NotImplementedError(self)
 
+    def read_words(self, addresses, word_size=None):
+        """Reads a word at each of these addresses, grouped by IMemoryMapping.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param word_size: the size of a word, the target word size by default
+        :return: the words, unsigned integers of the word size
+        :rtype: numpy.ndarray
+        """
+        raise NotImplementedError(self)
+
+    def read_bytes_many(self, addresses, size):
+        """Reads size bytes at each of these addresses, grouped by IMemoryMapping.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param size: long the size of each read.
+        :rtype: list of bytes str
+        """
+        raise NotImplementedError(self)
+
+    def read_struct_many(self, addresses, record_type):
+        """Reads a ctypes record instance at each of these addresses, grouped by IMemoryMapping.
+
+        :param addresses: a sequence of long virtual addresses.
+        :param record_type: a ctypes class.
+        :rtype: list of (record_type) ctypes class
+        """
+        raise NotImplementedError(self)
+
     def is_valid_address(self, obj, struct_type=None):
         """Return true is the virtual address is a valid address in a IMemoryMapping"""
         raise NotImplementedError(self)
@@ -157,6 +242,10 @@ class IMemoryHandler(object):
         """Return true is the virtual address is a valid address in a IMemoryMapping"""
         raise NotImplementedError(self)
 
+    def are_valid_address_values(self, addresses, size=0):
+        """Return a numpy bool array, True for the virtual addresses of size bytes in a IMemoryMapping"""
+        raise NotImplementedError(self)
+
     def __contains__(self, vaddr):
         """Return true is the virtual address is a valid address in a IMemoryMapping"""
         raise NotImplementedError(self)
@@ -265,6 +354,12 @@ class ITargetPlatform(object):
         """Returns the cpu bits of the host platform"""
         raise NotImplementedError(self)
 
+    def get_detection_report(self):
+        """Returns how each characteristic of the platform was found
+
+        :return: list of (name, value, 'forced'|'cached'|'detected', seconds, number of mappings read)"""
+        raise NotImplementedError(self)
+
 
 class IHeapFinder(object):
     """
@@ -318,6 +413,14 @@ class IHeapWalker(object):
         """ returns all free chunks in the heap (addr,size) """
         raise NotImplementedError('Please implement all methods')
 
+    def list_used_mappings(self):
+        """ returns the IMemoryMapping used by this heap """
+        raise NotImplementedError('Please implement all methods')
+
+    def list_segments(self):
+        """ returns the (start,end) address ranges of the segments of this heap """
+        raise NotImplementedError('Please implement all methods')
+
 
 class ICTypesUtils(object):
     """
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+"""
+On-disk cache of the heap discovery and heap walking results of a memory dump.
+
+Heap discovery and the full chunk walk of every heap are the dominant cost of
+a small search on a large dump. The HeapIndex saves, next to the dump, in
+<dumpname>.d/heapindex.npz:
+    - the address, root mapping and word size of each heap found,
+    - the user allocations and free chunks of each heap, as numpy arrays,
+    - the verdict of the heap validator on the chunk walk of each heap, and the
+      error of the heaps that could not be walked.
+
+The index is keyed by a fingerprint of the dump and by the haystack version.
+A stale index is ignored and rebuilt.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+
+import numpy
+
+import haystack
+
+log = logging.getLogger('heapindex')
+
+# minidump, cuckoo, frida already name their memory handler <dumpname>.d
+CACHE_FOLDER_SUFFIX = '.d'
+HEAP_INDEX_FILENAME = 'heapindex.npz'
+# change it when the file layout changes
+HEAP_INDEX_FORMAT = 2
+
+
+def get_cache_folder_name(memory_handler):
+    """Returns the <dumpname>.d cache folder name for this memory handler"""
+    name = memory_handler.get_name()
+    if name.endswith(CACHE_FOLDER_SUFFIX):
+        return name
+    return name + CACHE_FOLDER_SUFFIX
+
+
+def _stat_line(filename):
+    st = os.stat(filename)
+    return ('%s %d %d\n' % (filename, st.st_size, int(st.st_mtime))).encode('utf-8', 'replace')
+
+
+def make_fingerprint(dumpname, mappings):
+    """
+    Returns a fingerprint of a dump file or folder and of its mappings table.
+    The fingerprint of a folder dump covers each file of the folder, as a mapping
+    file can be rewritten without changing the folder stat.
+
+    :param dumpname: the dump file or folder name
+    :param mappings: list of IMemoryMapping
+    :return: str or None if the dump does not exists on disk (live process...)
+    """
+    if not os.path.exists(dumpname):
+        return None
+    dumpname = os.path.abspath(dumpname)
+    h = hashlib.sha1()
+    h.update(_stat_line(dumpname))
+    if os.path.isdir(dumpname):
+        for name in sorted(os.listdir(dumpname)):
+            filename = os.path.join(dumpname, name)
+            if os.path.isfile(filename):
+                h.update(_stat_line(filename))
+    for m in mappings:
+        h.update(('%x %x %s %s\n' % (m.start, m.end, m.permissions, m.pathname)).encode('utf-8', 'replace'))
+    return h.hexdigest()
+
+
+def make_dump_fingerprint(memory_handler):
+    """
+    Returns a fingerprint of the dump of this memory handler.
+    The fingerprint covers the dump file (size, mtime) and the mappings table.
+
+    :param memory_handler: IMemoryHandler
+    :return: str or None if the dump does not exists on disk (live process...)
+    """
+    dumpname = get_cache_folder_name(memory_handler)[:-len(CACHE_FOLDER_SUFFIX)]
+    return make_fingerprint(dumpname, memory_handler.get_mappings())
+
+
+class HeapIndex(object):
+    """
+    Loads and saves the heap walkers results of a memory handler to disk.
+
+    Usage:
+        index = HeapIndex(memory_handler)
+        heaps = index.load()  # None if there is no valid index
+        index.save(heap_walkers)
+    """
+
+    def __init__(self, memory_handler):
+        """
+        The fingerprint is taken at init time, before any heap discovery could rebase a mapping.
+
+        :param memory_handler: IMemoryHandler
+        """
+        self._memory_handler = memory_handler
+        self._filename = os.path.join(get_cache_folder_name(memory_handler), HEAP_INDEX_FILENAME)
+        self._fingerprint = make_dump_fingerprint(memory_handler)
+        # kernel heaps rebase their mappings. Remember the original start address.
+        self._original_starts = dict([(m, m.start) for m in memory_handler.get_mappings()])
+
+    def get_filename(self):
+        return self._filename
+
+    def is_enabled(self):
+        """The index is only used for dumps that exist on disk"""
+        return self._fingerprint is not None
+
+    def _make_metadata(self):
+        return {'format': HEAP_INDEX_FORMAT,
+                'version': haystack.__version__,
+                'fingerprint': self._fingerprint}
+
+    def reset(self):
+        """Deletes the index file."""
+        if os.access(self._filename, os.F_OK):
+            log.info('Removing heap index %s', self._filename)
+            os.remove(self._filename)
+        return
+
+    def load(self):
+        """
+        Loads the heap index.
+
+        :return: None if the index is missing or stale,
+            else a list of dict(address, mapping_start, offset, bits, valid, error, allocations, free_chunks)
+        """
+        if not self.is_enabled() or not os.access(self._filename, os.F_OK):
+            return None
+        try:
+            with numpy.load(self._filename, allow_pickle=False) as data:
+                meta = json.loads(str(data['meta']))
+                if meta != self._make_metadata():
+                    log.info('Heap index %s is stale, ignoring it', self._filename)
+                    return None
+                heaps = []
+                alloc_index = data['alloc_index']
+                free_index = data['free_index']
+                alloc_addrs, alloc_sizes = data['alloc_addrs'], data['alloc_sizes']
+                free_addrs, free_sizes = data['free_addrs'], data['free_sizes']
+                for i, address in enumerate(data['heap_addresses'].tolist()):
+                    a_start, a_end = alloc_index[i], alloc_index[i+1]
+                    f_start, f_end = free_index[i], free_index[i+1]
+                    heaps.append({
+                        'address': address,
+                        'mapping_start': int(data['heap_mappings'][i]),
+                        'offset': int(data['heap_offsets'][i]),
+                        'bits': int(data['heap_bits'][i]),
+                        'valid': bool(data['heap_valid'][i]),
+                        'error': str(data['heap_errors'][i]),
+                        'allocations': set(zip(alloc_addrs[a_start:a_end].tolist(),
+                                               alloc_sizes[a_start:a_end].tolist())),
+                        'free_chunks': set(zip(free_addrs[f_start:f_end].tolist(),
+                                               free_sizes[f_start:f_end].tolist())),
+                    })
+        except (IOError, OSError, KeyError, ValueError) as e:
+            log.warning('Could not read heap index %s: %s', self._filename, e)
+            return None
+        log.debug('Loaded %d heaps from heap index %s', len(heaps), self._filename)
+        return heaps
+
+    def save(self, heap_walkers):
+        """
+        Walks all heaps and saves the results in the heap index.
+        A heap whose chunks can not be walked is saved with a False verdict and its error,
+        the other heaps are still saved.
+
+        :param heap_walkers: list of IHeapWalker
+        :return: True if the index was written
+        """
+        if not self.is_enabled():
+            return False
+        addresses, mappings, offsets, bits, verdicts, errors = [], [], [], [], [], []
+        allocs, frees = [], []
+        for walker in heap_walkers:
+            mapping = walker.get_heap_mapping()
+            address = walker.get_heap_address()
+            addresses.append(address)
+            mappings.append(self._original_starts.get(mapping, mapping.start))
+            offsets.append(address - mapping.start)
+            bits.append(walker.get_target_platform().get_cpu_bits())
+            try:
+                _allocs = sorted(walker.get_user_allocations())
+                _frees = sorted(walker.get_free_chunks())
+                verdicts.append(True)
+                errors.append('')
+            except Exception as e:
+                log.warning('Heap 0x%x could not be walked: %s', address, e)
+                _allocs, _frees = [], []
+                verdicts.append(False)
+                errors.append('%s: %s' % (type(e).__name__, e))
+            allocs.append(_allocs)
+            frees.append(_frees)
+        alloc_addrs, alloc_sizes, alloc_index = self._to_arrays(allocs)
+        free_addrs, free_sizes, free_index = self._to_arrays(frees)
+        folder = os.path.dirname(self._filename)
+        try:
+            if not os.access(folder, os.F_OK):
+                os.mkdir(folder)
+            # write to a temporary file, then rename. Concurrent readers never see a partial index.
+            buf = io.BytesIO()
+            numpy.savez_compressed(buf,
+                                   meta=numpy.array(json.dumps(self._make_metadata())),
+                                   heap_addresses=numpy.array(addresses, dtype=numpy.uint64),
+                                   heap_mappings=numpy.array(mappings, dtype=numpy.uint64),
+                                   heap_offsets=numpy.array(offsets, dtype=numpy.int64),
+                                   heap_bits=numpy.array(bits, dtype=numpy.uint8),
+                                   heap_valid=numpy.array(verdicts, dtype=numpy.bool_),
+                                   heap_errors=numpy.array(errors, dtype='U'),
+                                   alloc_addrs=alloc_addrs, alloc_sizes=alloc_sizes, alloc_index=alloc_index,
+                                   free_addrs=free_addrs, free_sizes=free_sizes, free_index=free_index)
+            tmp_filename = '%s.%d.tmp' % (self._filename, os.getpid())
+            with open(tmp_filename, 'wb') as fout:
+                fout.write(buf.getvalue())
+            os.rename(tmp_filename, self._filename)
+        except (IOError, OSError) as e:
+            log.warning('Could not write heap index %s: %s', self._filename, e)
+            return False
+        log.debug('Saved %d heaps to heap index %s', len(addresses), self._filename)
+        return True
+
+    @staticmethod
+    def _to_arrays(chunk_lists):
+        """Concatenates lists of (addr, size) in two arrays, with an offset index array"""
+        index = numpy.zeros(len(chunk_lists) + 1, dtype=numpy.int64)
+        for i, chunks in enumerate(chunk_lists):
+            index[i+1] = index[i] + len(chunks)
+        addrs = numpy.array([c[0] for chunks in chunk_lists for c in chunks], dtype=numpy.uint64)
+        sizes = numpy.array([c[1] for chunks in chunk_lists for c in chunks], dtype=numpy.uint64)
+        return addrs, sizes, index
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+"""
+Heap statistics, computed from the allocations and free chunks of IHeapWalker.
+
+    - allocation size histograms (power of 2 buckets)
+    - free/used ratio
+    - fragmentation index: 1 - largest free block / total free space
+    - per-mapping and per-segment occupancy
+    - largest free block
+
+Statistics are plain dicts, ready to export as JSON or CSV.
+"""
+
+from __future__ import print_function
+
+import csv
+import json
+import logging
+
+import numpy
+
+log = logging.getLogger('heapstats')
+
+# histogram buckets, 2**0 .. 2**32 bytes
+HISTOGRAM_BINS = [0] + [2**i for i in range(33)]
+
+CSV_FIELDS = ['heap', 'bits', 'used_count', 'used_size', 'free_count', 'free_size',
+              'free_ratio', 'fragmentation', 'largest_free', 'mean_alloc_size', 'median_alloc_size']
+
+
+def to_arrays(chunks):
+    """ returns addresses and sizes of a list of (addr, size) as sorted numpy arrays """
+    if len(chunks) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint64)
+    data = numpy.array(sorted(chunks), dtype=numpy.uint64)
+    return data[:, 0], data[:, 1]
+
+
+def _histogram(sizes):
+    """ returns the allocation sizes histogram, as a list of [bucket_lower_bound, count] """
+    counts, bins = numpy.histogram(sizes, bins=HISTOGRAM_BINS)
+    return [[int(b), int(c)] for b, c in zip(bins[:-1], counts) if c > 0]
+
+
+def sum_by_range(ranges, addrs, sizes):
+    """
+    Sum the sizes of chunks in each (start, end) range.
+    A chunk is counted in the range containing its address.
+
+    :param ranges: sorted list of (start, end)
+    :param addrs: numpy array of chunk addresses
+    :param sizes: numpy array of chunk sizes
+    :return: (totals, counts) numpy arrays, one item per range
+    """
+    starts = numpy.array([r[0] for r in ranges], dtype=numpy.uint64)
+    ends = numpy.array([r[1] for r in ranges], dtype=numpy.uint64)
+    idx = numpy.searchsorted(starts, addrs, side='right') - 1
+    inside = (idx >= 0)
+    inside[inside] &= addrs[inside] < ends[idx[inside]]
+    totals = numpy.bincount(idx[inside], weights=sizes[inside].astype(numpy.float64), minlength=len(ranges))
+    counts = numpy.bincount(idx[inside], minlength=len(ranges))
+    return totals.astype(numpy.uint64), counts
+
+
+def _occupancy(ranges, used_addrs, used_sizes, free_addrs, free_sizes):
+    """ returns the used and free size of chunks in each (start, end) range """
+    res = []
+    if len(ranges) == 0:
+        return res
+    ranges = sorted(ranges)
+    used_totals, used_counts = sum_by_range(ranges, used_addrs, used_sizes)
+    free_totals, free_counts = sum_by_range(ranges, free_addrs, free_sizes)
+    for i, (start, end) in enumerate(ranges):
+        size = end - start
+        used = int(used_totals[i])
+        free = int(free_totals[i])
+        res.append({'start': start, 'end': end, 'size': size,
+                    'used_count': int(used_counts[i]), 'used_size': used,
+                    'free_count': int(free_counts[i]), 'free_size': free,
+                    'occupancy': float(used) / size if size else 0.})
+    return res
+
+
+def _chunks_statistics(used_sizes, free_sizes):
+    """ returns the statistics common to a heap and a process """
+    used_size = int(used_sizes.sum())
+    free_size = int(free_sizes.sum())
+    largest_free = int(free_sizes.max()) if len(free_sizes) > 0 else 0
+    stats = {
+        'used_count': len(used_sizes),
+        'used_size': used_size,
+        'free_count': len(free_sizes),
+        'free_size': free_size,
+        'free_ratio': float(free_size) / (used_size + free_size) if used_size + free_size else 0.,
+        # 0 when all free space is in one block, close to 1 when it is scattered
+        'fragmentation': 1. - float(largest_free) / free_size if free_size else 0.,
+        'largest_free': largest_free,
+        'mean_alloc_size': float(used_sizes.mean()) if len(used_sizes) > 0 else 0.,
+        'median_alloc_size': float(numpy.median(used_sizes)) if len(used_sizes) > 0 else 0.,
+        'histogram': _histogram(used_sizes),
+        'free_histogram': _histogram(free_sizes),
+    }
+    return stats
+
+
+def make_heap_statistics(walker):
+    """
+    Compute the statistics of one heap.
+
+    :param walker: IHeapWalker
+    :return: dict
+    """
+    used_addrs, used_sizes = to_arrays(walker.get_user_allocations())
+    free_addrs, free_sizes = to_arrays(walker.get_free_chunks())
+    stats = _chunks_statistics(used_sizes, free_sizes)
+    stats['heap'] = walker.get_heap_address()
+    stats['bits'] = walker.get_target_platform().get_cpu_bits()
+    mappings = [(m.start, m.end) for m in walker.list_used_mappings()]
+    stats['mappings'] = _occupancy(mappings, used_addrs, used_sizes, free_addrs, free_sizes)
+    stats['segments'] = _occupancy(walker.list_segments(), used_addrs, used_sizes, free_addrs, free_sizes)
+    return stats
+
+
+def make_process_statistics(finder):
+    """
+    Compute the statistics of all heaps in a process.
+
+    :param finder: IHeapFinder
+    :return: dict with the process totals, and the statistics of each heap in 'heaps'
+    """
+    heaps = []
+    used, free = [], []
+    for walker in finder.list_heap_walkers():
+        try:
+            heaps.append(make_heap_statistics(walker))
+        except (ValueError, RuntimeError) as e:
+            log.warning('Heap 0x%x could not be walked: %s', walker.get_heap_address(), e)
+            continue
+        used.append(to_arrays(walker.get_user_allocations())[1])
+        free.append(to_arrays(walker.get_free_chunks())[1])
+    used_sizes = numpy.concatenate(used) if used else numpy.zeros(0, dtype=numpy.uint64)
+    free_sizes = numpy.concatenate(free) if free else numpy.zeros(0, dtype=numpy.uint64)
+    stats = _chunks_statistics(used_sizes, free_sizes)
+    stats['heaps'] = heaps
+    return stats
+
+
+def output_to_json(stats):
+    """ returns the statistics as a JSON string """
+    return json.dumps(stats, indent=2, sort_keys=True)
+
+
+def output_to_csv(stats, fout):
+    """ write one CSV line per heap, then the process totals with heap='total' """
+    writer = csv.writer(fout)
+    writer.writerow(CSV_FIELDS)
+    for heap in stats['heaps']:
+        writer.writerow([heap[f] if f != 'heap' else '0x%x' % heap[f] for f in CSV_FIELDS])
+    total = dict(stats)
+    total['heap'] = 'total'
+    total['bits'] = ''
+    writer.writerow([total[f] for f in CSV_FIELDS])
+    return
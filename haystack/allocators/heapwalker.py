@@ -1,19 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import pkg_resources
+import time
+from multiprocessing.pool import ThreadPool
 
+from haystack import plugins
 from haystack.abc import interfaces
+from haystack.allocators import heapindex
 
 log = logging.getLogger('heapwalker')
 
-SUPPORTED_ALLOCATORS = {}
-
-
-def _discover_supported_allocators():
-    # TODO use it in memory dump discovery. Maybe add platform selectors to Finder interface
-    for entry_point in pkg_resources.iter_entry_points("haystack.heap_finder"):
-        SUPPORTED_ALLOCATORS[entry_point.name] = entry_point.resolve()
+# the heap finder of an allocator is imported when it is used
+SUPPORTED_ALLOCATORS = plugins.PluginRegistry(plugins.HEAP_FINDER_GROUP, plugins.BUILTIN_HEAP_FINDERS)
+# the allocator of each os
+OS_ALLOCATORS = {'linux': 'ptmalloc2',
+                 'winxp': 'winxp',
+                 'win7': 'win7'}
 
 
 class HeapWalker(interfaces.IHeapWalker):
@@ -62,6 +64,18 @@ class HeapWalker(interfaces.IHeapWalker):
         """ returns all free chunks in the heap (addr,size) """
         raise NotImplementedError('Please implement all methods')
 
+    def _preload_chunk_lists(self, allocations, free_chunks):
+        """ set the user allocations and free chunks from a previous walk of that heap """
+        raise NotImplementedError('Please implement all methods')
+
+    def list_used_mappings(self):
+        """ return the mappings used by this heap. Only the heap mapping by default """
+        return [self._heap_mapping]
+
+    def list_segments(self):
+        """ return the segments (start,end) of this heap. The heap mapping by default """
+        return [(self._heap_mapping.start, self._heap_mapping.end)]
+
     def __contains__(self, address):
         """ Does the heap walker or its relevant segments contains this address"""
         raise NotImplementedError('Please implement all methods')
@@ -81,6 +95,24 @@ class HeapFinder(interfaces.IHeapFinder):
         # optimisations
         self._heap_walkers = None
         self._heap_walkers_dict = None
+        # on-disk cache of the heap walk, next to the dump
+        self._heap_index = heapindex.HeapIndex(memory_handler)
+        # heaps are independent, they can be found and walked in parallel
+        self._workers = 1
+        self._heap_timings = dict()
+
+    def set_workers(self, workers):
+        """Set the number of threads used to find and walk the heaps."""
+        if workers < 1:
+            raise ValueError('workers should be >= 1')
+        self._workers = workers
+
+    def get_heap_timings(self):
+        """
+        return the time spent finding and walking each heap, sorted by heap address.
+        [(heap_address, find_seconds, walk_seconds), ...]
+        """
+        return sorted([(addr, t.get('find', 0.), t.get('walk', 0.)) for addr, t in self._heap_timings.items()])
 
     def get_heap_walker(self, mapping):
         if not isinstance(mapping, interfaces.IMemoryMapping):
@@ -96,18 +128,105 @@ class HeapFinder(interfaces.IHeapFinder):
     def list_heap_walkers(self):
         """return the list of heaps that load as heaps"""
         if not self._heap_walkers:
-            self._heap_walkers = []
-            for mapping in self._memory_handler:
-                walker = self._find_heap(mapping)
-                if walker:
-                    self._heap_walkers.append(walker)
-            # sort the list
-            self._heap_walkers.sort(key=lambda walker: walker.get_heap_address())
-            # FIXME, so do we have heaps in the middle of a mapping or not ?
-            # FIXME: what about segments
-            self._heap_walkers_dict = dict([(w.get_heap_address(), w) for w in self._heap_walkers])
+            walkers = self._load_heap_index()
+            if walkers is None:
+                walkers = self._find_heap_walkers()
+                if self._workers > 1 or self._heap_index.is_enabled():
+                    self._walk_heaps(walkers)
+                self._heap_index.save(walkers)
+            self._set_heap_walkers(walkers)
         return self._heap_walkers
 
+    def reset_heap_index(self):
+        """Forget the heap walkers and delete the on-disk heap index."""
+        self._heap_index.reset()
+        self._heap_walkers = None
+        self._heap_walkers_dict = None
+
+    def _find_heap_walkers(self):
+        """search all mappings for heaps. return the list of heap walkers"""
+        return self._find_heaps_in(self._memory_handler.get_mappings())
+
+    def _map(self, func, items):
+        """apply func to all items, with the worker pool. Results are in items order."""
+        if self._workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self._workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _find_heaps_in(self, mappings):
+        """search these mappings for heaps, in parallel. return the list of heap walkers in mappings order."""
+        def _timed_find_heap(mapping):
+            t0 = time.time()
+            return self._find_heap(mapping), time.time() - t0
+        heap_walkers = []
+        for walker, elapsed in self._map(_timed_find_heap, mappings):
+            if walker:
+                heap_walkers.append(walker)
+                self._heap_timings.setdefault(walker.get_heap_address(), dict())['find'] = elapsed
+        return heap_walkers
+
+    def _walk_heaps(self, heap_walkers):
+        """build the chunk lists of each heap, in parallel."""
+        def _timed_walk(walker):
+            t0 = time.time()
+            try:
+                walker.get_user_allocations()
+                walker.get_free_chunks()
+            except Exception as e:
+                # the walk will be retried lazily, and the error recorded in the heap index
+                log.warning('Heap 0x%x could not be walked: %s', walker.get_heap_address(), e)
+            return time.time() - t0
+        for walker, elapsed in zip(heap_walkers, self._map(_timed_walk, heap_walkers)):
+            addr = walker.get_heap_address()
+            self._heap_timings.setdefault(addr, dict())['walk'] = elapsed
+            log.info('Heap 0x%x walked in %0.3fs', addr, elapsed)
+        return
+
+    def _set_heap_walkers(self, heap_walkers):
+        """cache the list of heap walkers, and the heap walkers by address"""
+        self._heap_walkers = heap_walkers
+        # sort the list
+        self._heap_walkers.sort(key=lambda walker: walker.get_heap_address())
+        # FIXME, so do we have heaps in the middle of a mapping or not ?
+        # FIXME: what about segments
+        self._heap_walkers_dict = dict([(w.get_heap_address(), w) for w in self._heap_walkers])
+
+    def _load_heap_index(self):
+        """
+        Rebuild the heap walkers from the on-disk heap index.
+        return None if there is no valid heap index.
+        """
+        heaps = self._heap_index.load()
+        if heaps is None:
+            return None
+        heap_walkers = []
+        for heap in heaps:
+            mapping = self._memory_handler.get_mapping_for_address(heap['mapping_start'])
+            if not mapping:
+                log.warning('Heap index refers to unknown mapping 0x%x', heap['mapping_start'])
+                return None
+            # replay the kernel address space rebase of that heap mapping
+            if mapping.start != heap['address'] - heap['offset']:
+                self._memory_handler.rebase_mapping(mapping, heap['address'] - heap['offset'])
+            walker = self._make_heap_walker(mapping, heap['address'], heap['bits'])
+            if heap['valid']:
+                walker._preload_chunk_lists(heap['allocations'], heap['free_chunks'])
+            else:
+                log.debug('Heap 0x%x could not be walked: %s', heap['address'], heap['error'])
+            heap_walkers.append(walker)
+        return heap_walkers
+
+    def _make_heap_walker(self, mapping, address, bits):
+        """
+        return a heap walker for the heap at address on the mapping, for that cpu word size.
+        """
+        raise NotImplementedError(self)
+
     def search_heap_direct(self, start_address_mapping):
         """
         return a ctypes heap struct mapped at address on the mapping
@@ -135,14 +254,6 @@ def make_heap_finder(memory_handler):
         raise TypeError('memory_handler should be an IMemoryHandler')
     target_platform = memory_handler.get_target_platform()
     os_name = target_platform.get_os_name()
-    if os_name == 'linux':
-        from haystack.allocators.libc import libcheapwalker
-        return libcheapwalker.LibcHeapFinder(memory_handler)
-    elif os_name == 'winxp':
-        from haystack.allocators.win32 import winxpheapwalker
-        return winxpheapwalker.WinXPHeapFinder(memory_handler)
-    elif os_name == 'win7':
-        from haystack.allocators.win32 import win7heapwalker
-        return win7heapwalker.Win7HeapFinder(memory_handler)
-    else:
+    if os_name not in OS_ALLOCATORS:
         raise NotImplementedError('Heap Walker not found for os %s', os_name)
+    return SUPPORTED_ALLOCATORS[OS_ALLOCATORS[os_name]](memory_handler)
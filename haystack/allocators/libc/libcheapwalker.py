@@ -49,6 +49,10 @@ class LibcHeapWalker(heapwalker.HeapWalker):
     def _set_chunk_lists(self):
         self._allocs, self._free_chunks = self._heap_validator.get_user_allocations(self._heap_mapping)
 
+    def _preload_chunk_lists(self, allocations, free_chunks):
+        self._allocs = allocations
+        self._free_chunks = free_chunks
+
 
     def get_heap_validator(self):
         if self._heap_validator is None:
@@ -126,12 +130,12 @@ class LibcHeapFinder(heapwalker.HeapFinder):
         log.debug('HeapFinder._is_heap %s %s', mapping, load)
         return load
 
-    def list_heap_walkers(self):
+    def _find_heap_walkers(self):
         """return the list of heaps that load as heaps
 
-        Full overload of parent, to fix some bugs and prioritize.
+        Full overload of parent, to fix some bugs.
         """
-        heap_walkers = []
+        mappings = []
         for mapping in self._memory_handler:
             # BUG: python-ptrace read /proc/$$/mem.
             # file.seek does not like long integers like the start address
@@ -139,20 +143,27 @@ class LibcHeapFinder(heapwalker.HeapFinder):
             if mapping.pathname in ['[vdso]', '[vsyscall]']:
                 log.debug('Ignore system mapping %s', mapping)
             else:
-                walker = self._find_heap(mapping)
-                if walker is not None:
-                    heap_walkers.append(walker)
-        # heap_walkers.sort(key=lambda m: m.start)
+                mappings.append(mapping)
+        return self._find_heaps_in(mappings)
 
+    def _set_heap_walkers(self, heap_walkers):
+        """prioritize the [heap] mapping"""
+        # heap_walkers.sort(key=lambda m: m.start)
         # FIXME, put the [heap] in front
         i = [i for (i, walker) in enumerate(heap_walkers) if walker._heap_mapping.pathname == '[heap]']
         if len(i) == 1:
             h = heap_walkers.pop(i[0])
             heap_walkers.insert(0, h)
-        return heap_walkers
+        self._heap_walkers = heap_walkers
+        self._heap_walkers_dict = dict([(w.get_heap_address(), w) for w in self._heap_walkers])
+        return
 
     def get_heap_walker(self, mapping):
         if not isinstance(mapping, interfaces.IMemoryMapping):
             raise TypeError('Feed me a IMemoryMapping object')
-        target_platform = self._memory_handler.get_target_platform()
-        return LibcHeapWalker(self._memory_handler, target_platform, self._heap_module, mapping, self._constraints, mapping.start)
+        if self._heap_walkers_dict and mapping.start in self._heap_walkers_dict:
+            return self._heap_walkers_dict[mapping.start]
+        return self._make_heap_walker(mapping, mapping.start, self._target.get_cpu_bits())
+
+    def _make_heap_walker(self, mapping, address, bits):
+        return LibcHeapWalker(self._memory_handler, self._target, self._heap_module, mapping, self._constraints, address)
@@ -36,6 +36,7 @@ class Win7HeapWalker(winheapwalker.WinHeapWalker):
 
 
 class Win7HeapFinder(winheapwalker.WinHeapFinder):
+    signature_offsets = {32: 100, 64: 160}
 
     def _validator_type(self):
         return win7heap.Win7HeapValidator
@@ -43,35 +44,20 @@ class Win7HeapFinder(winheapwalker.WinHeapFinder):
     def _walker_type(self):
         return Win7HeapWalker
 
-    def _make_dual_arch_ctypes(self):
-        # dual arch
-        module_name_32 = 'haystack.allocators.win32.win7_32'
-        _win7_32 = target.TargetPlatform.make_target_win_32('win7')
-        _model_32 = model.Model(_win7_32.get_target_ctypes())
-        _win7_32_module = _model_32.import_module(module_name_32)
-        # TODO make dual optional
-        module_name_64 = 'haystack.allocators.win32.win7_64'
-        _win7_64 = target.TargetPlatform.make_target_win_64('win7')
-        _model_64 = model.Model(_win7_64.get_target_ctypes())
-        _win7_64_module = _model_64.import_module(module_name_64)
-
+    def _make_arch_ctypes(self, bits):
+        module_name = 'haystack.allocators.win32.win7_%d' % bits
+        if bits == 32:
+            _target = target.TargetPlatform.make_target_win_32('win7')
+        else:
+            _target = target.TargetPlatform.make_target_win_64('win7')
+        _model = model.Model(_target.get_target_ctypes())
+        _module = _model.import_module(module_name)
         # different arch have different recors types.
         parser = constraints.ConstraintsConfigHandler()
-        constraint_filename = os.path.join(os.path.dirname(sys.modules[__name__].__file__), 'win7heap32.constraints')
-        _constraints_32 = parser.read(constraint_filename)
-        constraint_filename = os.path.join(os.path.dirname(sys.modules[__name__].__file__), 'win7heap64.constraints')
-        _constraints_64 = parser.read(constraint_filename)
-
-        # KERNEL AS
-        kas32 = (0x8000000, 0xFFFFFFFF)
-        kas64 = (0xFFFF080000000000, 0xFFFFFFFFFFFFFFFF)
-
-        _cpu = dict()
-        _cpu[32] = {'model': _model_32, 'target': _win7_32, 'module': _win7_32_module,
-                    'constraints': _constraints_32, 'signature_offset': 100, 'kernel_as': kas32}
-        _cpu[64] = {'model': _model_64, 'target': _win7_64, 'module': _win7_64_module,
-                    'constraints': _constraints_64, 'signature_offset': 160, 'kernel_as': kas64}
-        return _cpu
+        constraint_filename = os.path.join(os.path.dirname(sys.modules[__name__].__file__),
+                                           'win7heap%d.constraints' % bits)
+        _constraints = parser.read(constraint_filename)
+        return {'model': _model, 'target': _target, 'module': _module, 'constraints': _constraints}
 
     def _get_heap_possible_kernel_pointer_from_heap(self, target_platform, heap):
         return target_platform.get_target_ctypes_utils().get_pointee_address(heap.BaseAddress)
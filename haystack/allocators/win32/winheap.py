@@ -14,11 +14,13 @@ __email__ = "loic.jaquemet+python@gmail.com"
 __status__ = "Production"
 
 
+import bisect
 import ctypes
 import logging
 
 from haystack import listmodel
 from haystack.abc import interfaces
+from haystack.allocators import heapstats
 
 log = logging.getLogger('winheap')
 
@@ -60,6 +62,41 @@ class UCR(object):
         self.end = self.address + self.size
 
 
+class UCRSkipList(object):
+    """
+    Sorted intervals of UnCommitted Ranges, to skip them while walking a segment.
+    Overlapping UCRs are merged.
+    """
+    def __init__(self, ucrs):
+        self.starts = []
+        self.ends = []
+        for ucr_addr, ucr_size in sorted(ucrs):
+            if ucr_size == 0:
+                continue
+            if len(self.ends) > 0 and ucr_addr <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], ucr_addr + ucr_size)
+            else:
+                self.starts.append(ucr_addr)
+                self.ends.append(ucr_addr + ucr_size)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, address):
+        """ returns (start, end) of the UCR containing address, or None"""
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0 and address < self.ends[i]:
+            return self.starts[i], self.ends[i]
+        return None
+
+    def next_start(self, address):
+        """ returns the start address of the first UCR after address, or None"""
+        i = bisect.bisect_right(self.starts, address)
+        if i < len(self.starts):
+            return self.starts[i]
+        return None
+
+
 class Segment(object):
     # based on win7 heap_segment
     # a segment can have multiple mappings
@@ -177,12 +214,8 @@ class WinHeapValidator(listmodel.ListModel):
         """
         allocated = set()
         free = set()
-        ucrs = self.collect_all_ucrs(heap)
-        skiplist = dict()
         # common UCR management for XP and win7
-        for ucr_addr, ucr_size in ucrs:
-            skiplist[ucr_addr] = ucr_size
-            log.debug('adding skiplist from %x to %x', ucr_addr, ucr_addr+ucr_size)
+        skiplist = UCRSkipList(self.collect_all_ucrs(heap))
         log.debug('skiplist has %d items', len(skiplist))
         # now parse all segment
         for segment in self.get_segment_list(heap):
@@ -194,29 +227,47 @@ class WinHeapValidator(listmodel.ListModel):
         return allocated, free
 
     def _iterate_chunk_list(self, heap, first_addr, last_addr, skiplist):
+            """
+            Walk the chunks of a segment.
+            Chunk headers are read in bulk, between UCRs.
+            """
             allocated = set()
             free = set()
             chunk_addr = first_addr
+            chunk_len = self._ctypes.sizeof(self.win_heap.HEAP_ENTRY)
+            encoded = hasattr(heap, 'EncodeFlagMask')  # heap.EncodeFlagMask
+            buf, buf_start, buf_end = None, 0, 0
             log.debug('reading chunk from %x to %x', first_addr, last_addr)
             while chunk_addr < last_addr:
-                if chunk_addr in skiplist:
-                    size = skiplist[chunk_addr]
-                    log.debug('Skipping 0x%0.8x - skip %0.5x bytes to 0x%0.8x', chunk_addr, size, chunk_addr + size)
-                    chunk_addr += size
+                ucr = skiplist.find(chunk_addr)
+                if ucr is not None:
+                    ucr_start, ucr_end = ucr
+                    if chunk_addr != ucr_start:
+                        log.warning('Chunk 0x%0.8x is inside UCR 0x%0.8x-0x%0.8x - exiting', chunk_addr, ucr_start, ucr_end)
+                        break
+                    log.debug('Skipping 0x%0.8x - skip %0.5x bytes to 0x%0.8x', chunk_addr, ucr_end - chunk_addr, ucr_end)
+                    chunk_addr = ucr_end
                     continue
-                chunk_header = self._memory_handler.getRef(self.win_heap.HEAP_ENTRY, chunk_addr)
-                if chunk_header is None:  # force read it
-                    log.debug('reading chunk from %x', chunk_addr)
+                if not (buf_start <= chunk_addr and chunk_addr + chunk_len <= buf_end):
+                    # read all chunks headers up to the next UCR
                     m = self._memory_handler.get_mapping_for_address(chunk_addr)
                     if not m:
                         log.debug("found a non valid chunk pointer at %x", chunk_addr)
                         break
-                    # BUG, a segment could be in a x64 heap
-                    chunk_header = m.read_struct(chunk_addr, self.win_heap.HEAP_ENTRY)
-                    self._memory_handler.keepRef(chunk_header, self.win_heap.HEAP_ENTRY, chunk_addr)
-                    # FIXME what is this hack
-                    chunk_header._orig_address_ = chunk_addr
-                if hasattr(heap, 'EncodeFlagMask'):  # heap.EncodeFlagMask
+                    buf_end = min(m.end, max(last_addr, chunk_addr + chunk_len))
+                    next_ucr = skiplist.next_start(chunk_addr)
+                    if next_ucr is not None and next_ucr < buf_end:
+                        buf_end = next_ucr
+                    if chunk_addr + chunk_len > buf_end:
+                        log.debug("found a truncated chunk header at %x", chunk_addr)
+                        break
+                    log.debug('reading chunks from %x to %x', chunk_addr, buf_end)
+                    buf_start = chunk_addr
+                    buf = m.read_bytes(buf_start, buf_end - buf_start)
+                # BUG, a segment could be in a x64 heap
+                chunk_header = self.win_heap.HEAP_ENTRY.from_buffer_copy(buf, chunk_addr - buf_start)
+                chunk_header._orig_address_ = chunk_addr
+                if encoded:
                     chunk_header = self.HEAP_ENTRY_decode(chunk_header, heap)
                     chunk_header = self._heap_entry_to_size(chunk_header)
                     # test if chunk is allocated or free
@@ -495,20 +546,15 @@ class WinHeapValidator(listmodel.ListModel):
 
     def count_by_segment(self, segment_list, chunksize_tuple, overhead_size):
         # change segments_list to [(start,end)]
+        ranges = sorted([(self._utils.get_pointee_address(s.FirstEntry),
+                          self._utils.get_pointee_address(s.LastValidEntry) + 1) for s in segment_list])
         res = {}
-        for addr, size in chunksize_tuple:
-            for s in segment_list:
-                start = self._utils.get_pointee_address(s.FirstEntry)
-                end = self._utils.get_pointee_address(s.LastValidEntry)
-                if start <= addr <= end:
-                    # we found the segment
-                    key = start
-                    if key not in res:
-                        # (size,overhead)
-                        res[key] = (0, 0)
-                    tsize, overhead = res[key]
-                    tsize += size
-                    overhead += overhead_size # size of win chunk header
-                    res[key] = (tsize, overhead)
-                    break
+        if len(ranges) == 0:
+            return res
+        addrs, sizes = heapstats.to_arrays(chunksize_tuple)
+        totals, counts = heapstats.sum_by_range(ranges, addrs, sizes)
+        for (start, end), tsize, count in zip(ranges, totals, counts):
+            if count > 0:
+                # (size,overhead) - size of win chunk header
+                res[start] = (int(tsize), int(count) * overhead_size)
         return res
@@ -7,6 +7,8 @@ from __future__ import print_function
 import ctypes
 import logging
 import struct
+import threading
+import time
 
 from haystack.abc import interfaces
 from haystack.allocators import heapwalker
@@ -83,6 +85,17 @@ class WinHeapWalker(heapwalker.HeapWalker):
             self._set_chunk_lists()
         return self._user_free_chunks
 
+    def get_free_chunks(self):
+        """ returns all free chunks that are not allocated (addr,size) .
+                addr and size EXCLUDES the HEAP_ENTRY header.
+        """
+        return self.get_user_free_chunks()
+
+    def _preload_chunk_lists(self, allocations, free_chunks):
+        self._user_allocs = allocations
+        self._user_free_chunks = free_chunks
+        return
+
     def get_backend_free_chunks(self):
         """
         """
@@ -230,6 +243,18 @@ class WinHeapWalker(heapwalker.HeapWalker):
         log.debug('+ freeLists: nb_free_chunk:0x%0.4x total_size:0x%0.5x', len(free_lists), freesize)
         return free_lists
 
+    def list_segments(self):
+        """
+        returns the (start,end) address ranges of the HEAP_SEGMENT of this heap
+        """
+        _utils = self._target.get_target_ctypes_utils()
+        boundaries = []
+        for segment in self._validator.get_segment_list(self.get_heap()):
+            start = segment._orig_address_
+            end = _utils.get_pointee_address(segment.LastValidEntry)
+            boundaries.append((start, end))
+        return boundaries
+
     def list_used_mappings(self):
         """
         A Windows heap is composed of segments
@@ -237,11 +262,7 @@ class WinHeapWalker(heapwalker.HeapWalker):
         We return the list of mappings in this memory_handler that are used by this heap
         :return:
         """
-        boundaries = []
-        for segment in self._validator.get_segment_list(self.get_heap()):
-            start = segment._orig_address_
-            end = self._target.get_target_ctypes_utils().get_pointee_address(segment.LastValidEntry)
-            boundaries.append((start, end))
+        boundaries = self.list_segments()
         # look at all mappings
         used = []
         for m in self._memory_handler.get_mappings():
@@ -257,16 +278,41 @@ class WinHeapWalker(heapwalker.HeapWalker):
 
 
 class WinHeapFinder(heapwalker.HeapFinder):
+    # offset of HEAP.Signature, by cpu bits
+    signature_offsets = {32: 0, 64: 0}
+    # KERNEL AS, by cpu bits
+    kernel_address_spaces = {32: (0x8000000, 0xFFFFFFFF),
+                             64: (0xFFFF080000000000, 0xFFFFFFFFFFFFFFFF)}
 
     def __init__(self, memory_handler):
         """
+        The heap profile of an architecture is only imported when a heap signature is found for it.
+
         :param memory_handler: IMemoryHandler
         :return: HeapFinder
         """
         super(WinHeapFinder, self).__init__(memory_handler)
-        self._cpu = self._make_dual_arch_ctypes()
+        self._cpu = dict()
+        self._cpu_lock = threading.Lock()
+        # a 32 bits process only has 32 bits heaps. A WOW64 process has both.
+        if memory_handler.get_target_platform().get_cpu_bits() == 32:
+            self._heap_bits = [32]
+        else:
+            self._heap_bits = [32, 64]
+        # kernel heaps rebase the mappings of the memory handler. They are not searched
+        # by the workers, but in a serial pass, when no other thread reads the mappings.
+        self._defer_kernel_heaps = False
+        self._deferred_mappings = set()
         return
 
+    def _get_cpu(self, bits):
+        """ return the model, target, module and constraints of the heap profile for that arch """
+        with self._cpu_lock:
+            if bits not in self._cpu:
+                log.debug('loading the %d bits heap profile', bits)
+                self._cpu[bits] = self._make_arch_ctypes(bits)
+            return self._cpu[bits]
+
     def _validator_type(self):
         """ return the validator class type"""
         raise NotImplementedError('Please implement all methods')
@@ -275,8 +321,8 @@ class WinHeapFinder(heapwalker.HeapFinder):
         """ return the heap walker class type"""
         raise NotImplementedError('Please implement all methods')
 
-    def _make_dual_arch_ctypes(self):
-        """ return the dual arch reference ctypes """
+    def _make_arch_ctypes(self, bits):
+        """ return the reference ctypes of that arch, as a dict(model, target, module, constraints) """
         raise NotImplementedError('Please implement all methods')
 
     def _find_heap(self, mapping):
@@ -284,34 +330,43 @@ class WinHeapFinder(heapwalker.HeapFinder):
         return a ctypes heap struct mapped at address on the mapping.
         Funny enough, a X64 process could have 32 bits and 64 bits heaps.
         """
-        for addr in range(mapping.start, mapping.end, 0x1000):
+        # zero pages have no heap signature
+        presence = mapping.get_page_presence()
+        for i, addr in enumerate(range(mapping.start, mapping.end, 0x1000)):
+            if not presence[i]:
+                continue
             map_start = mapping.start
             # offset of Signature in 32 and 64 bits
-            for bits in [32, 64]:
-                offset = self._cpu[bits]['signature_offset']
+            for bits in self._heap_bits:
+                offset = self.signature_offsets[bits]
                 signature = struct.unpack('I', mapping.read_bytes(addr+offset, 4))[0]
                 # WinHeap value for HEAP.Signature
                 if signature == 0xeeffeeff:
                     # deep load and check the heap with constraint validation
                     if self.__is_heap(mapping, addr, bits):
-                        return self._walker_type()(self._memory_handler,
-                                              self._cpu[bits]['target'],
-                                              self._cpu[bits]['module'],
-                                              mapping,
-                                              self._cpu[bits]['constraints'],
-                                              addr)
+                        return self._make_heap_walker(mapping, addr, bits)
+                    elif self._defer_kernel_heaps:
+                        if self.__is_kernel_heap_candidate(mapping, addr, bits):
+                            # search that mapping again in the serial pass
+                            with self._cpu_lock:
+                                self._deferred_mappings.add(id(mapping))
+                            return None
                     elif self.__is_kernel_heap(mapping, addr, bits):
                         _heap_offset = addr - map_start
                         heap_addr = mapping.start + _heap_offset
-                        return self._walker_type()(self._memory_handler,
-                                              self._cpu[bits]['target'],
-                                              self._cpu[bits]['module'],
-                                              mapping,
-                                              self._cpu[bits]['constraints'],
-                                              heap_addr)
+                        return self._make_heap_walker(mapping, heap_addr, bits)
                     # otherwise try another combination
         return None
 
+    def _make_heap_walker(self, mapping, address, bits):
+        cpu = self._get_cpu(bits)
+        return self._walker_type()(self._memory_handler,
+                                   cpu['target'],
+                                   cpu['module'],
+                                   mapping,
+                                   cpu['constraints'],
+                                   address)
+
     def __is_heap(self, mapping, address, bits):
         """
         test if a mapping is a heap
@@ -321,9 +376,10 @@ class WinHeapFinder(heapwalker.HeapFinder):
         if not isinstance(mapping, interfaces.IMemoryMapping):
             raise TypeError('Feed me a IMemoryMapping object')
         # switch to the right target
-        heap_module = self._cpu[bits]['module']
-        target_platform = self._cpu[bits]['target']
-        constraints = self._cpu[bits]['constraints']
+        cpu = self._get_cpu(bits)
+        heap_module = cpu['module']
+        target_platform = cpu['target']
+        constraints = cpu['constraints']
         heap = mapping.read_struct(address, heap_module.HEAP)
         # validator is (should be) then target-bound
         validator = self._validator_type()(self._memory_handler, constraints, target_platform, heap_module)
@@ -331,25 +387,46 @@ class WinHeapFinder(heapwalker.HeapFinder):
         log.debug('HeapFinder._is_heap %s %s', mapping, load)
         return load
 
+    def __get_kernel_pointer(self, mapping, address, bits):
+        """
+        return the kernel address of a heap in KERNEL space, or None. Only reads the mapping.
+        """
+        cpu = self._get_cpu(bits)
+        heap = mapping.read_struct(address, cpu['module'].HEAP)
+        # TEST Kernel address space.
+        # winxp has heap.UnusedUnCommittedRanges
+        # win 7 has heap.BaseAddress
+        kernel_ptr = self._get_heap_possible_kernel_pointer_from_heap(cpu['target'], heap)
+        if not self.__is_kernel_address_space(bits, kernel_ptr):
+            return None
+        return kernel_ptr
+
+    def __is_kernel_heap_candidate(self, mapping, address, bits):
+        """
+        test if a mapping could be a heap in KERNEL space, without rebasing it
+        :param mapping: IMemoryMapping
+        :return:
+        """
+        if not isinstance(mapping, interfaces.IMemoryMapping):
+            raise TypeError('Feed me a IMemoryMapping object')
+        return self.__get_kernel_pointer(mapping, address, bits) is not None
+
     def __is_kernel_heap(self, mapping, address, bits):
         """
-        test if a mapping is a heap in KERNEL space, from a USER space address memory dump
+        test if a mapping is a heap in KERNEL space, from a USER space address memory dump.
+        The mapping is rebased, so no other thread should read the mappings.
         :param mapping: IMemoryMapping
         :return:
         """
         if not isinstance(mapping, interfaces.IMemoryMapping):
             raise TypeError('Feed me a IMemoryMapping object')
-        offset = self._cpu[bits]['signature_offset']
         # switch to the right target
-        heap_module = self._cpu[bits]['module']
-        target_platform = self._cpu[bits]['target']
-        constraints = self._cpu[bits]['constraints']
-        heap = mapping.read_struct(address, heap_module.HEAP)
-        # TEST Kernel address space.
-        # winxp has heap.UnusedUnCommittedRanges
-        # win 7 has heap.BaseAddress
-        kernel_ptr = self._get_heap_possible_kernel_pointer_from_heap(target_platform, heap)
-        if not self.__is_kernel_address_space(bits, kernel_ptr):
+        cpu = self._get_cpu(bits)
+        heap_module = cpu['module']
+        target_platform = cpu['target']
+        constraints = cpu['constraints']
+        kernel_ptr = self.__get_kernel_pointer(mapping, address, bits)
+        if kernel_ptr is None:
             return False
         # Else we found a kernel AS HEAP
         old_start = mapping.start
@@ -372,7 +449,7 @@ class WinHeapFinder(heapwalker.HeapFinder):
 
     def __is_kernel_address_space(self, bits, address):
         # Session space is return 0xFFFFF90000000000 <= address <= 0xFFFFF97FFFFFFFFF
-        start, end = self._cpu[bits]['kernel_as']
+        start, end = self.kernel_address_spaces[bits]
         # return 0xFFFF080000000000 <= address <= 0xFFFFFFFFFFFFFFFF
         return start <= address <= end
 
@@ -385,8 +462,9 @@ class WinHeapFinder(heapwalker.HeapFinder):
         if not heap:
             raise ValueError("Address not found")
         bits = self._memory_handler.get_target_platform().get_cpu_bits()
-        heap_module = self._cpu[bits]['module']
-        constraints = self._cpu[bits]['constraints']
+        cpu = self._get_cpu(bits)
+        heap_module = cpu['module']
+        constraints = cpu['constraints']
         my_searcher = searcher.AnyOffsetRecordSearcher(self._memory_handler,
                                                        constraints,
                                                        [heap])
@@ -395,32 +473,54 @@ class WinHeapFinder(heapwalker.HeapFinder):
         results = my_searcher._load_at(heap, start_address_mapping, heap_module.HEAP, depth=5)
         return results
 
-    def list_heap_walkers(self):
+    def _find_heaps_in(self, mappings):
+        """
+        search these mappings for heaps. return the list of heap walkers in mappings order.
+
+        A kernel heap rebases its mapping, which moves it in the memory handler while the workers
+        read other mappings. So the workers only look for user space heaps, and the mappings with
+        a kernel heap candidate are searched again after the workers are done, one at a time.
+        """
+        if self._workers <= 1:
+            return super(WinHeapFinder, self)._find_heaps_in(mappings)
+        self._deferred_mappings = set()
+        self._defer_kernel_heaps = True
+        try:
+            heap_walkers = super(WinHeapFinder, self)._find_heaps_in(mappings)
+        finally:
+            self._defer_kernel_heaps = False
+        if not self._deferred_mappings:
+            return heap_walkers
+        for mapping in mappings:
+            if id(mapping) not in self._deferred_mappings:
+                continue
+            t0 = time.time()
+            walker = self._find_heap(mapping)
+            if walker:
+                heap_walkers.append(walker)
+                self._heap_timings.setdefault(walker.get_heap_address(), dict())['find'] = time.time() - t0
+        self._deferred_mappings = set()
+        # back to mappings order
+        order = dict((id(m), i) for i, m in enumerate(mappings))
+        heap_walkers.sort(key=lambda walker: order[id(walker.get_heap_mapping())])
+        return heap_walkers
+
+    def _set_heap_walkers(self, heap_walkers):
         """
-        return the list of heaps that load as heaps
         Take into account the fact that Segment and mappings exists
         """
-        if not self._heap_walkers:
-            self._heap_walkers = []
-            self._heap_walkers_dict = dict()
-            for mapping in self._memory_handler:
-                # walker could be a kernel AS heap, rebased.
-                # Double check we have looked at it already.
-                if mapping.start in self._heap_walkers_dict:
-                    continue
-                walker = self._find_heap(mapping)
-                if walker:
-                    self._heap_walkers.append(walker)
-                    self._heap_walkers_dict[mapping.start] = walker
-                    self._heap_walkers_dict[walker.get_heap_address()] = walker
-            # sort the list
-            self._heap_walkers.sort(key=lambda walker: walker.get_heap_address())
-            # now look at segment & all used mappings.
-            for walker in self._heap_walkers:
-                # for all 'child' mapping used by a segment of thisHEAP
-                for m in walker.list_used_mappings():
-                    if m.start not in self._heap_walkers_dict:
-                        # point this mapping to the Root Heap walker
-                        self._heap_walkers_dict[m.start] = walker
-                pass
-        return self._heap_walkers
+        self._heap_walkers = heap_walkers
+        self._heap_walkers_dict = dict()
+        for walker in self._heap_walkers:
+            self._heap_walkers_dict[walker.get_heap_mapping().start] = walker
+            self._heap_walkers_dict[walker.get_heap_address()] = walker
+        # sort the list
+        self._heap_walkers.sort(key=lambda walker: walker.get_heap_address())
+        # now look at segment & all used mappings.
+        for walker in self._heap_walkers:
+            # for all 'child' mapping used by a segment of thisHEAP
+            for m in walker.list_used_mappings():
+                if m.start not in self._heap_walkers_dict:
+                    # point this mapping to the Root Heap walker
+                    self._heap_walkers_dict[m.start] = walker
+        return
@@ -34,3 +34,13 @@ def int16(s):
         raise argparse.ArgumentTypeError(e)
     return i
 
+
+def positive_int(s):
+    """Validates an integer greater than 0"""
+    try:
+        i = int(s)
+    except Exception as e:
+        raise argparse.ArgumentTypeError(e)
+    if i < 1:
+        raise argparse.ArgumentTypeError("%s is not greater than 0." % s)
+    return i
@@ -87,7 +87,7 @@ class CTypesRecordConstraintValidator(interfaces.IRecordConstraintsValidator):
             raise TypeError("Feed me a target_ctypes as Ctypes modules")
         self._memory_handler = memory_handler
         self._ctypes = target_ctypes
-        self._utils = utils.Utils(self._ctypes)
+        self._utils = utils.get_ctypes_utils(self._ctypes)
         self._constraints_base = None
         self._constraints_dynamic = None
         if my_constraints is not None:
@@ -509,10 +509,11 @@ class CTypesRecordConstraintValidator(interfaces.IRecordConstraintsValidator):
         Returns False if the object address is NULL.
         Returns False if the object address is not in a mapping.
         Returns False if the object overflows the mapping.
+        Returns False if the mapping content was not dumped.
 
         Returns the mapping in which the address stands otherwise.
         """
-        m = self._memory_handler.get_mapping_for_address(addr)
+        m = self._memory_handler.is_valid_address_value(addr)
         log.debug('is_valid_address_value = %x %s' % (addr, m))
         if m:
             if structType is not None:
@@ -9,8 +9,6 @@ import os
 import sys
 import time
 
-import pkg_resources
-
 try:
     from urllib.parse import urlparse
 except ImportError:
@@ -19,6 +17,8 @@ except ImportError:
 from haystack import argparse_utils
 from haystack import basicmodel
 from haystack import constraints
+from haystack import dbg
+from haystack import plugins
 from haystack.search import api
 
 log = logging.getLogger('cli')
@@ -47,10 +47,8 @@ DUMPTYPE_FRIDA = 'frida'
 #                'dmp': DUMPTYPE_MINIDUMP,
 #                'frida': DUMPTYPE_FRIDA}
 
-SUPPORTED_DUMP_URI = {}
-# populate SUPPORTED_DUMP_URI
-for entry_point in pkg_resources.iter_entry_points("haystack.mappings_loader"):
-    SUPPORTED_DUMP_URI[entry_point.name] = entry_point.resolve()
+# the loader of a scheme is imported when it is used
+SUPPORTED_DUMP_URI = plugins.PluginRegistry(plugins.MAPPINGS_LOADER_GROUP, plugins.BUILTIN_MAPPINGS_LOADERS)
 
 
 def url(u):
@@ -70,7 +68,7 @@ def url(u):
         _url = urlparse("%s://%s" % (scheme, path))
     if scheme in ['volatility', 'rekall']:
         path = _url.path.split(':')[0]
-    if scheme in ['dir', 'volatility', 'rekall', 'dmp']:
+    if scheme in ['dir', 'hsd', 'tar', 'core', 'volatility', 'rekall', 'dmp']:
         if not os.path.exists(path):
             raise argparse.ArgumentTypeError("Target {p} does not exists".format(p=path))
         # see url.netloc for host name, frida ? live ?
@@ -94,7 +92,26 @@ def make_memory_handler(opts):
     if dumptype not in SUPPORTED_DUMP_URI.keys():
         raise TypeError('dump type has no case support. %s' % dumptype)
     loader = SUPPORTED_DUMP_URI[dumptype](opts)
-    return loader.make_memory_handler()
+    memory_handler = loader.make_memory_handler()
+    if getattr(opts, 'explain_detection', False):
+        print(format_detection_report(memory_handler.get_target_platform()))
+    if getattr(opts, 'rebuild_cache', False):
+        # drop the heap walk index saved next to the dump
+        memory_handler.get_heap_finder().reset_heap_index()
+    if getattr(opts, 'workers', 1) > 1:
+        memory_handler.get_heap_finder().set_workers(opts.workers)
+    return memory_handler
+
+
+def format_detection_report(target_platform):
+    """Returns the detection report of the target platform as text"""
+    lines = ['%s' % target_platform]
+    total = 0
+    for name, value, source, seconds, probed in target_platform.get_detection_report():
+        lines.append('  %-10s %-6s %-9s %0.4fs %d mappings read' % (name, value, source, seconds, probed))
+        total += seconds
+    lines.append('  detection took %0.4fs' % total)
+    return '\n'.join(lines)
 
 
 def get_output(memory_handler, results, rtype):
@@ -144,9 +161,13 @@ def search_cmdline(args):
     results = api.search_record(memory_handler, record_type, my_constraints, extended_search=args.extended)
     # output handling
     try:
-        ret = get_output(memory_handler, results, args.output)
-        # print output on stdout
-        print(ret)
+        if args.output == 'jsonl':
+            # stream the results on stdout
+            api.output_to_json_lines(memory_handler, results, sys.stdout)
+        else:
+            ret = get_output(memory_handler, results, args.output)
+            # print output on stdout
+            print(ret)
     except Exception as e:
         log.error(e)
     finally:
@@ -189,9 +210,12 @@ def show_cmdline(args):
     # output handling
     ret = None
     try:
-        ret = get_output(memory_handler, results, args.output)
-        # print output on stdout
-        print(ret)
+        if args.output == 'jsonl':
+            api.output_to_json_lines(memory_handler, results, sys.stdout)
+        else:
+            ret = get_output(memory_handler, results, args.output)
+            # print output on stdout
+            print(ret)
         if args.constraints_file:
             print('Validated', validation)
     except Exception as e:
@@ -294,8 +318,23 @@ def base_argparser(program_name, description):
     rootparser.add_argument('--interactive', dest='interactive', action='store_true',
                             help='drop to python command line after action')
     rootparser.add_argument('--nommap', dest='mmap', action='store_false', help='disable mmap()-ing')
+    rootparser.add_argument('--no-block-cache', dest='block_cache', action='store_false',
+                            help='Do not cache the blocks read from volatility, rekall or frida mappings')
+    live = rootparser.add_argument_group('live process')
+    live.add_argument('--vm-readv', dest='vm_readv', action='store_true',
+                      help='Read the live process memory with process_vm_readv, without stopping it')
+    live.add_argument('--snapshot', action='store_true',
+                      help='Copy the heaps of the live process with process_vm_readv, then resume it')
+    live.add_argument('--max-age', dest='max_age', type=float, action='store', default=dbg.DEFAULT_MAX_AGE,
+                      help='Seconds a page read with process_vm_readv is cached')
     rootparser.add_argument('--osname', '-n', action='store', default=None, choices=['linux', 'winxp', 'win7'], help='Force a specific OS')
     rootparser.add_argument('--bits', '-b', type=int, action='store', default=None, choices=[32, 64], help='Force a specific word size')
+    rootparser.add_argument('--explain-detection', dest='explain_detection', action='store_true',
+                            help='Print how the target OS and cpu bits were found, and how long it took')
+    rootparser.add_argument('--rebuild-cache', dest='rebuild_cache', action='store_true',
+                            help='Ignore and rebuild the heap index cached next to the dump')
+    rootparser.add_argument('--workers', '-w', type=argparse_utils.positive_int, action='store', default=1,
+                            help='Number of threads used to find and walk the heaps')
     text = '://, '.join(sorted(SUPPORTED_DUMP_URI.keys())) + '://'
     help_desc = 'target file or process. Supported URL types: %s' % text
     rootparser.add_argument('target', type=url, help=help_desc)
@@ -357,6 +396,8 @@ def output_argparser(rootparser):
                         help='Print results as human readable string')
     output.add_argument('--json', dest='output', action='store_const', const='json',
                         help='Print results as json readable string')
+    output.add_argument('--jsonl', dest='output', action='store_const', const='jsonl',
+                        help='Stream results as json lines, one result per line')
     # useful in interactive mode
     output.add_argument('--python', dest='output', action='store_const', const='python',
                         help='Print results as python code')
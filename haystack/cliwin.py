@@ -10,6 +10,7 @@ import sys
 
 from haystack import cli
 from haystack import argparse_utils
+from haystack.allocators import heapstats
 from haystack.outputters import text
 from haystack.mappings import folder
 
@@ -32,6 +33,8 @@ def find_heap():
     group.add_argument('address', nargs='?', type=argparse_utils.int16, default=None, help='Load Heap from address (hex)')
     group.add_argument('--heap', '-p', action='store_true', help='Show the heap content')
     group.add_argument('--frontend', '-f', action='store_true', help='Show the frontend heap content')
+    parser.add_argument('--stats', '-s', choices=['json', 'csv'], default=None,
+                        help='Output heap statistics for all heaps, as json or csv')
 
     opts = parser.parse_args(argv)
     cli.set_logging_level(opts)
@@ -39,6 +42,14 @@ def find_heap():
     memory_handler = cli.make_memory_handler(opts)
     finder = memory_handler.get_heap_finder()
 
+    if opts.stats is not None:
+        stats = heapstats.make_process_statistics(finder)
+        if opts.stats == 'json':
+            print(heapstats.output_to_json(stats))
+        else:
+            heapstats.output_to_csv(stats, sys.stdout)
+        return
+
     # Show Target information
     if opts.bits or opts.osname:
         print('Forced target resolution:', memory_handler.get_target_platform())
@@ -58,7 +69,11 @@ def find_heap():
 
     print('Probable Process HEAPS:')
     for m in memory_handler.get_mappings():
-        for addr in range(m.start, m.end, 0x1000):
+        # zero pages have no heap signature
+        presence = m.get_page_presence()
+        for i, addr in enumerate(range(m.start, m.end, 0x1000)):
+            if not presence[i]:
+                continue
             special = ''
             for os, bits, offset in [('winxp', 32, 8), ('winxp', 64, 16),
                                      ('win7', 32, 100), ('win7', 64, 160)]:
@@ -75,6 +90,12 @@ def find_heap():
         validator = walker.get_heap_validator()
         validator.print_heap_analysis(walker.get_heap(), opts.verbose)
 
+    if opts.verbose:
+        print('Heap timings:')
+        print('@heap        find(s)   walk(s)')
+        for addr, find_time, walk_time in finder.get_heap_timings():
+            print('0x%0.8x  %8.3f  %8.3f' % (addr, find_time, walk_time))
+
     return
 
 
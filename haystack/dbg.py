@@ -1,29 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
+import ctypes
+import errno
 import logging
+import os
 import platform
+import signal
+import struct
+import threading
 import time
 
+from past.builtins import long
 
-try:
-    import ptrace
-    from ptrace import os_tools
-    from ptrace.debugger import debugger
-    from ptrace import linux_proc
-    from ptrace.debugger import process_error
-
-except ImportError as e:
-    pass
-
-try:
-    import winappdbg
-
-except ImportError as e:
-    pass
+# ptrace and winappdbg are imported by the debuggers that use them. They are slow to import.
 
 log = logging.getLogger("gbd")
 
+PAGE_SIZE = 0x1000
+# iovec per process_vm_readv call
+IOV_MAX = 1024
+# seconds a page read from a live process is served from the cache
+DEFAULT_MAX_AGE = 0.5
+# pages in the live page cache
+DEFAULT_CACHE_PAGES = 4096
+# larger reads bypass the page cache
+CACHE_MAX_READ = 16 * PAGE_SIZE
+# seconds to wait for a process to stop on SIGSTOP
+STOP_TIMEOUT = 2.0
+
 
 class IProcessDebugger(object):
     def get_process(self):
@@ -55,6 +61,8 @@ class IProcess(object):
 
 class MyPTraceDebugger(IProcessDebugger):
     def __init__(self, pid):
+        from ptrace import os_tools
+        from ptrace.debugger import debugger
         # /proc mappings debugger
         if not os_tools.HAS_PROC:
             raise TypeError('We only support /proc ptrace')
@@ -75,6 +83,7 @@ class MyPTraceDebugger(IProcessDebugger):
 class MyWinAppDebugger(IProcessDebugger):
 
     def __init__(self, pid):
+        import winappdbg
         winappdbg.System.request_debug_privileges()
         self.procs = []
         proc = winappdbg.Process(pid)
@@ -100,6 +109,7 @@ class MyPTraceProcess(IProcess):
         self.ptrace_process.cont()
 
     def get_mappings_line(self):
+        from ptrace import linux_proc
         return linux_proc.openProc("%s/maps" % self.get_pid()).readlines()
 
     def read_word(self, address):
@@ -128,6 +138,7 @@ class MyWinAppDbgProcess(IProcess):
 
     def get_mappings_line(self):
         """ return proc maps """
+        import winappdbg
         fileName = self.winapp_process.get_filename()
         memoryMap = self.winapp_process.get_memory_map()
         mappedFilenames = self.winapp_process.get_mapped_filenames()
@@ -237,6 +248,196 @@ class MyWinAppDbgProcess(IProcess):
         return self.winapp_process.read_structure(address, basetype * count)
 
 
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+_process_vm_readv = None
+
+
+def _get_process_vm_readv():
+    global _process_vm_readv
+    if _process_vm_readv is None:
+        try:
+            func = ctypes.CDLL(None, use_errno=True).process_vm_readv
+        except AttributeError:
+            raise NotImplementedError('process_vm_readv is not available on this platform')
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_ulong,
+                         ctypes.POINTER(iovec), ctypes.c_ulong, ctypes.c_ulong]
+        func.restype = ctypes.c_ssize_t
+        _process_vm_readv = func
+    return _process_vm_readv
+
+
+def process_vm_readv(pid, ranges):
+    """
+    Reads several memory ranges of a process, IOV_MAX ranges per syscall.
+
+    :param ranges: list of (address, size)
+    :return: list of bytes, None for the ranges that could not be read
+    """
+    func = _get_process_vm_readv()
+    results = [None] * len(ranges)
+    i = 0
+    while i < len(ranges):
+        batch = ranges[i:i + IOV_MAX]
+        buf = ctypes.create_string_buffer(sum(size for address, size in batch))
+        buf_address = ctypes.addressof(buf)
+        local_iov = (iovec * len(batch))()
+        remote_iov = (iovec * len(batch))()
+        offset = 0
+        for j, (address, size) in enumerate(batch):
+            local_iov[j].iov_base = buf_address + offset
+            local_iov[j].iov_len = size
+            remote_iov[j].iov_base = address
+            remote_iov[j].iov_len = size
+            offset += size
+        read = func(pid, local_iov, len(batch), remote_iov, len(batch), 0)
+        if read < 0:
+            err = ctypes.get_errno()
+            if err != errno.EFAULT:
+                raise OSError(err, os.strerror(err))
+            read = 0
+        # a partial read stops before the first range that could not be read
+        offset = 0
+        done = 0
+        for address, size in batch:
+            if offset + size > read:
+                break
+            results[i + done] = ctypes.string_at(buf_address + offset, size)
+            offset += size
+            done += 1
+        if done < len(batch):
+            log.debug('could not read 0x%x-0x%x', batch[done][0], batch[done][0] + batch[done][1])
+            done += 1
+        i += done
+    return results
+
+
+class ProcessVMReadvProcess(IProcess):
+    """
+    Reads the memory of a live process with process_vm_readv, without ptrace.
+
+    The process is not stopped, unless stop() is called.
+    Pages read are cached for max_age seconds. Set max_age to 0 to disable the cache.
+    """
+    def __init__(self, pid, max_age=DEFAULT_MAX_AGE, cache_size=DEFAULT_CACHE_PAGES):
+        self.pid = pid
+        self.max_age = max_age
+        self._cache_size = cache_size
+        # page address: (read time, page content)
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.hits = 0
+        self.misses = 0
+
+    def get_pid(self):
+        return self.pid
+
+    def _get_state(self):
+        with open('/proc/%d/stat' % self.pid) as fin:
+            return fin.read().rsplit(')', 1)[1].split()[0]
+
+    def stop(self):
+        """ stop the process with SIGSTOP, and wait for it to be stopped """
+        os.kill(self.pid, signal.SIGSTOP)
+        self._stopped = True
+        t0 = time.time()
+        while self._get_state() not in ['T', 't']:
+            if time.time() - t0 > STOP_TIMEOUT:
+                log.warning('process %d did not stop after %0.1f secs', self.pid, STOP_TIMEOUT)
+                break
+            time.sleep(0.0005)
+        self.invalidate()
+
+    def resume(self):
+        if self._stopped:
+            os.kill(self.pid, signal.SIGCONT)
+            self._stopped = False
+
+    def invalidate(self):
+        with self._lock:
+            self._pages.clear()
+
+    def get_mappings_line(self):
+        with open('/proc/%d/maps' % self.pid) as fin:
+            return fin.readlines()
+
+    def read_bytes_many(self, ranges):
+        """
+        Scatter read of several memory ranges, bypassing the cache.
+
+        :param ranges: list of (address, size)
+        :return: list of bytes, None for the ranges that could not be read
+        """
+        return process_vm_readv(self.pid, ranges)
+
+    def _read(self, address, size):
+        data = process_vm_readv(self.pid, [(address, size)])[0]
+        if data is None:
+            raise OSError(errno.EFAULT, 'could not read 0x%x-0x%x in process %d' % (address, address + size, self.pid))
+        return data
+
+    def read_bytes(self, address, size):
+        if self.max_age <= 0 or size > CACHE_MAX_READ:
+            return self._read(address, size)
+        first = address - address % PAGE_SIZE
+        pages = dict()
+        missing = []
+        now = time.time()
+        with self._lock:
+            for page in range(first, address + size, PAGE_SIZE):
+                entry = self._pages.get(page)
+                if entry is not None and now - entry[0] <= self.max_age:
+                    self.hits += 1
+                    pages[page] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append((page, PAGE_SIZE))
+        if len(missing) > 0:
+            contents = process_vm_readv(self.pid, missing)
+            with self._lock:
+                for (page, _), content in zip(missing, contents):
+                    if content is None:
+                        raise OSError(errno.EFAULT, 'could not read 0x%x in process %d' % (page, self.pid))
+                    pages[page] = content
+                    self._pages.pop(page, None)
+                    self._pages[page] = (now, content)
+                while len(self._pages) > self._cache_size:
+                    self._pages.popitem(last=False)
+        data = b''.join([pages[page] for page in range(first, address + size, PAGE_SIZE)])
+        return data[address - first:address - first + size]
+
+    def read_word(self, address):
+        if ctypes.sizeof(ctypes.c_void_p) == 8:
+            return struct.unpack('Q', self.read_bytes(address, 8))[0]
+        return struct.unpack('I', self.read_bytes(address, 4))[0]
+
+    def read_struct(self, address, _struct):
+        return _struct.from_buffer_copy(self.read_bytes(address, ctypes.sizeof(_struct)))
+
+    def read_array(self, address, basetype, count):
+        return (basetype * count).from_buffer_copy(self.read_bytes(address, ctypes.sizeof(basetype) * count))
+
+
+class ProcessVMReadvDebugger(IProcessDebugger):
+    """
+    Reads a live process with process_vm_readv.
+    If stop is True, the process is stopped with SIGSTOP until quit().
+    """
+    def __init__(self, pid, stop=False, max_age=DEFAULT_MAX_AGE):
+        self.process = ProcessVMReadvProcess(pid, max_age=max_age)
+        if stop:
+            self.process.stop()
+
+    def get_process(self):
+        return self.process
+
+    def quit(self):
+        self.process.resume()
+
+
 def get_debugger(pid):
     if platform.system() != 'Windows':
         return MyPTraceDebugger(pid)
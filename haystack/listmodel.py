@@ -84,12 +84,121 @@ to iterate on elements of the list.
 
 import ctypes
 import logging
+import struct
+
+import numpy
 
 from haystack import basicmodel
 from haystack import constraints
 
 log = logging.getLogger('listmodel')
 
+# below that many frontier nodes, the lists are walked one node at a time
+_MIN_BATCH_SIZE = 16
+
+
+def _walk_double_linked_list(memory_handler, frontier, seen, size, forward_offset, backward_offset, word_size):
+    """
+    Walks one double linked list, one node at a time.
+
+    :param frontier: list of the next addresses to visit
+    :param seen: set of the visited and sentinel addresses, updated
+    :return: (members, bad_link)
+        members is the list of the nodes addresses, bad_link the first invalid node address or None.
+    """
+    fmt = 'Q' if word_size == 8 else 'I'
+    members = []
+    while len(frontier) > 0:
+        addr = frontier.pop()
+        if addr == 0 or addr in seen:
+            continue
+        seen.add(addr)
+        m = memory_handler.is_valid_address_value(addr)
+        if not m or addr + size > m.end:
+            return members, addr
+        members.append(addr)
+        frontier.append(struct.unpack(fmt, m.read_bytes(addr + forward_offset, word_size))[0])
+        frontier.append(struct.unpack(fmt, m.read_bytes(addr + backward_offset, word_size))[0])
+    return members, None
+
+
+def walk_double_linked_lists(memory_handler, links, size, forward_offset, backward_offset, sentinels=None,
+                             word_size=None):
+    """
+    Iterates over many double linked lists at once, one level of nodes at a time.
+
+    At each step, the forward and backward links of all the nodes of the frontier are read
+    with two batched reads. The visited addresses are kept in one set per list.
+    When the frontier gets small, the remaining nodes are walked one by one.
+
+    :param memory_handler: IMemoryHandler
+    :param links: list of the (forward, backward) addresses of the head of each list
+    :param size: the size of the list entry record at each node address
+    :param forward_offset: the offset of the forward pointer in the list entry record
+    :param backward_offset: the offset of the backward pointer in the list entry record
+    :param sentinels: list of the sets of addresses that are not part of each list
+    :param word_size: the size of the pointers of the list entry record, the target word size by default
+    :return: (members, bad_links)
+        members is the list of the numpy arrays of the nodes addresses of each list.
+        bad_links is a dict(list index: the first invalid node address).
+        The members of such a list are incomplete.
+    """
+    if word_size is None:
+        _ctypes = memory_handler.get_target_platform().get_target_ctypes()
+        word_size = _ctypes.sizeof(_ctypes.c_void_p)
+    count = len(links)
+    seen = [set() for i in range(count)]
+    for i, list_sentinels in enumerate(sentinels or []):
+        seen[i].update(list_sentinels)
+    members = [[] for i in range(count)]
+    bad_links = dict()
+    # the frontier
+    list_indexes = [i for i in range(count) for j in range(2)]
+    addresses = [int(addr) for link in links for addr in link]
+    while len(addresses) >= _MIN_BATCH_SIZE:
+        # drop the null, visited and sentinel addresses, and the lists with a bad link
+        next_indexes = []
+        next_addresses = []
+        for i, addr in zip(list_indexes, addresses):
+            if addr == 0 or addr in seen[i] or i in bad_links:
+                continue
+            seen[i].add(addr)
+            next_indexes.append(i)
+            next_addresses.append(addr)
+        if len(next_addresses) == 0:
+            return [numpy.asarray(m, dtype=numpy.uint64) for m in members], bad_links
+        list_indexes = numpy.asarray(next_indexes, dtype=numpy.uint64)
+        addresses = numpy.asarray(next_addresses, dtype=numpy.uint64)
+        valid = memory_handler.are_valid_address_values(addresses, size)
+        for i, addr in zip(list_indexes[~valid].tolist(), addresses[~valid].tolist()):
+            bad_links.setdefault(i, addr)
+        list_indexes = list_indexes[valid]
+        addresses = addresses[valid]
+        for i, addr in zip(list_indexes.tolist(), addresses.tolist()):
+            members[i].append(addr)
+        if len(bad_links) > 0:
+            advance = ~numpy.isin(list_indexes, list(bad_links.keys()))
+            list_indexes = list_indexes[advance]
+            addresses = addresses[advance]
+        # next level
+        forwards = memory_handler.read_words(addresses + numpy.uint64(forward_offset), word_size)
+        backwards = memory_handler.read_words(addresses + numpy.uint64(backward_offset), word_size)
+        list_indexes = numpy.concatenate((list_indexes, list_indexes)).tolist()
+        addresses = numpy.concatenate((forwards, backwards)).tolist()
+    # finish the lists one by one
+    frontiers = dict()
+    for i, addr in zip(list_indexes, addresses):
+        frontiers.setdefault(i, []).append(addr)
+    for i, frontier in frontiers.items():
+        if i in bad_links:
+            continue
+        list_members, bad_link = _walk_double_linked_list(memory_handler, frontier, seen[i], size,
+                                                          forward_offset, backward_offset, word_size)
+        members[i].extend(list_members)
+        if bad_link is not None:
+            bad_links[i] = bad_link
+    return [numpy.asarray(m, dtype=numpy.uint64) for m in members], bad_links
+
 
 class ListModel(basicmodel.CTypesRecordConstraintValidator):
     """
@@ -413,7 +522,7 @@ class ListModel(basicmodel.CTypesRecordConstraintValidator):
         log.debug("_iterate_list_from_field_with_link_info Field:%s at offset:%d st_size:%d", fieldname, offset, self._ctypes.sizeof(pointee_record_type))
         for x in self._iterate_list_from_field_inner(iterator_fn, head, pointee_record_type, offset, done):
             yield x
-        raise StopIteration
+        return
 
     def _iterate_list_from_field_inner(self, iterator_fn, head, pointee_record_type, offset, sentinels):
         """
@@ -468,59 +577,47 @@ class ListModel(basicmodel.CTypesRecordConstraintValidator):
                 yield st
             # save the last address as a sentinel
             sentinels.add(list_member_address)
-        raise StopIteration
+        return
+
+    def get_double_linked_lists_members(self, records, sentinels=None):
+        """
+        Returns the addresses of the members of many double linked lists, iterated all at once.
+
+        :param records: the instances of a registered double linked list record type
+        :param sentinels: list of the sets of addresses that are not part of each list
+        :return: (members, bad_links), see walk_double_linked_lists
+        """
+        if len(records) == 0:
+            return [], dict()
+        record_type = type(records[0])
+        forward, backward, _ = self.get_double_linked_list_type(record_type)
+        links = [(self._utils.get_pointee_address(getattr(record, forward)),
+                  self._utils.get_pointee_address(getattr(record, backward))) for record in records]
+        return walk_double_linked_lists(self._memory_handler, links, self._ctypes.sizeof(record_type),
+                                        self._utils.offsetof(record_type, forward),
+                                        self._utils.offsetof(record_type, backward),
+                                        sentinels, self._ctypes.sizeof(self._ctypes.c_void_p))
 
     def _iterate_double_linked_list(self, record, sentinels=None):
         """
-        iterate forward, then backward, until null or duplicate
+        iterate forward and backward, until null or duplicate
 
         :param record:
         :return:
         """
-        # stop when Null
-        done = {0}
         if sentinels is None:
-            sentinels = {}
-        obj = record
+            sentinels = set()
         record_type = type(record)
-        # we ignore the sentinels here, as this is an internal iterator
-        forward, backward, _ = self.get_double_linked_list_type(record_type)
         log.debug('sentinels: {%s}', ','.join(['0x%0.8x' % s for s in sentinels]))
-        # make the stack
-        stack = set()
-        for fieldname in [forward, backward]:
-            link = getattr(obj, fieldname)
-            addr = self._utils.get_pointee_address(link)
-            stack.add(addr)
-        # go trough the tree
-        while 1:
-            new_nodes = set()
-            if len(stack) == 0:
-                log.debug('x2_list: empty stack, stop iteration')
-                break
-            for addr in stack:
-                if addr in done or addr in sentinels:
-                    log.debug('x2_list: addr: 0x%x in done or sentinels', addr)
-                    continue
-                done.add(addr)
-                memory_map = self._memory_handler.is_valid_address_value(addr, record_type)
-                if memory_map is False:
-                    log.error("_iterate_double_linked_list: the link of this linked list has a bad value: 0x%x", addr)
-                    raise ValueError('ValueError: the link of this linked list has a bad value: 0x%x' % addr)
-                st = memory_map.read_struct(addr, record_type)
-                st._orig_address_ = addr
-                self._memory_handler.keepRef(st, record_type, addr)
-                log.debug("keepRefx2 %s.%s: @%x", record_type.__name__, fieldname, addr)
-                yield addr
-                # next
-                f_addr = self._utils.get_pointee_address(getattr(st, forward))
-                b_addr = self._utils.get_pointee_address(getattr(st, backward))
-                new_nodes.add(f_addr)
-                new_nodes.add(b_addr)
-                log.debug('_iterate_double_linked_list %s <%s>/0x%x', forward, link.__class__.__name__, f_addr)
-                log.debug('_iterate_double_linked_list %s <%s>/0x%x', backward, link.__class__.__name__, b_addr)
-            stack = new_nodes
-        raise StopIteration
+        members, bad_links = self.get_double_linked_lists_members([record], [sentinels])
+        addresses = members[0].tolist()
+        for addr, st in zip(addresses, self._memory_handler.read_struct_many(addresses, record_type)):
+            self._memory_handler.keepRef(st, record_type, addr)
+            yield addr
+        if 0 in bad_links:
+            log.error("_iterate_double_linked_list: the link of this linked list has a bad value: 0x%x", bad_links[0])
+            raise ValueError('ValueError: the link of this linked list has a bad value: 0x%x' % bad_links[0])
+        return
 
     def _iterate_single_linked_list(self, record, sentinels=None):
         """
@@ -562,7 +659,7 @@ class ListModel(basicmodel.CTypesRecordConstraintValidator):
             link = getattr(st, fieldname)
             addr = self._utils.get_pointee_address(link)
             log.debug('_iterate_single_linked_list <%s>/0x%x', link.__class__.__name__, addr)
-        raise StopIteration
+        return
 
     def is_valid(self, record):
         """
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Random access to haystack folder dumps archived as tar or tar.gz files.
+
+The archive is not extracted.
+
+    - In a tar file, the mapping files are stored uncompressed. The tar file is
+      mmap-ed and each mapping reads its member data zero-copy at its offset.
+    - In a tar.gz file, a seek index of the gzip stream is built in one pass, with
+      an access point every 4 MB of uncompressed data, and saved in the <archive>.d folder.
+      A read inflates from the closest access point, and the inflated data is kept
+      in a LRU cache of 64 KB blocks.
+
+Usage:
+    haystack-live-dump --archive gztar 1234 dump
+    haystack-search tar:///path/to/dump.tar.gz ...
+"""
+
+from __future__ import print_function
+
+import bisect
+import ctypes
+import ctypes.util
+import io
+import json
+import logging
+import mmap
+import os
+import struct
+import tarfile
+import zlib
+
+import numpy
+
+from haystack.abc import interfaces
+from haystack.allocators import heapindex
+from haystack.mappings import container
+from haystack.mappings import delta
+from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MetadataMemoryMapping
+from haystack.mappings.file import LocalMemoryMapping
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__status__ = "Production"
+
+log = logging.getLogger('archive')
+
+GZIP_MAGIC = b'\x1f\x8b'
+# uncompressed bytes between two access points of the gzip index
+DEFAULT_SPAN = 4 * 1024 * 1024
+# compressed bytes read at once
+READ_SIZE = 64 * 1024
+# the deflate window before an access point
+WINDOW_SIZE = 32 * 1024
+# the bits of an access point at the header of a gzip member
+MEMBER_START = -1
+# the gzip index is saved in the <archive>.d cache folder
+GZIP_INDEX_FILENAME = 'gzipindex.npz'
+# change it when the file layout changes
+GZIP_INDEX_FORMAT = 1
+# zlib.h
+Z_OK, Z_STREAM_END = 0, 1
+Z_BLOCK = 5
+
+
+def is_gzip(filename):
+    with open(filename, 'rb') as fin:
+        return fin.read(2) == GZIP_MAGIC
+
+
+def is_archive(filename):
+    return os.path.isfile(filename) and tarfile.is_tarfile(filename)
+
+
+class _ZStream(ctypes.Structure):
+    """ zlib z_stream """
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+
+def _load_libz():
+    """
+    The zlib module does not tell where the deflate blocks end, so the index is built with libz.
+    returns None if libz can not be loaded.
+    """
+    name = ctypes.util.find_library('z') or ctypes.util.find_library('zlib1')
+    if name is None:
+        return None
+    try:
+        libz = ctypes.CDLL(name)
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        libz.inflate.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int]
+        libz.inflateReset.argtypes = [ctypes.POINTER(_ZStream)]
+        libz.inflateEnd.argtypes = [ctypes.POINTER(_ZStream)]
+    except (OSError, AttributeError) as e:
+        log.debug('Could not load libz: %s', e)
+        return None
+    return libz
+
+
+_libz = _load_libz()
+
+
+def get_gzip_index_filename(filename):
+    return os.path.join(filename + heapindex.CACHE_FOLDER_SUFFIX, GZIP_INDEX_FILENAME)
+
+
+class GzipIndex(object):
+    """
+    A seek index over a gzip file, after zran.c in the zlib examples.
+
+    An access point is at the end of a deflate block. It holds the uncompressed offset,
+    the offset of the next compressed byte, the number of bits of the block in the previous
+    byte, and the last 32 KB of uncompressed data. Inflating from an access point
+    aligns the compressed bytes on the block, and primes a raw inflate with the window.
+    The windows are kept compressed.
+
+    The index is built in one pass with libz, and saved in the <archive>.d folder. Without libz,
+    the only access points are the starts of the gzip members.
+    """
+    def __init__(self, filename, span=DEFAULT_SPAN, block_size=container.DEFAULT_BLOCK_SIZE,
+                 cache_size=container.DEFAULT_CACHE_SIZE):
+        self._filename = filename
+        self._span = span
+        self.block_size = block_size
+        self.cache = container.BlockCache(cache_size)
+        self._fin = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+        # access points: uncompressed offsets, compressed offsets, bits and compressed windows
+        self._outs = []
+        self._ins = []
+        self._bits = []
+        self._windows = []
+        self.size = 0
+        if not self._load_index():
+            if _libz is None:
+                log.warning('libz not found, %s is only indexed by gzip member', filename)
+                self._build_members()
+            else:
+                self._build()
+            self._save_index()
+        log.debug('%s: %d bytes, %d access points', filename, self.size, len(self._outs))
+
+    def _add_point(self, out_offset, in_pos, bits, window):
+        self._outs.append(out_offset)
+        self._ins.append(in_pos)
+        self._bits.append(bits)
+        self._windows.append(zlib.compress(window, 1))
+
+    def _build(self):
+        """ inflate the whole file with libz, stopping at each deflate block end """
+        strm = _ZStream()
+        if _libz.inflateInit2_(ctypes.byref(strm), zlib.MAX_WBITS | 16, _libz.zlibVersion(),
+                               ctypes.sizeof(_ZStream)) != Z_OK:
+            raise MemoryError('inflateInit2 failed')
+        window = ctypes.create_string_buffer(WINDOW_SIZE)
+        total_in = total_out = 0
+        member_out = last = 0
+        self._add_point(0, 0, MEMBER_START, b'')
+        try:
+            while True:
+                data = self._fin.read(READ_SIZE)
+                if not data:
+                    break
+                buf = ctypes.create_string_buffer(data, len(data))
+                strm.next_in = ctypes.addressof(buf)
+                strm.avail_in = len(data)
+                while strm.avail_in != 0:
+                    if strm.avail_out == 0:
+                        strm.next_out = ctypes.addressof(window)
+                        strm.avail_out = WINDOW_SIZE
+                    total_in += strm.avail_in
+                    total_out += strm.avail_out
+                    ret = _libz.inflate(ctypes.byref(strm), Z_BLOCK)
+                    total_in -= strm.avail_in
+                    total_out -= strm.avail_out
+                    if ret == Z_STREAM_END:
+                        # concatenated gzip members
+                        rest = ctypes.string_at(strm.next_in, min(strm.avail_in, 2)) if strm.avail_in else b''
+                        if len(rest) < 2:
+                            rest += self._peek(total_in + len(rest), 2 - len(rest))
+                        if rest != GZIP_MAGIC:
+                            return
+                        _libz.inflateReset(ctypes.byref(strm))
+                        member_out = last = total_out
+                        self._add_point(total_out, total_in, MEMBER_START, b'')
+                        continue
+                    elif ret != Z_OK:
+                        raise ValueError('%s: invalid gzip data at offset %d' % (self._filename, total_in))
+                    # at a block end, but not the last block
+                    if strm.data_type & 128 and not strm.data_type & 64 and total_out - last > self._span:
+                        pos = WINDOW_SIZE - strm.avail_out
+                        history = window.raw[pos:] + window.raw[:pos]
+                        self._add_point(total_out, total_in, strm.data_type & 7,
+                                        history[WINDOW_SIZE - min(WINDOW_SIZE, total_out - member_out):])
+                        last = total_out
+        finally:
+            self.size = total_out
+            _libz.inflateEnd(ctypes.byref(strm))
+
+    def _build_members(self):
+        """ inflate the whole file with the zlib module, and add an access point at each gzip member """
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        in_pos = 0
+        self._add_point(0, 0, MEMBER_START, b'')
+        while in_pos < len(self._mmap):
+            pending = self._mmap[in_pos:in_pos + READ_SIZE]
+            in_pos += len(pending)
+            while pending:
+                self.size += len(decompressor.decompress(pending))
+                if not decompressor.eof:
+                    break
+                pending = decompressor.unused_data
+                member_in = in_pos - len(pending)
+                if self._peek(member_in, 2) != GZIP_MAGIC:
+                    return
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                self._add_point(self.size, member_in, MEMBER_START, b'')
+        return
+
+    def _peek(self, in_pos, size):
+        return self._mmap[in_pos:in_pos + size]
+
+    def _make_metadata(self):
+        st = os.stat(self._filename)
+        return {'format': GZIP_INDEX_FORMAT,
+                'archive': '%d %d' % (st.st_size, int(st.st_mtime)),
+                'span': self._span}
+
+    def _load_index(self):
+        """ loads the access points saved next to the archive. returns False if there are none, or stale """
+        filename = get_gzip_index_filename(self._filename)
+        if not os.access(filename, os.F_OK):
+            return False
+        try:
+            with numpy.load(filename, allow_pickle=False) as data:
+                if json.loads(str(data['meta'])) != self._make_metadata():
+                    log.info('Gzip index %s is stale, ignoring it', filename)
+                    return False
+                windows, window_index = data['windows'].tobytes(), data['window_index'].tolist()
+                self._outs = data['outs'].tolist()
+                self._ins = data['ins'].tolist()
+                self._bits = data['bits'].tolist()
+                self._windows = [windows[window_index[i]:window_index[i+1]] for i in range(len(self._outs))]
+                self.size = int(data['size'])
+        except (IOError, OSError, KeyError, ValueError) as e:
+            log.warning('Could not read gzip index %s: %s', filename, e)
+            self._outs, self._ins, self._bits, self._windows = [], [], [], []
+            return False
+        return True
+
+    def _save_index(self):
+        filename = get_gzip_index_filename(self._filename)
+        window_index = numpy.zeros(len(self._windows) + 1, dtype=numpy.int64)
+        window_index[1:] = numpy.cumsum([len(w) for w in self._windows])
+        try:
+            folder_name = os.path.dirname(filename)
+            if not os.access(folder_name, os.F_OK):
+                os.mkdir(folder_name)
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp_filename, 'wb') as fout:
+                numpy.savez(fout,
+                            meta=numpy.array(json.dumps(self._make_metadata())),
+                            size=numpy.array(self.size, dtype=numpy.uint64),
+                            outs=numpy.array(self._outs, dtype=numpy.uint64),
+                            ins=numpy.array(self._ins, dtype=numpy.uint64),
+                            bits=numpy.array(self._bits, dtype=numpy.int8),
+                            windows=numpy.frombuffer(b''.join(self._windows), dtype=numpy.uint8),
+                            window_index=window_index)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            log.warning('Could not write gzip index %s: %s', filename, e)
+            return False
+        return True
+
+    def _read_input(self, in_pos, bits, size):
+        """ returns size compressed bytes from in_pos, shifted to start at the block of an access point """
+        if in_pos >= len(self._mmap):
+            return b''
+        elif bits <= 0:
+            return self._mmap[in_pos:in_pos + size]
+        # the block starts in the top bits of the byte before in_pos
+        raw = numpy.frombuffer(self._mmap[in_pos - 1:in_pos + size], dtype=numpy.uint8).astype(numpy.uint16)
+        following = numpy.append(raw[1:], numpy.uint16(0))
+        shifted = ((raw >> (8 - bits)) | (following << bits)) & 0xff
+        return shifted.astype(numpy.uint8).tobytes()[:size]
+
+    def _inflate(self, i, end):
+        """ inflate from the access point i up to the end uncompressed offset """
+        out = []
+        out_offset = self._outs[i]
+        while out_offset < end:
+            bits, in_pos = self._bits[i], self._ins[i]
+            if bits == MEMBER_START:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                window = zlib.decompress(self._windows[i])
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+            pending = b''
+            while out_offset < end and not decompressor.eof:
+                if not pending:
+                    pending = self._read_input(in_pos, bits, READ_SIZE)
+                    in_pos += READ_SIZE
+                    if not pending:
+                        break
+                data = decompressor.decompress(pending, end - out_offset)
+                pending = decompressor.unconsumed_tail
+                out_offset += len(data)
+                out.append(data)
+            if not decompressor.eof:
+                break
+            # the next gzip member
+            i += 1
+            while i < len(self._bits) and self._bits[i] != MEMBER_START:
+                i += 1
+            if i == len(self._bits):
+                break
+        return b''.join(out)
+
+    def _load_block(self, index):
+        """ inflate the blocks up to the next access point, and cache them """
+        offset = index * self.block_size
+        i = bisect.bisect_right(self._outs, offset) - 1
+        start = self._outs[i]
+        stop = self._outs[i + 1] if i + 1 < len(self._outs) else self.size
+        # up to the end of the block holding the next access point
+        end = max(offset + self.block_size, -(-stop // self.block_size) * self.block_size)
+        data = self._inflate(i, end)
+        # only the full blocks after the access point
+        first = -(-start // self.block_size)
+        for j in range(first, index):
+            self.cache.put(j, data[j * self.block_size - start:(j + 1) * self.block_size - start])
+        for j in range(index + 1, -(-(start + len(data)) // self.block_size)):
+            self.cache.put(j, data[j * self.block_size - start:(j + 1) * self.block_size - start])
+        return data[offset - start:offset - start + self.block_size]
+
+    def read(self, offset, size):
+        """ returns size uncompressed bytes at offset """
+        data = []
+        while size > 0:
+            index, block_offset = divmod(offset, self.block_size)
+            block = self.cache.get(index, self._load_block)
+            chunk = block[block_offset:block_offset + size]
+            if len(chunk) == 0:
+                break
+            data.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b''.join(data)
+
+    def close(self):
+        self._mmap.close()
+        self._fin.close()
+        self._windows = []
+
+
+class GzipIndexFile(io.RawIOBase):
+    """ a read-only seekable file object over a GzipIndex, for tarfile """
+    def __init__(self, index):
+        self._index = index
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._index.size
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._index.size - self._pos
+        data = self._index.read(self._pos, size)
+        self._pos += len(data)
+        return data
+
+
+class ArchiveMemoryMapping(AMemoryMapping):
+    """
+    A memory mapping with content in a tar member.
+    """
+    def __init__(self, source, data_offset, start, end, permissions='r--',
+                 offset=0, major_device=0, minor_device=0, inode=0, pathname=''):
+        AMemoryMapping.__init__(self, start, end, permissions, offset,
+                                major_device, minor_device, inode, pathname)
+        # a memoryview of the tar mmap, or a GzipIndex
+        self._source = source
+        self._data_offset = data_offset
+
+    def _read(self, addr, size):
+        offset = addr - self.start
+        if offset < 0 or offset + size > len(self):
+            raise ValueError('0x%0.8x/0x%x is not a valid address range for me: %s' % (addr, size, self))
+        offset += self._data_offset
+        if isinstance(self._source, GzipIndex):
+            return self._source.read(offset, size)
+        return self._source[offset:offset + size]
+
+    def _get_content_array(self):
+        if isinstance(self._source, GzipIndex):
+            return None
+        return numpy.frombuffer(self._source, dtype=numpy.uint8, count=len(self), offset=self._data_offset)
+
+    def read_word(self, addr):
+        ws = self._ctypes.sizeof(self._ctypes.c_void_p)
+        data = self._read(addr, ws)
+        if ws == 4:
+            return struct.unpack('I', data)[0]
+        elif ws == 8:
+            return struct.unpack('Q', data)[0]
+
+    def read_bytes(self, addr, size):
+        return bytes(self._read(addr, size))
+
+    def read_struct(self, addr, struct_type):
+        size = self._ctypes.sizeof(struct_type)
+        instance = struct_type.from_buffer_copy(self._read(addr, size))
+        instance._orig_address_ = addr
+        return instance
+
+    def read_array(self, addr, basetype, count):
+        size = self._ctypes.sizeof(basetype * count)
+        array = (basetype * count).from_buffer_copy(self._read(addr, size))
+        return array
+
+    def mmap(self):
+        return self
+
+    def get_byte_buffer(self):
+        return self.read_bytes(self.start, len(self))
+
+    def reset(self):
+        pass
+
+
+class TarDumpLoader(folder.ProcessMemoryDumpLoader):
+    """ Loads a haystack folder dump from a tar or tar.gz file, without extracting it."""
+
+    def __init__(self, dumpname, bits=None, os_name=None, span=DEFAULT_SPAN):
+        self._span = span
+        super(TarDumpLoader, self).__init__(dumpname, bits=bits, os_name=os_name)
+
+    def _is_valid(self):
+        if not is_archive(self.dumpname):
+            return False
+        if is_gzip(self.dumpname):
+            self._source = GzipIndex(self.dumpname, span=self._span)
+            self._tar = tarfile.open(fileobj=GzipIndexFile(self._source), mode='r:')
+        else:
+            self._fin = open(self.dumpname, 'rb')
+            self._mmap = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+            self._source = memoryview(self._mmap)
+            self._tar = tarfile.open(fileobj=self._fin, mode='r:')
+        # the dump folder is archived with its name
+        self._members = dict()
+        for member in self._tar.getmembers():
+            if member.isfile():
+                self._members[os.path.basename(member.name)] = member
+        if self.indexFilename not in self._members:
+            log.error('no mappings index file in the archive.')
+            return False
+        return True
+
+    def _load_metadata(self):
+        self._read_metadata(io.TextIOWrapper(self._tar.extractfile(self._members[self.indexFilename])))
+        return
+
+    def _make_mappings(self):
+        _mappings = []
+        for mmap_fname, start, end, permissions, offset, major_device, minor_device, inode, pathname in self.metalines:
+            member = self._members.get(mmap_fname)
+            if member is None:
+                log.debug('Ignore absent file : %s', mmap_fname)
+                mmap = MetadataMemoryMapping(start, end, permissions, offset, major_device, minor_device, inode,
+                                             pathname=pathname)
+            elif member.issparse() or member.size != end - start:
+                # the member data is not stored contiguously
+                log.debug('Copying member %s', mmap_fname)
+                mmap = AMemoryMapping(start, end, permissions, offset, major_device, minor_device, inode,
+                                      pathname=pathname)
+                content = self._tar.extractfile(member).read()
+                content += b'\x00' * (end - start - len(content))
+                mmap = LocalMemoryMapping.fromBytebuffer(mmap, content)
+            else:
+                mmap = ArchiveMemoryMapping(self._source, member.offset_data, start, end, permissions,
+                                            offset, major_device, minor_device, inode, pathname=pathname)
+            _mappings.append(mmap)
+        if delta.BASE_FILENAME in self._members:
+            _mappings = self._overlay_mappings(_mappings)
+        return _mappings
+
+    def _overlay_mappings(self, mappings):
+        """ overlay an archived delta dump on its base dump """
+        base_member = self._members[delta.BASE_FILENAME]
+        base = self._tar.extractfile(base_member).read().decode('utf-8')
+        # the base path is relative to the delta dump folder, that was archived next to the archive
+        dumpname = os.path.join(os.path.dirname(os.path.abspath(self.dumpname)), os.path.dirname(base_member.name))
+        base_dumpname = delta.resolve_base_dumpname(dumpname, base)
+        delta_file = io.BytesIO(self._tar.extractfile(self._members[delta.DELTA_FILENAME]).read())
+        changed = delta.load_changed_pages(delta_file)
+        return delta.overlay_mappings(self.dumpname, mappings, self.metalines, base_dumpname=base_dumpname,
+                                      changed=changed)
+
+
+class TarLoader(interfaces.IMemoryLoader):
+    desc = 'Load a haystack memory dump archived in a tar or tar.gz file'
+
+    def __init__(self, opts):
+        self.loader = TarDumpLoader(opts.target.path, bits=opts.bits, os_name=opts.osname)
+
+    def make_memory_handler(self):
+        return self.loader.make_memory_handler()
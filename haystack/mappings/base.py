@@ -30,6 +30,16 @@ Its intended to be retrofittable with ptrace's memory _memory_handler.
 from past.builtins import long
 import logging
 
+import numpy
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    # numpy < 1.20
+    def sliding_window_view(content, size):
+        from numpy.lib.stride_tricks import as_strided
+        return as_strided(content, shape=(len(content) - size + 1, size), strides=content.strides * 2,
+                          writeable=False)
+
 # haystack
 from haystack import utils
 from haystack import model
@@ -46,6 +56,67 @@ __credits__ = ["Victor Skinner"]
 
 log = logging.getLogger('memorybase')
 
+PAGE_SIZE = 0x1000
+# the largest read of a group of coalesced reads
+MAX_COALESCED_READ = 1024 * 1024
+
+
+def make_page_presence(data):
+    """ returns a numpy bool array, True for each page of data holding a non-zero byte """
+    npages = (len(data) + PAGE_SIZE - 1) // PAGE_SIZE
+    if len(data) % PAGE_SIZE:
+        data = bytes(data) + b'\x00' * (npages * PAGE_SIZE - len(data))
+    pages = numpy.frombuffer(data, dtype=numpy.uint64).reshape(npages, PAGE_SIZE // 8)
+    return pages.any(axis=1)
+
+
+def presence_to_ranges(presence, start, end, margin=0):
+    """
+    Convert a page presence map to a sorted list of (start, end) address ranges.
+    Each range is extended backwards by margin bytes, and clamped to [start, end).
+    """
+    ranges = []
+    flags = numpy.concatenate(([False], presence, [False])).astype(numpy.int8)
+    edges = numpy.flatnonzero(numpy.diff(flags))
+    for first, last in zip(edges[::2], edges[1::2]):
+        r_start = max(start, start + int(first) * PAGE_SIZE - margin)
+        r_end = min(end, start + int(last) * PAGE_SIZE)
+        if ranges and r_start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], r_end)
+        else:
+            ranges.append((r_start, r_end))
+    return ranges
+
+
+def read_coalesced(read_ranges, addresses, size, max_gap=PAGE_SIZE, max_read=MAX_COALESCED_READ):
+    """
+    Reads size bytes at each address, with one read per group of close addresses.
+
+    :param read_ranges: function(list of (address, size)) returning the list of bytes read
+    :param max_gap: addresses closer than max_gap bytes are read together
+    :param max_read: a group is not extended past max_read bytes
+    :return: list of bytes, in the addresses order
+    """
+    reads = []
+    for i in sorted(range(len(addresses)), key=addresses.__getitem__):
+        addr = addresses[i]
+        if len(reads) > 0 and addr <= reads[-1][0] + reads[-1][1] + max_gap \
+                and addr + size - reads[-1][0] <= max_read:
+            reads[-1][1] = max(reads[-1][1], addr + size - reads[-1][0])
+            reads[-1][2].append(i)
+        else:
+            reads.append([addr, size, [i]])
+    results = [None] * len(addresses)
+    contents = read_ranges([(start, length) for start, length, indices in reads])
+    for (start, length, indices), content in zip(reads, contents):
+        if content is None or len(content) < length:
+            raise ValueError('could not read 0x%x-0x%x' % (start, start + length))
+        for i in indices:
+            offset = addresses[i] - start
+            results[i] = bytes(content[offset:offset + size])
+    return results
+
+
 
 class AMemoryMapping(interfaces.IMemoryMapping):
 
@@ -90,10 +161,11 @@ class AMemoryMapping(interfaces.IMemoryMapping):
         self._is_heap_addr = None
         self._ctypes = None
         self._utils = None
+        self._page_presence = None
 
     def set_ctypes(self, _ctypes):
         self._ctypes = _ctypes
-        self._utils = utils.Utils(_ctypes)
+        self._utils = utils.get_ctypes_utils(_ctypes)
 
     def __contains__(self, address):
         return self.start <= address < self.end
@@ -164,6 +236,22 @@ class AMemoryMapping(interfaces.IMemoryMapping):
             address += chunk_length
         return ''.join(string), truncated
 
+    def get_page_presence(self):
+        """ pages holding only zeroes are absent, when the backend knows it. The map is computed once. """
+        if getattr(self, '_page_presence', None) is None:
+            self._page_presence = self._make_page_presence()
+        return self._page_presence
+
+    def _make_page_presence(self):
+        """
+        Backends that know their zero pages without reading them override this.
+        Reading the content to find them would cost more than what the callers save.
+        """
+        return numpy.ones((len(self) + PAGE_SIZE - 1) // PAGE_SIZE, dtype=bool)
+
+    def get_present_ranges(self, margin=0):
+        return presence_to_ranges(self.get_page_presence(), self.start, self.end, margin)
+
     def _vtop(self, vaddr):
         ret = vaddr - self.start
         if ret < 0 or ret > len(self):
@@ -177,6 +265,63 @@ class AMemoryMapping(interfaces.IMemoryMapping):
         vaddr = paddr - pstart
         return vaddr
 
+    def _check_addresses(self, addresses, size):
+        """ returns the addresses in a numpy array, if all the reads are in this mapping """
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64).ravel()
+        if len(addresses) > 0 and (int(addresses.min()) < self.start or int(addresses.max()) + size > self.end):
+            raise ValueError('some addresses are not valid address ranges for me: %s' % self)
+        return addresses
+
+    def _gather(self, content, addresses, size):
+        """ returns a (len(addresses), size) uint8 array with the bytes at these addresses, in one fancy indexing """
+        if len(addresses) == 0:
+            return numpy.zeros((0, size), dtype=numpy.uint8)
+        offsets = (addresses - numpy.uint64(self.start)).astype(numpy.intp)
+        # each row of the view is the size bytes at an offset, without an index array of every byte
+        return sliding_window_view(content, size)[offsets]
+
+    def _read_many(self, addresses, size):
+        """ returns a (len(addresses), size) uint8 array with the bytes at these addresses """
+        addresses = self._check_addresses(addresses, size)
+        content = self._get_content_array()
+        if content is not None:
+            return self._gather(content, addresses, size)
+        data = bytearray(b''.join([bytes(d) for d in self.read_bytes_many(addresses.tolist(), size)]))
+        return numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(addresses), size)
+
+    def read_words(self, addresses, word_size=None):
+        ws = word_size or self._ctypes.sizeof(self._ctypes.c_void_p)
+        return self._read_many(addresses, ws).view(numpy.dtype('u%d' % ws)).ravel()
+
+    def read_bytes_many(self, addresses, size):
+        """
+        Mappings with their content in local memory gather the bytes with one numpy fancy indexing,
+        the others read the addresses one by one.
+        """
+        addresses = self._check_addresses(addresses, size)
+        content = self._get_content_array()
+        if content is None:
+            return [bytes(self.read_bytes(addr, size)) for addr in addresses.tolist()]
+        return [row.tobytes() for row in self._gather(content, addresses, size)]
+
+    def read_struct_many(self, addresses, record_type):
+        size = self._ctypes.sizeof(record_type)
+        addresses = self._check_addresses(addresses, size).tolist()
+        records = []
+        for addr, row in zip(addresses, self._read_many(addresses, size)):
+            record = record_type.from_buffer_copy(row)
+            record._orig_address_ = addr
+            records.append(record)
+        return records
+
+    def read_record_array(self, addresses, record_type):
+        dtype = model.get_numpy_dtype(record_type, self._ctypes)
+        return self._read_many(addresses, dtype.itemsize).view(dtype).ravel()
+
+    def _get_content_array(self):
+        """ returns a numpy uint8 array of the mapping content, when it is in local memory, or None """
+        return None
+
     # ---- to implement if needed
     def read_word(self, address):
         raise NotImplementedError(self)
@@ -190,6 +335,10 @@ class AMemoryMapping(interfaces.IMemoryMapping):
     def read_array(self, address, basetype, count):
         raise NotImplementedError(self)
 
+    def reset(self):
+        """ metadata only, nothing to close """
+        pass
+
     def rebase(self, new_start_address):
         log.debug("rebasing 0x%0.8x -> 0x%0.8x", self.start, new_start_address)
         end = new_start_address + len(self)
@@ -197,6 +346,15 @@ class AMemoryMapping(interfaces.IMemoryMapping):
         self.end = end
 
 
+class MetadataMemoryMapping(AMemoryMapping):
+    """
+    A mapping whose content was not dumped. All its pages are absent.
+    """
+
+    def _make_page_presence(self):
+        return numpy.zeros((len(self) + PAGE_SIZE - 1) // PAGE_SIZE, dtype=bool)
+
+
 class MemoryHandler(interfaces.IMemoryHandler, interfaces.IMemoryCache):
     """
     Handler for the concept of process memory.
@@ -277,12 +435,85 @@ class MemoryHandler(interfaces.IMemoryHandler, interfaces.IMemoryCache):
             m.reset()
 
     def __optim_get_mapping_for_address(self):
-        self.__optim_get_mapping_for_address_cache = dict()
+        # build it aside, heap walker threads could be reading the current one
+        _cache = dict()
         for m in self.get_mappings():
             for i in range(m.start, m.end, 0x1000):
-                self.__optim_get_mapping_for_address_cache[i] = m
+                _cache[i] = m
+        self.__optim_get_mapping_for_address_cache = _cache
+        # the sorted mappings ranges, for the batched reads
+        self.__mapping_ranges = (numpy.array([m.start for m in self._mappings], dtype=numpy.uint64),
+                                 numpy.array([m.end for m in self._mappings], dtype=numpy.uint64))
+        # the content of the placeholders for the mappings that were not dumped can not be read
+        self.__mapping_dumped = numpy.array([not isinstance(m, MetadataMemoryMapping) for m in self._mappings],
+                                            dtype=bool)
         return
 
+    def _group_by_mapping(self, addresses):
+        """
+        Returns the addresses in a numpy array, and a list of (mapping, indices of its addresses).
+
+        :raises ValueError: if an address is not in a mapping
+        """
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64).ravel()
+        positions = self._get_mapping_positions(addresses)
+        if (positions < 0).any():
+            raise ValueError('0x%x is not in a dumped mapping' % int(addresses[numpy.argmax(positions < 0)]))
+        groups = []
+        for position in numpy.unique(positions):
+            groups.append((self._mappings[position], numpy.flatnonzero(positions == position)))
+        return addresses, groups
+
+    def _get_mapping_positions(self, addresses, size=0):
+        """
+        returns the index of the mapping of each address,
+        or -1 if the size bytes at address are not in a dumped mapping
+        """
+        starts, ends = self.__mapping_ranges
+        if len(starts) == 0:
+            return numpy.full(len(addresses), -1, dtype=numpy.intp)
+        positions = numpy.searchsorted(starts, addresses, side='right') - 1
+        # an address needs at least one byte in the mapping. numpy has no uint64 + int64 arithmetic
+        clipped = numpy.maximum(positions, 0)
+        invalid = (positions < 0) | (addresses + numpy.uint64(max(size, 1)) > ends[clipped])
+        invalid |= ~self.__mapping_dumped[clipped]
+        positions[invalid] = -1
+        return positions
+
+    def are_valid_address_values(self, addresses, size=0):
+        """
+        :param addresses: a sequence of addresses
+        :param size: the size of the records at these addresses
+        :return: numpy bool array, True for the addresses of a record fully in a dumped mapping
+        """
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64).ravel()
+        return self._get_mapping_positions(addresses, size) >= 0
+
+    def read_words(self, addresses, word_size=None):
+        _ctypes = self._target.get_target_ctypes()
+        ws = word_size or _ctypes.sizeof(_ctypes.c_void_p)
+        addresses, groups = self._group_by_mapping(addresses)
+        words = numpy.zeros(len(addresses), dtype=numpy.dtype('u%d' % ws))
+        for mapping, indices in groups:
+            words[indices] = mapping.read_words(addresses[indices], ws)
+        return words
+
+    def read_bytes_many(self, addresses, size):
+        addresses, groups = self._group_by_mapping(addresses)
+        results = [None] * len(addresses)
+        for mapping, indices in groups:
+            for i, data in zip(indices, mapping.read_bytes_many(addresses[indices], size)):
+                results[i] = data
+        return results
+
+    def read_struct_many(self, addresses, record_type):
+        addresses, groups = self._group_by_mapping(addresses)
+        results = [None] * len(addresses)
+        for mapping, indices in groups:
+            for i, record in zip(indices, mapping.read_struct_many(addresses[indices], record_type)):
+                results[i] = record
+        return results
+
     def get_mapping_for_address(self, vaddr):
         # TODO: optimization. 127s out of 288s = 40%
         assert isinstance(vaddr, long) or isinstance(vaddr, int)
@@ -326,13 +557,14 @@ class MemoryHandler(interfaces.IMemoryHandler, interfaces.IMemoryCache):
         Returns False if the object address is NULL.
         Returns False if the object address is not in a mapping.
         Returns False if the object overflows the mapping.
+        Returns False if the mapping content was not dumped.
 
         Returns the mapping in which the address stands otherwise.
         """
         my_ctypes = self._target.get_target_ctypes()
         m = self.get_mapping_for_address(addr)
         log.debug('is_valid_address_value = %x %s' % (addr, m))
-        if m:
+        if m and not isinstance(m, MetadataMemoryMapping):
             if structType is not None:
                 s = my_ctypes.sizeof(structType)
                 if (addr + s) < m.start or (addr + s) > m.end:
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A block cache for memory mappings with a slow backend.
+
+Volatility, Rekall and frida mappings translate each read through the framework,
+and record validation does many small reads. A CachedMemoryMapping reads aligned blocks
+of 64 KB from the wrapped mapping, keeps them in a LRU cache shared by all the mappings
+of a memory handler, and serves the small reads from the cache.
+
+Usage:
+    mappings = cached.make_cached_mappings(mappings)
+    ...
+    log.info('block cache hit rate: %0.2f', mappings[0].cache.hit_rate())
+"""
+
+from __future__ import print_function
+
+import logging
+import struct
+
+from haystack.mappings import container
+from haystack.mappings.base import AMemoryMapping
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__status__ = "Production"
+
+log = logging.getLogger('cached')
+
+
+class CachedMemoryMapping(AMemoryMapping):
+    """
+    Wraps a memory mapping. Reads of up to block_size bytes are served from a block cache.
+    """
+    def __init__(self, mapping, cache=None, block_size=container.DEFAULT_BLOCK_SIZE):
+        AMemoryMapping.__init__(self, mapping.start, mapping.end, mapping.permissions, mapping.offset,
+                                mapping.major_device, mapping.minor_device, mapping.inode, mapping.pathname)
+        self._mapping = mapping
+        self.block_size = block_size
+        if cache is None:
+            cache = container.BlockCache()
+        self.cache = cache
+
+    def set_ctypes(self, _ctypes):
+        super(CachedMemoryMapping, self).set_ctypes(_ctypes)
+        self._mapping.set_ctypes(_ctypes)
+
+    def _load_block(self, key):
+        start, index = key
+        block_start = max(self.start, index * self.block_size)
+        block_end = min(self.end, (index + 1) * self.block_size)
+        return self._mapping.read_bytes(block_start, block_end - block_start)
+
+    def _read(self, addr, size):
+        if addr < self.start or addr + size > self.end:
+            raise ValueError('0x%0.8x/0x%x is not a valid address range for me: %s' % (addr, size, self))
+        if size > self.block_size:
+            return self._mapping.read_bytes(addr, size)
+        data = []
+        while size > 0:
+            index = addr // self.block_size
+            block = self.cache.get((self.start, index), self._load_block)
+            offset = addr - max(self.start, index * self.block_size)
+            chunk = block[offset:offset + size]
+            if len(chunk) == 0:
+                raise ValueError('short read at 0x%0.8x in %s' % (addr, self))
+            data.append(chunk)
+            addr += len(chunk)
+            size -= len(chunk)
+        if len(data) == 1:
+            return data[0]
+        return b''.join(data)
+
+    def read_word(self, addr):
+        ws = self._ctypes.sizeof(self._ctypes.c_void_p)
+        data = self._read(addr, ws)
+        if ws == 4:
+            return struct.unpack('I', data)[0]
+        elif ws == 8:
+            return struct.unpack('Q', data)[0]
+
+    def read_bytes(self, addr, size):
+        return bytes(self._read(addr, size))
+
+    def read_struct(self, addr, struct_type):
+        size = self._ctypes.sizeof(struct_type)
+        instance = struct_type.from_buffer_copy(self._read(addr, size))
+        instance._orig_address_ = addr
+        return instance
+
+    def read_array(self, addr, basetype, count):
+        size = self._ctypes.sizeof(basetype * count)
+        array = (basetype * count).from_buffer_copy(self._read(addr, size))
+        return array
+
+    def reset(self):
+        self.cache.clear()
+        self._mapping.reset()
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        d['cache'] = None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__ = d
+        self.cache = container.BlockCache()
+
+
+def make_cached_mappings(mappings, block_size=container.DEFAULT_BLOCK_SIZE, cache_size=container.DEFAULT_CACHE_SIZE):
+    """
+    Wraps each mapping in a CachedMemoryMapping. The mappings share one block cache.
+
+    :param cache_size: the number of blocks in the cache
+    :return: list of CachedMemoryMapping
+    """
+    cache = container.BlockCache(cache_size)
+    return [CachedMemoryMapping(m, cache, block_size) for m in mappings]
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Single-file haystack dump format, version 2.
+
+A haystack folder dump is one file per mapping plus a 'mappings' text index.
+The v2 container stores the same information in one file:
+
+    - a fixed size header,
+    - the mapping content, in fixed-size blocks. Each block is stored raw,
+      or zlib or lzma compressed, whichever is smaller,
+    - a binary mapping table, with the metadata of each mapping and
+      its first block index and block count,
+    - a block offset table, with the file offset, stored length and codec
+      of each block.
+
+The tables are written at the end, so the container can be written in one pass.
+
+The loader mmaps the container. Raw blocks are read zero-copy from the mmap.
+Compressed blocks are decompressed on demand, through a LRU block cache.
+
+Usage:
+    haystack-convert-dump test/src/test-ctypes6.64.dump test-ctypes6.64.hsd
+    haystack-search hsd:///path/to/test-ctypes6.64.hsd ...
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+import numpy
+
+from haystack import target
+from haystack.abc import interfaces
+from haystack.mappings import base
+from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MemoryHandler
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__status__ = "Production"
+
+log = logging.getLogger('container')
+
+MAGIC = b'HSTKDMP2'
+VERSION = 2
+# magic, version, block_size, mapping_count, block_count, mapping_table_offset, block_table_offset
+HEADER_FORMAT = '<8sIIIQQQ'
+HEADER_SIZE = 64
+# start, end, offset, inode, major_device, minor_device, first_block, block_count, flags, permissions, len(pathname)
+MAPPING_FORMAT = '<QQQQIIQQI8sH'
+MAPPING_SIZE = struct.calcsize(MAPPING_FORMAT)
+# the mapping content is in the container. Otherwise, metadata only.
+MAPPING_FLAG_CONTENT = 0x1
+BLOCK_DTYPE = numpy.dtype([('offset', '<u8'), ('length', '<u4'), ('codec', '<u4')])
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {'raw': CODEC_RAW, 'zlib': CODEC_ZLIB, 'lzma': CODEC_LZMA}
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+# a compressed block of zeroes is smaller than that
+ZERO_BLOCK_MAX_LENGTH = 1024
+# 16 MB of decompressed blocks, by default
+DEFAULT_CACHE_SIZE = 256
+
+
+def _compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data)
+    elif codec == CODEC_LZMA:
+        import lzma
+        return lzma.compress(data)
+    raise ValueError('Unknown codec %d' % codec)
+
+
+def _decompress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == CODEC_LZMA:
+        import lzma
+        return lzma.decompress(data)
+    raise ValueError('Unknown codec %d' % codec)
+
+
+def is_container(filename):
+    """Returns True if filename is a v2 container"""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+class BlockCache(object):
+    """
+    A thread-safe LRU cache of blocks, keyed by block index.
+    """
+    def __init__(self, capacity=DEFAULT_CACHE_SIZE):
+        self._capacity = capacity
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """Returns the block for key. Calls load(key) on a cache miss."""
+        with self._lock:
+            if key in self._blocks:
+                self.hits += 1
+                data = self._blocks.pop(key)
+                self._blocks[key] = data
+                return data
+            self.misses += 1
+        data = load(key)
+        with self._lock:
+            self._blocks[key] = data
+            while len(self._blocks) > self._capacity:
+                self._blocks.popitem(last=False)
+        return data
+
+    def put(self, key, data):
+        """Adds a block loaded by other means."""
+        with self._lock:
+            self._blocks[key] = data
+            while len(self._blocks) > self._capacity:
+                self._blocks.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+class ContainerWriter(object):
+    """
+    Writes a v2 container.
+
+    Usage:
+        with ContainerWriter('dump.hsd', codec='zlib') as writer:
+            writer.add_mapping(mapping, content)
+    """
+    def __init__(self, filename, block_size=DEFAULT_BLOCK_SIZE, codec='zlib'):
+        if codec not in CODECS:
+            raise ValueError('codec should be one of %s' % ', '.join(sorted(CODECS.keys())))
+        self._filename = filename
+        self._block_size = block_size
+        self._codec = CODECS[codec]
+        self._mappings = []
+        self._blocks = []
+        self._fout = open(filename, 'wb')
+        # placeholder
+        self._fout.write(b'\x00' * HEADER_SIZE)
+        self._offset = HEADER_SIZE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_block(self, data):
+        """Write one block, compressed if it makes it smaller. Returns the block index."""
+        codec = CODEC_RAW
+        if self._codec != CODEC_RAW:
+            compressed = _compress(self._codec, data)
+            if len(compressed) < len(data):
+                data = compressed
+                codec = self._codec
+        self._fout.write(data)
+        self._blocks.append((self._offset, len(data), codec))
+        self._offset += len(data)
+        return len(self._blocks) - 1
+
+    def add_mapping(self, mapping, content=None):
+        """
+        Add a mapping to the container.
+
+        :param mapping: IMemoryMapping, for the metadata
+        :param content: the bytes of the mapping, or None to save the metadata only
+        """
+        first_block = len(self._blocks)
+        flags = 0
+        if content is not None:
+            if len(content) != mapping.end - mapping.start:
+                raise ValueError('%s: the content is 0x%x bytes, the mapping is 0x%x bytes' % (
+                    mapping, len(content), mapping.end - mapping.start))
+            flags |= MAPPING_FLAG_CONTENT
+            view = memoryview(content)
+            for offset in range(0, len(view), self._block_size):
+                self._write_block(view[offset:offset + self._block_size].tobytes())
+        block_count = len(self._blocks) - first_block
+        self._mappings.append((mapping.start, mapping.end, mapping.offset, mapping.inode,
+                               mapping.major_device, mapping.minor_device, first_block, block_count,
+                               flags, mapping.permissions, str(mapping.pathname)))
+        return
+
+    def close(self):
+        if self._fout is None:
+            return
+        mapping_table_offset = self._offset
+        for m in self._mappings:
+            pathname = m[10].encode('utf-8')
+            self._fout.write(struct.pack(MAPPING_FORMAT, m[0], m[1], m[2], m[3], m[4], m[5], m[6], m[7], m[8],
+                                         m[9].encode('ascii'), len(pathname)))
+            self._fout.write(pathname)
+            self._offset += MAPPING_SIZE + len(pathname)
+        block_table_offset = self._offset
+        self._fout.write(numpy.array(self._blocks, dtype=BLOCK_DTYPE).tobytes())
+        self._fout.seek(0)
+        self._fout.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, self._block_size, len(self._mappings),
+                                     len(self._blocks), mapping_table_offset, block_table_offset))
+        self._fout.close()
+        self._fout = None
+        log.debug('Wrote %d mappings in %d blocks to %s', len(self._mappings), len(self._blocks), self._filename)
+        return
+
+
+class ContainerFile(object):
+    """
+    A read-only v2 container, mmap-ed.
+    """
+    def __init__(self, filename, cache_size=DEFAULT_CACHE_SIZE):
+        self._filename = filename
+        self._fin = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        (magic, version, self.block_size, mapping_count, block_count,
+         mapping_table_offset, block_table_offset) = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a haystack v2 dump' % filename)
+        if version != VERSION:
+            raise ValueError('%s: unsupported haystack dump version %d' % (filename, version))
+        self.blocks = numpy.frombuffer(self._mmap, dtype=BLOCK_DTYPE, count=block_count, offset=block_table_offset)
+        self.mappings = []
+        offset = mapping_table_offset
+        for i in range(mapping_count):
+            fields = struct.unpack_from(MAPPING_FORMAT, self._mmap, offset)
+            offset += MAPPING_SIZE
+            pathname = self._view[offset:offset + fields[10]].tobytes().decode('utf-8')
+            offset += fields[10]
+            permissions = fields[9].rstrip(b'\x00').decode('ascii')
+            self.mappings.append(fields[:9] + (permissions, pathname))
+        self.cache = BlockCache(cache_size)
+
+    def get_filename(self):
+        return self._filename
+
+    def is_raw(self, first_block, block_count):
+        """Returns True if these blocks are all raw and contiguous in the container"""
+        if block_count == 0:
+            return False
+        blocks = self.blocks[first_block:first_block + block_count]
+        if numpy.any(blocks['codec'] != CODEC_RAW):
+            return False
+        return int(blocks['offset'][-1]) - int(blocks['offset'][0]) == int(blocks['length'][:-1].sum())
+
+    def get_raw_view(self, first_block, block_count):
+        """Returns a zero-copy memoryview on raw and contiguous blocks"""
+        start = int(self.blocks['offset'][first_block])
+        last = self.blocks[first_block + block_count - 1]
+        return self._view[start:int(last['offset']) + int(last['length'])]
+
+    def _load_block(self, index):
+        offset, length, codec = self.blocks[index]
+        data = self._view[int(offset):int(offset) + int(length)]
+        return _decompress(int(codec), data)
+
+    def get_zero_blocks(self, first_block, block_count):
+        """
+        Returns a numpy bool array, True for the blocks holding only zeroes.
+        A block of zeroes is always stored compressed, and small. Only these small blocks are decompressed.
+        """
+        blocks = self.blocks[first_block:first_block + block_count]
+        zero = (blocks['codec'] != CODEC_RAW) & (blocks['length'] <= ZERO_BLOCK_MAX_LENGTH)
+        for i in numpy.flatnonzero(zero).tolist():
+            zero[i] = not numpy.frombuffer(self._load_block(first_block + i), dtype=numpy.uint8).any()
+        return zero
+
+    def get_block(self, index):
+        """Returns the content of a block. Raw blocks are not copied."""
+        block = self.blocks[index]
+        if block['codec'] == CODEC_RAW:
+            offset = int(block['offset'])
+            return self._view[offset:offset + int(block['length'])]
+        return self.cache.get(index, self._load_block)
+
+    def close(self):
+        self.blocks = None
+        self.cache.clear()
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # mappings still hold a view on raw blocks. The mmap is closed when they are released.
+            log.debug('Container %s is still in use', self._filename)
+        self._fin.close()
+
+
+class ContainerMemoryMapping(AMemoryMapping):
+    """
+    A memory mapping with content in a v2 container.
+    """
+    def __init__(self, container, first_block, block_count, start, end, permissions='r--',
+                 offset=0, major_device=0, minor_device=0, inode=0, pathname=''):
+        AMemoryMapping.__init__(self, start, end, permissions, offset,
+                                major_device, minor_device, inode, pathname)
+        self._container = container
+        self._first_block = first_block
+        self._block_count = block_count
+        self._block_size = container.block_size
+        self._raw = None
+        if container.is_raw(first_block, block_count):
+            self._raw = container.get_raw_view(first_block, block_count)
+            if len(self._raw) < len(self):
+                raise ValueError('%s: the container holds 0x%x bytes' % (self, len(self._raw)))
+
+    def _read(self, addr, size):
+        offset = addr - self.start
+        if offset < 0 or offset + size > len(self):
+            raise ValueError('0x%0.8x/0x%x is not a valid address range for me: %s' % (addr, size, self))
+        if self._raw is not None:
+            return self._raw[offset:offset + size]
+        # gather from blocks
+        data = []
+        while size > 0:
+            index, block_offset = divmod(offset, self._block_size)
+            if index >= self._block_count:
+                raise ValueError('0x%0.8x is past the last block of %s' % (self.start + offset, self))
+            block = self._container.get_block(self._first_block + index)
+            chunk = block[block_offset:block_offset + size]
+            if len(chunk) == 0:
+                raise ValueError('short block at 0x%0.8x in %s' % (self.start + offset, self))
+            data.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        if len(data) == 1:
+            return data[0]
+        return b''.join(data)
+
+    def _get_content_array(self):
+        if self._raw is None:
+            # compressed blocks
+            return None
+        return numpy.frombuffer(self._raw, dtype=numpy.uint8, count=len(self))
+
+    def _make_page_presence(self):
+        """ the blocks of zeroes are absent, without reading the other blocks """
+        presence = numpy.zeros((len(self) + base.PAGE_SIZE - 1) // base.PAGE_SIZE, dtype=bool)
+        zero = self._container.get_zero_blocks(self._first_block, self._block_count)
+        for i in numpy.flatnonzero(~zero).tolist():
+            first = i * self._block_size
+            last = min(first + self._block_size, len(self))
+            presence[first // base.PAGE_SIZE:(last + base.PAGE_SIZE - 1) // base.PAGE_SIZE] = True
+        return presence
+
+    def read_word(self, addr):
+        ws = self._ctypes.sizeof(self._ctypes.c_void_p)
+        data = self._read(addr, ws)
+        if ws == 4:
+            return struct.unpack('I', data)[0]
+        elif ws == 8:
+            return struct.unpack('Q', data)[0]
+
+    def read_bytes(self, addr, size):
+        return bytes(self._read(addr, size))
+
+    def read_struct(self, addr, struct_type):
+        size = self._ctypes.sizeof(struct_type)
+        instance = struct_type.from_buffer_copy(self._read(addr, size))
+        instance._orig_address_ = addr
+        return instance
+
+    def read_array(self, addr, basetype, count):
+        size = self._ctypes.sizeof(basetype * count)
+        array = (basetype * count).from_buffer_copy(self._read(addr, size))
+        return array
+
+    def mmap(self):
+        return self
+
+    def get_byte_buffer(self):
+        return self.read_bytes(self.start, len(self))
+
+    def reset(self):
+        pass
+
+
+class ContainerDumpLoader(folder.MemoryDumpLoader):
+    """ Loads a v2 container dump."""
+
+    def __init__(self, dumpname, bits=None, os_name=None, cache_size=DEFAULT_CACHE_SIZE):
+        self._cache_size = cache_size
+        super(ContainerDumpLoader, self).__init__(dumpname, bits=bits, os_name=os_name)
+
+    def _is_valid(self):
+        return is_container(self.dumpname)
+
+    def _load_mappings(self):
+        self._container = ContainerFile(self.dumpname, self._cache_size)
+        _mappings = []
+        for (start, end, offset, inode, major_device, minor_device,
+             first_block, block_count, flags, permissions, pathname) in self._container.mappings:
+            if flags & MAPPING_FLAG_CONTENT:
+                mmap = ContainerMemoryMapping(self._container, first_block, block_count, start, end, permissions,
+                                              offset, major_device, minor_device, inode, pathname=pathname)
+            else:
+                mmap = base.MetadataMemoryMapping(start, end, permissions, offset, major_device, minor_device,
+                                                  inode, pathname=pathname)
+            _mappings.append(mmap)
+        _target_platform = target.TargetPlatform(_mappings, cpu_bits=self._cpu_bits, os_name=self._os_name,
+                                                 cache_name=self.dumpname)
+        self._memory_handler = MemoryHandler(_mappings, _target_platform, self.dumpname)
+        return
+
+
+class ContainerLoader(interfaces.IMemoryLoader):
+    desc = 'Load a haystack v2 single-file memory dump'
+
+    def __init__(self, opts):
+        self.loader = ContainerDumpLoader(opts.target.path, bits=opts.bits, os_name=opts.osname)
+
+    def make_memory_handler(self):
+        return self.loader.make_memory_handler()
+
+
+def convert_folder(dumpname, filename, block_size=DEFAULT_BLOCK_SIZE, codec='zlib'):
+    """
+    Convert a haystack folder dump to a v2 container.
+
+    :param dumpname: the folder dump
+    :param filename: the v2 container file name
+    :return: filename
+    """
+    loader = folder.ProcessMemoryDumpLoader(dumpname)
+    loader._load_metadata()
+    # the mappings of a delta dump are overlaid on its base, copy their content rather than the files
+    with ContainerWriter(filename, block_size=block_size, codec=codec) as writer:
+        for m in loader._make_mappings():
+            if isinstance(m, base.MetadataMemoryMapping):
+                writer.add_mapping(m)
+                continue
+            writer.add_mapping(m, m.read_bytes(m.start, len(m)))
+            m.reset()
+    log.info('Converted %s to %s', dumpname, filename)
+    return filename
+
+
+def argparser():
+    convert_parser = argparse.ArgumentParser(prog='haystack-convert-dump',
+                                             description="Convert a haystack folder dump to a single-file v2 dump.")
+    convert_parser.add_argument('dumpname', action='store', help='The folder dump name.')
+    convert_parser.add_argument('filename', action='store', help='The v2 dump file name.')
+    convert_parser.add_argument('--codec', action='store', default='zlib', choices=sorted(CODECS.keys()),
+                                help='Block compression')
+    convert_parser.add_argument('--block-size', dest='block_size', type=int, action='store',
+                                default=DEFAULT_BLOCK_SIZE, help='Block size in bytes')
+    return convert_parser
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparser()
+    opts = parser.parse_args(sys.argv[1:])
+    convert_folder(opts.dumpname, opts.filename, opts.block_size, opts.codec)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loads ELF core files, as produced by gcore or by the kernel on a crash.
+
+The core file is mmap-ed once. Each PT_LOAD segment is a memory mapping that reads
+its content from the core file mmap at the segment offset. The bytes of a segment
+past p_filesz are not stored in the core file and read as zeroes.
+The mappings pathnames are read from the NT_FILE note, and the cpu bits from e_ident.
+
+Usage:
+    gcore -o core 1234
+    haystack-search core:///path/to/core.1234 ...
+"""
+
+from __future__ import print_function
+
+import logging
+import mmap
+import struct
+
+import os
+
+import numpy
+
+from haystack import target
+from haystack.abc import interfaces
+from haystack.mappings import base
+from haystack.mappings.base import AMemoryMapping
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__status__ = "Production"
+
+log = logging.getLogger('core')
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+ET_CORE = 4
+PT_LOAD = 1
+PT_NOTE = 4
+NT_FILE = 0x46494c45
+PF_X = 1
+PF_W = 2
+PF_R = 4
+
+# e_type, e_phoff, e_phentsize, e_phnum
+_EHDR = {ELFCLASS32: ('H10xI8x2xHH', 16),
+         ELFCLASS64: ('H14xQ14xHH', 16)}
+# p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_flags
+_PHDR32 = 'III4xIII4x'
+# p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz
+_PHDR64 = 'IIQQ8xQQ8x'
+
+
+def is_core(filename):
+    with open(filename, 'rb') as fin:
+        e_ident = fin.read(18)
+    if len(e_ident) < 18 or not e_ident.startswith(ELF_MAGIC):
+        return False
+    endianness = '<' if bytearray(e_ident)[5] == ELFDATA2LSB else '>'
+    return struct.unpack(endianness + 'H', e_ident[16:18])[0] == ET_CORE
+
+
+def _align4(size):
+    return (size + 3) & ~3
+
+
+class CoreMemoryMapping(AMemoryMapping):
+    """
+    A memory mapping of a PT_LOAD segment of a core file.
+    """
+    def __init__(self, source, data_offset, filesz, start, end, permissions='r--',
+                 offset=0, major_device=0, minor_device=0, inode=0, pathname=''):
+        AMemoryMapping.__init__(self, start, end, permissions, offset,
+                                major_device, minor_device, inode, pathname)
+        # a memoryview of the core file mmap
+        self._source = source
+        self._data_offset = data_offset
+        self._filesz = min(filesz, end - start)
+
+    def _read(self, addr, size):
+        offset = addr - self.start
+        if offset < 0 or offset + size > len(self):
+            raise ValueError('0x%0.8x/0x%x is not a valid address range for me: %s' % (addr, size, self))
+        if offset + size <= self._filesz:
+            return self._source[self._data_offset + offset:self._data_offset + offset + size]
+        # zero fill past the stored bytes
+        data = bytes(self._source[self._data_offset + offset:self._data_offset + min(offset + size, self._filesz)])
+        return data + b'\x00' * (size - len(data))
+
+    def read_word(self, addr):
+        ws = self._ctypes.sizeof(self._ctypes.c_void_p)
+        data = self._read(addr, ws)
+        if ws == 4:
+            return struct.unpack('I', data)[0]
+        elif ws == 8:
+            return struct.unpack('Q', data)[0]
+
+    def read_bytes(self, addr, size):
+        return bytes(self._read(addr, size))
+
+    def read_struct(self, addr, struct_type):
+        size = self._ctypes.sizeof(struct_type)
+        instance = struct_type.from_buffer_copy(self._read(addr, size))
+        instance._orig_address_ = addr
+        return instance
+
+    def read_array(self, addr, basetype, count):
+        size = self._ctypes.sizeof(basetype * count)
+        array = (basetype * count).from_buffer_copy(self._read(addr, size))
+        return array
+
+    def _get_content_array(self):
+        if self._filesz < len(self):
+            # the zero filled end is not in the core file
+            return None
+        return numpy.frombuffer(self._source, dtype=numpy.uint8, count=len(self), offset=self._data_offset)
+
+    def _make_page_presence(self):
+        """ the zero filled pages are absent, without reading them """
+        presence = numpy.zeros((len(self) + base.PAGE_SIZE - 1) // base.PAGE_SIZE, dtype=bool)
+        if self._filesz > 0:
+            stored = base.make_page_presence(self._source[self._data_offset:self._data_offset + self._filesz])
+            presence[:len(stored)] = stored
+        return presence
+
+    def mmap(self):
+        return self
+
+    def get_byte_buffer(self):
+        return self.read_bytes(self.start, len(self))
+
+    def reset(self):
+        pass
+
+
+class CoreDumpLoader(interfaces.IMemoryLoader):
+    """
+    Loads the PT_LOAD segments of an ELF core file.
+    """
+
+    def __init__(self, filename, bits=None, os_name=None):
+        self.filename = os.path.abspath(filename)
+        self._cpu_bits = bits
+        self._os_name = os_name
+        self._memory_handler = None
+        self._fin = open(self.filename, 'rb')
+        self._mmap = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self._source = memoryview(self._mmap)
+        self._read_header()
+
+    def _read_header(self):
+        e_ident = bytearray(self._mmap[:16])
+        if bytes(e_ident[:4]) != ELF_MAGIC:
+            raise ValueError('%s is not an ELF file' % self.filename)
+        self._class = e_ident[4]
+        if self._class not in _EHDR:
+            raise ValueError('%s: unknown ELF class %d' % (self.filename, self._class))
+        if e_ident[5] == ELFDATA2LSB:
+            self._endianness = '<'
+        elif e_ident[5] == ELFDATA2MSB:
+            self._endianness = '>'
+        else:
+            raise ValueError('%s: unknown ELF data encoding %d' % (self.filename, e_ident[5]))
+        fmt, offset = _EHDR[self._class]
+        e_type, self._phoff, self._phentsize, self._phnum = struct.unpack_from(self._endianness + fmt,
+                                                                                 self._mmap, offset)
+        if e_type != ET_CORE:
+            raise ValueError('%s is not an ELF core file' % self.filename)
+        if self._cpu_bits is None:
+            self._cpu_bits = 32 if self._class == ELFCLASS32 else 64
+        return
+
+    def _iter_program_headers(self):
+        for i in range(self._phnum):
+            offset = self._phoff + i * self._phentsize
+            if self._class == ELFCLASS32:
+                p_type, p_offset, p_vaddr, p_filesz, p_memsz, p_flags = struct.unpack_from(
+                    self._endianness + _PHDR32, self._mmap, offset)
+            else:
+                p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz = struct.unpack_from(
+                    self._endianness + _PHDR64, self._mmap, offset)
+            yield p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz
+
+    def _iter_notes(self, offset, size):
+        end = offset + size
+        while offset + 12 <= end:
+            namesz, descsz, n_type = struct.unpack_from(self._endianness + 'III', self._mmap, offset)
+            offset += 12
+            name = self._mmap[offset:offset + namesz].rstrip(b'\x00')
+            offset += _align4(namesz)
+            yield name, n_type, offset, descsz
+            offset += _align4(descsz)
+
+    def _read_file_note(self, offset, size):
+        """
+        NT_FILE: count, page_size, count * (start, end, file_ofs), count * NUL terminated filenames
+
+        :return: list of (start, end, file offset, pathname)
+        """
+        word = 'I' if self._class == ELFCLASS32 else 'Q'
+        ws = struct.calcsize(word)
+        count, page_size = struct.unpack_from(self._endianness + word * 2, self._mmap, offset)
+        ranges = struct.unpack_from(self._endianness + word * 3 * count, self._mmap, offset + 2 * ws)
+        names = self._mmap[offset + (2 + 3 * count) * ws:offset + size].split(b'\x00')
+        files = []
+        for i in range(count):
+            start, end, file_ofs = ranges[i * 3:i * 3 + 3]
+            files.append((start, end, file_ofs * page_size, names[i].decode('utf-8', 'replace')))
+        return files
+
+    def _make_mappings(self):
+        segments = []
+        files = []
+        for p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz in self._iter_program_headers():
+            if p_type == PT_LOAD:
+                segments.append((p_flags, p_offset, p_vaddr, p_filesz, p_memsz))
+            elif p_type == PT_NOTE:
+                for name, n_type, desc_offset, descsz in self._iter_notes(p_offset, p_filesz):
+                    if name == b'CORE' and n_type == NT_FILE:
+                        files.extend(self._read_file_note(desc_offset, descsz))
+        if len(segments) == 0:
+            raise ValueError('%s has no PT_LOAD segment' % self.filename)
+        _mappings = []
+        for p_flags, p_offset, p_vaddr, p_filesz, p_memsz in segments:
+            if p_offset + p_filesz > len(self._mmap):
+                log.warning('truncated core file: segment 0x%x is zero filled past the end of file', p_vaddr)
+                p_filesz = max(0, len(self._mmap) - p_offset)
+            permissions = ''.join([('r' if p_flags & PF_R else '-'),
+                                   ('w' if p_flags & PF_W else '-'),
+                                   ('x' if p_flags & PF_X else '-'), 'p'])
+            offset = 0
+            pathname = ''
+            for start, end, file_ofs, name in files:
+                if start <= p_vaddr < end:
+                    offset = file_ofs + p_vaddr - start
+                    pathname = name
+                    break
+            mmap = CoreMemoryMapping(self._source, p_offset, p_filesz, p_vaddr, p_vaddr + p_memsz, permissions,
+                                     offset, 0, 0, 0, pathname)
+            log.debug('PT_LOAD %s filesz:0x%x', mmap, p_filesz)
+            _mappings.append(mmap)
+        return _mappings
+
+    def make_memory_handler(self):
+        if self._memory_handler is None:
+            _mappings = self._make_mappings()
+            _target_platform = target.TargetPlatform(_mappings, cpu_bits=self._cpu_bits, os_name=self._os_name,
+                                                     cache_name=self.filename)
+            # Use a folder name for its cache later on
+            self._memory_handler = base.MemoryHandler(_mappings, _target_platform, self.filename + '.d')
+        return self._memory_handler
+
+
+class CoreLoader(interfaces.IMemoryLoader):
+    desc = 'Load an ELF core file'
+
+    def __init__(self, opts):
+        self.loader = CoreDumpLoader(opts.target.path, bits=opts.bits, os_name=opts.osname)
+
+    def make_memory_handler(self):
+        return self.loader.make_memory_handler()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental haystack folder dumps.
+
+A delta dump is made against a base dump. Only the pages whose hash changed
+since the base are written; the other pages are holes in the mapping files.
+The delta dump folder holds:
+
+    - 'base': the path of the base dump, relative to the delta dump,
+    - 'delta.npz': for each mapping file, the page map of the pages stored in this dump.
+      The other pages are read from the base dump,
+    - 'pagehashes.npz': a hash of each page of each mapping, for the next delta dump.
+
+A full dump has no page hashes, they are computed when it is used as a base.
+
+The loaders overlay a delta dump on its base, so a delta dump is used like a full dump.
+The base of an archived delta dump is relative to the folder the archive was made from.
+A base can be a delta dump itself.
+
+Usage:
+    haystack-live-dump 1234 dump.0
+    haystack-live-dump --base dump.0 1234 dump.1
+"""
+
+import ctypes
+import hashlib
+import logging
+import mmap
+import struct
+
+import os
+
+import numpy
+
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import PAGE_SIZE
+from haystack.mappings.file import ContentPin
+from haystack.mappings.file import FilenameBackedMemoryMapping
+from haystack.mappings.file import LocalMemoryMapping
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__status__ = "Production"
+
+log = logging.getLogger('delta')
+
+HASHES_FILENAME = 'pagehashes.npz'
+DELTA_FILENAME = 'delta.npz'
+BASE_FILENAME = 'base'
+
+
+def _page_hash(page):
+    return struct.unpack('<Q', hashlib.blake2b(page, digest_size=8).digest())[0]
+
+
+def hash_pages(data):
+    """ returns the 64 bits hash of each page of data, as a numpy uint64 array """
+    view = memoryview(data)
+    return numpy.array([_page_hash(view[i:i + PAGE_SIZE]) for i in range(0, len(data), PAGE_SIZE)],
+                       dtype=numpy.uint64)
+
+
+def is_delta(dumpname):
+    return os.access(os.path.join(dumpname, BASE_FILENAME), os.F_OK)
+
+
+def get_base_dumpname(dumpname):
+    with open(os.path.join(dumpname, BASE_FILENAME)) as fin:
+        return resolve_base_dumpname(dumpname, fin.read())
+
+
+def resolve_base_dumpname(dumpname, base):
+    """ returns the path of the base dump, from the content of the base file of the delta dump dumpname """
+    # older delta dumps store an absolute path
+    return os.path.normpath(os.path.join(os.path.abspath(dumpname), base.strip()))
+
+
+def _load_npz(filename):
+    with numpy.load(filename) as data:
+        return dict((k, data[k]) for k in data.files)
+
+
+def load_changed_pages(source):
+    """
+    returns the page map of the pages stored in a delta dump, for each mapping file.
+
+    :param source: the delta dump folder, or a file object of its delta file
+    """
+    if not hasattr(source, 'read'):
+        source = os.path.join(source, DELTA_FILENAME)
+    return _load_npz(source)
+
+
+def _save_npz(filename, arrays):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fout:
+        numpy.savez_compressed(fout, **arrays)
+    os.rename(tmp, filename)
+
+
+def load_page_hashes(dumpname):
+    """
+    returns the page hashes of each mapping file of a folder dump.
+    Dumps made without page hashes are hashed from the mapping files.
+
+    :return: dict of mapping file name: numpy uint64 array
+    """
+    filename = os.path.join(dumpname, HASHES_FILENAME)
+    if os.access(filename, os.F_OK):
+        return _load_npz(filename)
+    from haystack.mappings import folder
+    log.info('No page hashes in %s, hashing the base dump', dumpname)
+    loader = folder.ProcessMemoryDumpLoader(dumpname)
+    loader._load_metadata()
+    hashes = dict()
+    for metaline in loader.metalines:
+        mmap_fname = metaline[0]
+        try:
+            with open(os.path.join(dumpname, mmap_fname), 'rb') as fin:
+                hashes[mmap_fname] = hash_pages(fin.read())
+        except IOError:
+            # metadata only
+            continue
+    return hashes
+
+
+class DeltaWriter(object):
+    """
+    Tracks the page hashes of the mappings being dumped, and the pages that changed since the base dump.
+    Without a base dump, all pages are changed, and nothing is hashed.
+    """
+
+    def __init__(self, base=None):
+        self._base = os.path.abspath(base) if base is not None else None
+        self._base_hashes = load_page_hashes(self._base) if base is not None else dict()
+        self.hashes = dict()
+        self.changed = dict()
+
+    def add_mapping(self, mmap_fname, size):
+        npages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+        self.changed[mmap_fname] = numpy.ones(npages, dtype=bool)
+        if self._base is not None:
+            self.hashes[mmap_fname] = numpy.zeros(npages, dtype=numpy.uint64)
+
+    def discard_mapping(self, mmap_fname):
+        """ the mapping was not dumped """
+        self.hashes.pop(mmap_fname, None)
+        self.changed.pop(mmap_fname, None)
+
+    def update(self, mmap_fname, offset, data):
+        """
+        Record the page hashes of a chunk of a mapping.
+
+        :return: list of bool, True for the pages of data that changed since the base dump
+        """
+        if self._base is None:
+            return [True] * ((len(data) + PAGE_SIZE - 1) // PAGE_SIZE)
+        first = offset // PAGE_SIZE
+        hashes = hash_pages(data)
+        self.hashes[mmap_fname][first:first + len(hashes)] = hashes
+        base_hashes = self._base_hashes.get(mmap_fname)
+        if base_hashes is None or len(base_hashes) != len(self.hashes[mmap_fname]):
+            # new mapping
+            return [True] * len(hashes)
+        changed = base_hashes[first:first + len(hashes)] != hashes
+        self.changed[mmap_fname][first:first + len(hashes)] = changed
+        return changed.tolist()
+
+    def changed_pages(self):
+        return int(sum(c.sum() for c in self.changed.values()))
+
+    def save(self, destdir):
+        if self._base is None:
+            return
+        _save_npz(os.path.join(destdir, HASHES_FILENAME), self.hashes)
+        _save_npz(os.path.join(destdir, DELTA_FILENAME), self.changed)
+        try:
+            base = os.path.relpath(self._base, os.path.abspath(destdir))
+        except ValueError:
+            # another drive
+            base = self._base
+        with open(os.path.join(destdir, BASE_FILENAME), 'w') as fout:
+            fout.write('%s\n' % base)
+        return
+
+
+class OverlayMemoryMapping(AMemoryMapping):
+    """
+    A mapping of a delta dump, overlaid on the same mapping of the base dump.
+    The content is assembled on first access, then read from a LocalMemoryMapping.
+    The base mapping file is mmap-ed copy-on-write, so only the changed pages are copied.
+    """
+
+    def __init__(self, delta_mapping, base_mapping, changed):
+        AMemoryMapping.__init__(self, delta_mapping.start, delta_mapping.end, delta_mapping.permissions,
+                                delta_mapping.offset, delta_mapping.major_device, delta_mapping.minor_device,
+                                delta_mapping.inode, delta_mapping.pathname)
+        self._delta_mapping = delta_mapping
+        self._base_mapping = base_mapping
+        self._changed = changed
+        self._base = None
+
+    def set_ctypes(self, _ctypes):
+        super(OverlayMemoryMapping, self).set_ctypes(_ctypes)
+        self._delta_mapping.set_ctypes(_ctypes)
+        self._base_mapping.set_ctypes(_ctypes)
+
+    def _make_content(self):
+        """ returns a private writable buffer with the base content, and the changed pages of the delta """
+        filename = None
+        if isinstance(self._base_mapping, FilenameBackedMemoryMapping):
+            filename = self._base_mapping._memdumpname
+        if isinstance(self._base_mapping, OverlayMemoryMapping):
+            content = self._base_mapping._make_content()
+        elif filename is not None and os.path.getsize(filename) >= len(self):
+            with open(filename, 'rb') as fin:
+                content = mmap.mmap(fin.fileno(), len(self), access=mmap.ACCESS_COPY)
+        else:
+            content = bytearray(self._base_mapping.read_bytes(self._base_mapping.start, len(self)))
+        # copy the runs of changed pages
+        flags = numpy.concatenate(([False], self._changed, [False])).astype(numpy.int8)
+        edges = numpy.flatnonzero(numpy.diff(flags))
+        for first, last in zip(edges[::2], edges[1::2]):
+            offset = int(first) * PAGE_SIZE
+            size = min(int(last) * PAGE_SIZE, len(self)) - offset
+            content[offset:offset + size] = self._delta_mapping.read_bytes(self._delta_mapping.start + offset, size)
+        self._delta_mapping.reset()
+        self._base_mapping.reset()
+        return content
+
+    def _mmap(self):
+        if self._base is None:
+            content = (ctypes.c_ubyte * len(self)).from_buffer(self._make_content())
+            self._base = LocalMemoryMapping.fromAddress(self, ctypes.addressof(content))
+            self._base._keepalive = ContentPin(content)
+        return self._base
+
+    def mmap(self):
+        return self._mmap()
+
+    def is_mmaped(self):
+        return self._base is not None
+
+    def get_byte_buffer(self):
+        return self._mmap().get_byte_buffer()
+
+    def read_word(self, address):
+        return self._mmap().read_word(address)
+
+    def read_bytes(self, address, size):
+        return self._mmap().read_bytes(address, size)
+
+    def read_struct(self, address, struct_type):
+        return self._mmap().read_struct(address, struct_type)
+
+    def read_array(self, address, basetype, count):
+        return self._mmap().read_array(address, basetype, count)
+
+    def rebase(self, new_start_address):
+        super(OverlayMemoryMapping, self).rebase(new_start_address)
+        if self._base is not None:
+            self._base.rebase(new_start_address)
+
+    def reset(self):
+        self._base = None
+        self._delta_mapping.reset()
+        self._base_mapping.reset()
+
+
+def overlay_mappings(dumpname, mappings, metalines, base_dumpname=None, changed=None):
+    """
+    Overlay the mappings of the delta dump dumpname on its base dump.
+
+    :param mappings: the list of mappings loaded from the delta dump
+    :param metalines: the metadata of the mappings, as read by the folder loader
+    :param base_dumpname: the path of the base dump, read from the delta dump by default
+    :param changed: the page maps of the delta dump, read from the delta dump by default
+    :return: list of mappings
+    """
+    from haystack.mappings import folder
+    if base_dumpname is None:
+        base_dumpname = get_base_dumpname(dumpname)
+    if changed is None:
+        changed = load_changed_pages(dumpname)
+    log.debug('Loading base dump %s for %s', base_dumpname, dumpname)
+    base_loader = folder.ProcessMemoryDumpLoader(base_dumpname)
+    base_loader._load_metadata()
+    base_mappings = dict((m.start, m) for m in base_loader._make_mappings())
+    res = []
+    for m, metaline in zip(mappings, metalines):
+        base_mapping = base_mappings.get(m.start)
+        m_changed = changed.get(metaline[0])
+        if m_changed is None or m_changed.all() or base_mapping is None or len(base_mapping) != len(m):
+            res.append(m)
+            continue
+        res.append(OverlayMemoryMapping(m, base_mapping, m_changed))
+    return res
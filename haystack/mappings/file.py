@@ -34,8 +34,13 @@ import logging
 import struct
 import mmap
 
+import collections
 import os
 import ctypes
+import threading
+import weakref
+
+import numpy
 
 # haystack
 import haystack
@@ -47,6 +52,51 @@ log = logging.getLogger('file')
 
 MMAP_HACK_ACTIVE = True
 
+def make_file_page_presence(filename, offset, size):
+    """
+    Returns the page presence map of size bytes at offset in a sparse file.
+    The holes are found with SEEK_DATA and SEEK_HOLE, without reading the file.
+
+    :return: numpy bool array, or None if the file is not sparse
+    """
+    if not hasattr(os, 'SEEK_HOLE'):
+        return None
+    stat = os.stat(filename)
+    if stat.st_blocks * 512 >= stat.st_size:
+        # not sparse
+        return None
+    presence = numpy.zeros((size + base.PAGE_SIZE - 1) // base.PAGE_SIZE, dtype=bool)
+    end = min(offset + size, stat.st_size)
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        position = offset
+        while position < end:
+            try:
+                data = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError:
+                # no more data
+                break
+            if data >= end:
+                break
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+            presence[(data - offset) // base.PAGE_SIZE:(hole - offset + base.PAGE_SIZE - 1) // base.PAGE_SIZE] = True
+            position = hole
+    finally:
+        os.close(fd)
+    return presence
+
+
+class ContentPin(object):
+    """
+    Holds the owner of the content of a mapping.
+    The records read from the mapping keep a reference to it, so the content stays valid while they live.
+    """
+    __slots__ = ('content', '__weakref__')
+
+    def __init__(self, content):
+        self.content = content
+
+
 class LocalMemoryMapping(AMemoryMapping):
 
     """
@@ -70,6 +120,8 @@ class LocalMemoryMapping(AMemoryMapping):
         self._local_mmap = (ctypes.c_ubyte * len(self)).from_address(int(address))
         self._address = ctypes.addressof(self._local_mmap)
         self._bytebuffer = None
+        # the owner of the memory at address, kept alive by the records read from it
+        self._keepalive = None
 
     def _vtop(self, vaddr):
         ret = vaddr - self.start + self._address
@@ -104,13 +156,24 @@ class LocalMemoryMapping(AMemoryMapping):
         struct = struct.from_address(int(laddr))
         #struct = struct.from_buffer_copy(struct.from_address(int(laddr)))
         struct._orig_address_ = vaddr
+        if self._keepalive is not None:
+            struct._keepalive_ = self._keepalive
         return struct
 
     def read_array(self, vaddr, basetype, count):
         laddr = self._vtop(vaddr)
         array = (basetype * count).from_address(int(laddr))
+        if self._keepalive is not None:
+            array._keepalive_ = self._keepalive
         return array
 
+    def _get_content_array(self):
+        return numpy.frombuffer(self._local_mmap, dtype=numpy.uint8)
+
+    def _make_page_presence(self):
+        """ the content is already in local memory """
+        return base.make_page_presence(self._get_content_array()[:len(self)])
+
     def get_byte_buffer(self):
         if self._bytebuffer is None:
             self._bytebuffer = self.read_bytes(self.start, len(self))
@@ -124,6 +187,7 @@ class LocalMemoryMapping(AMemoryMapping):
         d = dict(self.__dict__)
         del d['_local_mmap']
         del d['_bytebuffer']
+        d['_keepalive'] = None
         return d
 
     @classmethod
@@ -245,6 +309,7 @@ class MemoryDumpMemoryMapping(AMemoryMapping):
                 log.warning('MemoryHandler Mapping content copied to ctypes array : %s', self)
             # make that _base
             self._base = LocalMemoryMapping.fromAddress(self, ctypes.addressof(self._local_mmap_content))
+            self._base._keepalive = ContentPin(self._get_content_owner())
             log.debug('%s done.' % self.__class__)
         # redirect function calls
         self.read_word = self._base.read_word
@@ -253,6 +318,12 @@ class MemoryDumpMemoryMapping(AMemoryMapping):
         self.read_struct = self._base.read_struct
         return self._base
 
+    def _get_content_owner(self):
+        """ the object that owns the memory of _local_mmap_content """
+        if MMAP_HACK_ACTIVE and getattr(self, '_local_mmap_bytebuffer', None) is not None:
+            return self._local_mmap_bytebuffer
+        return self._local_mmap_content
+
     def _read_word(self, vaddr):
         return self._mmap().read_word(vaddr)
 
@@ -265,6 +336,9 @@ class MemoryDumpMemoryMapping(AMemoryMapping):
     def _read_array(self, vaddr, basetype, count):
         return self._mmap().read_array(vaddr, basetype, count)
 
+    def _get_content_array(self):
+        return self._mmap()._get_content_array()
+
     # set the default
     read_word = _read_word
     read_array = _read_array
@@ -320,6 +394,10 @@ class FileBackedMemoryMapping(MemoryDumpMemoryMapping):
         """ returns self to force super() to read through us    """
         return self
 
+    def _get_content_array(self):
+        """ read the records from the file """
+        return None
+
     def _vtop(self, vaddr):
         ret = vaddr - self.start
         if ret < 0 or ret > len(self):
@@ -357,6 +435,19 @@ class FileBackedMemoryMapping(MemoryDumpMemoryMapping):
         # is non-aligned a pb ?
         return word
 
+    def read_bytes_many(self, addresses, size):
+        """ one read per group of close addresses """
+        addresses = self._check_addresses(addresses, size).tolist()
+
+        def read_ranges(ranges):
+            with open(self._local_mmap.memdump_name, 'rb') as memdump:
+                contents = []
+                for address, length in ranges:
+                    memdump.seek(self._vtop(address))
+                    contents.append(memdump.read(length))
+                return contents
+        return base.read_coalesced(read_ranges, addresses, size)
+
     def read_array(self, address, basetype, count):
         laddr = self._vtop(address)
         size = ctypes.sizeof((basetype * count))
@@ -395,14 +486,66 @@ class FilenameBackedMemoryMapping(MemoryDumpMemoryMapping):
                                          major_device, minor_device, inode, pathname, preload=False)
         self._memdumpname = memdumpname
         assert isinstance(self._memdumpname, str)
+        self._lru = None
         return
 
+    def set_lru(self, lru):
+        """ share a MappingLRU, that caps the number of mmap-ed mappings """
+        self._lru = lru
+
     def _mmap(self):
-        #import code
-        # code.interact(local=locals())
+        if self._base is not None:
+            if self._lru is not None:
+                self._lru.touch(self)
+            return self._base
         self._memdump = open(self._memdumpname, 'rb')
         # memdump is closed by super()
-        return MemoryDumpMemoryMapping._mmap(self)
+        base = MemoryDumpMemoryMapping._mmap(self)
+        if self._lru is not None:
+            # read through _mmap, to update the mapping recency
+            self._redirect_reads()
+            self._lru.add(self)
+        return base
+
+    def _redirect_reads(self):
+        self.read_word = self._read_word
+        self.read_array = self._read_array
+        self.read_bytes = self._read_bytes
+        self.read_struct = self._read_struct
+
+    def has_live_records(self):
+        """
+        Returns True if records read from the mmap are still alive.
+        The records are the only other holders of the content pin.
+        """
+        if self._base is None or self._base._keepalive is None:
+            return False
+        pin_ref = weakref.ref(self._base._keepalive)
+        self._base._keepalive = None
+        pin = pin_ref()
+        if pin is None:
+            pin = ContentPin(self._get_content_owner())
+        self._base._keepalive = pin
+        return pin_ref() is not None
+
+    def release(self):
+        """
+        Return to a non-loaded state, and close the mmap.
+        The mmap of a mapping with live records is left open, to the records.
+        """
+        if not self.has_live_records() and getattr(self, '_local_mmap_bytebuffer', None) is not None:
+            self._local_mmap_bytebuffer.close()
+        self._local_mmap_content = None
+        self._local_mmap_bytebuffer = None
+        self._base = None
+        self._redirect_reads()
+
+    def _make_page_presence(self):
+        """ holes of a sparse dump file are absent pages, without reading the file """
+        presence = make_file_page_presence(self._memdumpname, 0, len(self))
+        if presence is None:
+            return AMemoryMapping._make_page_presence(self)
+        return presence
 
     def reset(self):
         """
@@ -410,6 +553,8 @@ class FilenameBackedMemoryMapping(MemoryDumpMemoryMapping):
         to a non-loaded state, closing opened file descriptors.
         :return:
         """
+        if self._lru is not None:
+            self._lru.discard(self)
         self._local_mmap_content = None
         if hasattr(self, '_local_mmap_bytebuffer'):
             if self._local_mmap_bytebuffer:
@@ -423,6 +568,54 @@ class FilenameBackedMemoryMapping(MemoryDumpMemoryMapping):
         self.read_struct = self._read_struct
 
 
+class MappingLRU(object):
+    """
+    Caps the number of mmap-ed mappings of a memory dump.
+    When a mapping is mmap-ed over capacity, the least recently read mapping is released.
+    A mapping with live records is pinned: it is not released while the records are alive.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._mappings = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.released = 0
+
+    def add(self, mapping):
+        evicted = []
+        with self._lock:
+            self._mappings.pop(id(mapping), None)
+            self._mappings[id(mapping)] = mapping
+            if len(self._mappings) > self._capacity:
+                # from the least recently read, the last one is the new mapping
+                for key in list(self._mappings.keys())[:-1]:
+                    if self._mappings[key].has_live_records():
+                        continue
+                    evicted.append(self._mappings.pop(key))
+                    if len(self._mappings) <= self._capacity:
+                        break
+            if len(self._mappings) > self._capacity:
+                log.debug('%d mmap-ed mappings are pinned by live records', len(self._mappings) - self._capacity)
+            self.released += len(evicted)
+        for m in evicted:
+            log.debug('Releasing %s', m)
+            m.release()
+
+    def touch(self, mapping):
+        """ the mapping is the most recently read """
+        key = id(mapping)
+        with self._lock:
+            if key in self._mappings and next(reversed(self._mappings)) != key:
+                self._mappings[key] = self._mappings.pop(key)
+
+    def discard(self, mapping):
+        with self._lock:
+            self._mappings.pop(id(mapping), None)
+
+    def __len__(self):
+        return len(self._mappings)
+
+
 class LazyMmap:
 
     """
@@ -433,7 +626,7 @@ class LazyMmap:
         i = memdump.tell()
         try:
             memdump.seek(2 ** 64)
-        except OverflowError:
+        except (OverflowError, ValueError):
             memdump.seek(os.fstat(memdump.fileno()).st_size)
         self.size = memdump.tell()
         self.memdump_name = memdump.name
@@ -466,11 +659,12 @@ class MMapProcessMapping(base.AMemoryMapping):
     """Process memory mapping using 1 file for all mappings """
 
     def __init__(self, mmap_content, start, end, permissions='r--',
-                 offset=0, major_device=0, minor_device=0, inode=0, pathname=''):
-        """mmap_content should be """
+                 offset=0, major_device=0, minor_device=0, inode=0, pathname='', filename=None):
+        """mmap_content should be the mmap of filename, if known"""
         base.AMemoryMapping.__init__(self, start, end, permissions, offset,
                                      major_device, minor_device, inode, pathname)
         self._backend = mmap_content
+        self._filename = filename
         self.offset = offset
 
     def read_word(self, addr):
@@ -499,5 +693,16 @@ class MMapProcessMapping(base.AMemoryMapping):
         array = (basetype *count).from_buffer_copy(self._backend.read(size))
         return array
 
+    def _get_content_array(self):
+        return numpy.frombuffer(self._backend, dtype=numpy.uint8, count=len(self), offset=self.offset)
+
+    def _make_page_presence(self):
+        presence = None
+        if self._filename is not None:
+            presence = make_file_page_presence(self._filename, self.offset, len(self))
+        if presence is None:
+            return base.AMemoryMapping._make_page_presence(self)
+        return presence
+
     def reset(self):
         pass
@@ -20,7 +20,6 @@ Functions:
 """
 
 import logging
-import zipfile  # relatively useless
 
 import os
 
@@ -28,10 +27,10 @@ import haystack
 from haystack import types
 from haystack import target
 from haystack.abc import interfaces
-from haystack.mappings.base import MemoryHandler, AMemoryMapping
-from haystack.mappings.file import FileBackedMemoryMapping
+from haystack.mappings import delta
+from haystack.mappings.base import MemoryHandler, MetadataMemoryMapping
 from haystack.mappings.file import FilenameBackedMemoryMapping
-from haystack.mappings.file import LocalMemoryMapping
+from haystack.mappings.file import MappingLRU
 
 __author__ = "Loic Jaquemet"
 __copyright__ = "Copyright (C) 2012 Loic Jaquemet"
@@ -45,16 +44,8 @@ log = logging.getLogger('dump_loader')
 
 # bad bad idea...
 MMAP_HACK_ACTIVE = True
-# do not load huge mmap
-MAX_MAPPING_SIZE_FOR_MMAP = 1024 * 1024 * 20
-
-
-class LazyLoadingException(Exception):
-
-    def __init__(self, filename):
-        Exception.__init__(self)
-        self._filename = filename
-        return
+# mmap-ed mapping files at the same time, per dump
+MAX_OPEN_MAPPINGS = 512
 
 
 class MemoryDumpLoader(interfaces.IMemoryLoader):
@@ -90,6 +81,7 @@ class ProcessMemoryDumpLoader(MemoryDumpLoader):
     """ Handles memory load from several recognized format."""
     indexFilename = 'mappings'
     filePrefix = './'
+    max_open_mappings = MAX_OPEN_MAPPINGS
 
     def _is_valid(self):
         """Validates if we handle the format."""
@@ -120,16 +112,13 @@ class ProcessMemoryDumpLoader(MemoryDumpLoader):
             log.info('Not a valid directory')
         return False
 
-    def _protected_open_file(self, mmap_fname, mmap_pathname):
-        return self._open_file(self.archive, self.filePrefix + mmap_fname)
-
     def _load_mappings(self):
         """Loads the _memory_handler content from the dump to a MemoryMappings.
 
         If an underlying file containing a memory dump does not exists, still
         create a MemoryMap for metadata purposes.
-        If the memory map is > _target_platform.MAX_MAPPING_SIZE_FOR_MMAP, use a slow FileBackedMemoryMapping.
-        Else, load the mapping in memory.
+        Only the metadata is loaded. The mapping files are opened and mmap-ed on first read,
+        and at most max_open_mappings are mmap-ed at the same time.
         """
         self._load_metadata()
         self._load_memory_mappings()  # set self._memory_handler
@@ -137,7 +126,11 @@ class ProcessMemoryDumpLoader(MemoryDumpLoader):
 
     def _load_metadata(self):
         """ Load    amemory dump meta data """
-        mappingsFile = self._open_file(self.archive, self.indexFilename)
+        self._read_metadata(self._open_file(self.archive, self.indexFilename))
+        return
+
+    def _read_metadata(self, mappingsFile):
+        """ Read the memory dump meta data from the mappings index file object, and close it """
         self.metalines = []
         for l in mappingsFile.readlines():
             fields = l.strip().split(' ')
@@ -162,44 +155,37 @@ class ProcessMemoryDumpLoader(MemoryDumpLoader):
 
     def _load_memory_mappings(self):
         """ make the python objects"""
+        _mappings = self._make_mappings()
+        _target_platform = target.TargetPlatform(_mappings, cpu_bits=self._cpu_bits, os_name=self._os_name,
+                                                 cache_name=self.dumpname)
+        self._memory_handler = MemoryHandler(_mappings, _target_platform, self.dumpname)
+        return
+
+    def _make_mappings(self):
+        """ make the mappings, overlaid on the base dump for a delta dump """
         _mappings = []
+        # one listdir, rather than one stat per mapping
+        mmap_files = set(self.mmaps)
+        self._lru = MappingLRU(self.max_open_mappings)
         for mmap_fname, start, end, permissions, offset, major_device, minor_device, inode, pathname in self.metalines:
-            log.debug('Loading %s - %s' % (mmap_fname, pathname))
-            # open the file in the archive
-            try:
-                mmap_content_file = self._protected_open_file(mmap_fname, pathname)
-            except (IOError, KeyError) as e:
-                log.debug('Ignore absent file : %s' % (e))
-                mmap = AMemoryMapping(start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
-                _mappings.append(mmap)
-                continue
-            except LazyLoadingException as e:
-                mmap = FilenameBackedMemoryMapping(e._filename, start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
-                _mappings.append(mmap)
-                continue
-
-            if isinstance(self.archive, zipfile.ZipFile):  # ZipExtFile is lame
-                log.warning(
-                    'Using a local memory mapping . Zipfile sux. thx ruby.')
-                mmap = AMemoryMapping(start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
-                mmap = LocalMemoryMapping.fromBytebuffer(mmap, mmap_content_file.read())
-            # use file mmap when file is too big
-            elif end - start > MAX_MAPPING_SIZE_FOR_MMAP:
-                log.warning('Using a file backed memory mapping. no mmap in memory for this memorymap (%s).' % (pathname) +
-                            ' Search will fail. Buffer is needed.')
-                mmap = FileBackedMemoryMapping(mmap_content_file.name, start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
+            if mmap_fname not in mmap_files:
+                log.debug('Ignore absent file : %s', mmap_fname)
+                mmap = MetadataMemoryMapping(start, end, permissions, offset, major_device, minor_device, inode,
+                                             pathname=pathname)
             else:
-                # log.debug('Using a MemoryDumpMemoryMapping. small size')
-                # mmap = MemoryDumpMemoryMapping(mmap_content_file, start, end, permissions, offset,
-                log.debug('Always use FilenameBackedMemoryMapping. small size')
-                mmap = FilenameBackedMemoryMapping(mmap_content_file.name, start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
+                fname = os.path.sep.join([self.archive, self.filePrefix + mmap_fname])
+                mmap = FilenameBackedMemoryMapping(fname, start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
+                mmap.set_lru(self._lru)
             _mappings.append(mmap)
-        _target_platform = target.TargetPlatform(_mappings, cpu_bits=self._cpu_bits, os_name=self._os_name)
-        self._memory_handler = MemoryHandler(_mappings, _target_platform, self.dumpname)
-        return
+        if delta.is_delta(self.dumpname):
+            _mappings = delta.overlay_mappings(self.dumpname, _mappings, self.metalines)
+        return _mappings
 
 
 class LazyProcessMemoryDumpLoader(ProcessMemoryDumpLoader):
+    """
+    mmap the mappings with these pathnames at load time. Other mappings are mmap-ed on first read.
+    """
 
     def __init__(self, dumpname, maps_to_load=None, bits=None, os_name=None):
         self._cpu_bits = bits
@@ -208,39 +194,36 @@ class LazyProcessMemoryDumpLoader(ProcessMemoryDumpLoader):
         self._memory_handler = None
         if not self._is_valid():
             raise ValueError('memory dump not valid for %s ' % self.__class__)
+        self._maps_to_load = maps_to_load
         if maps_to_load is None:
             self._maps_to_load = ['[heap]', '[stack]']
         log.debug('Filter on mapping names: %s ' % self._maps_to_load)
         return
 
-    def _protected_open_file(self, mmap_fname, mmap_pathname):
-        if mmap_pathname is not None and mmap_pathname in self._maps_to_load:
-            log.debug('SELECTED: %s', mmap_pathname)
-            return self._open_file(self.archive, self.filePrefix + mmap_fname)
-        else:
-            log.debug('IGNORED: %s', mmap_pathname)
-            # return lambda: (file(os.path.sep.join([self.archive,
-            # self.filePrefix+mmap_fname]),'r')
-            raise LazyLoadingException(os.path.sep.join([self.archive, self.filePrefix + mmap_fname]))
-            # TODO FIX with name only, not file()
+    def make_memory_handler(self):
+        memory_handler = super(LazyProcessMemoryDumpLoader, self).make_memory_handler()
+        for m in memory_handler.get_mappings():
+            if m.pathname in self._maps_to_load and isinstance(m, FilenameBackedMemoryMapping):
+                log.debug('SELECTED: %s', m.pathname)
+                m.mmap()
+        return memory_handler
 
 
 class VeryLazyProcessMemoryDumpLoader(LazyProcessMemoryDumpLoader):
     """
-    Always use a filename backed memory mapping.
+    Always use a filename backed memory mapping. Nothing is mmap-ed at load time.
     """
+    def make_memory_handler(self):
+        return ProcessMemoryDumpLoader.make_memory_handler(self)
+
     def _load_memory_mappings(self):
         """ make the python objects"""
-        _mappings = []
         default_ctypes = types.load_ctypes_default()
-        for mmap_fname, start, end, permissions, offset, major_device, minor_device, inode, pathname in self.metalines:
-            log.debug('Loading %s - %s' % (mmap_fname, pathname))
-            # open the file in the archive
-            fname = os.path.sep.join([self.dumpname, mmap_fname])
-            mmap = FilenameBackedMemoryMapping(fname, start, end, permissions, offset, major_device, minor_device, inode, pathname=pathname)
+        _mappings = self._make_mappings()
+        for mmap in _mappings:
             mmap.set_ctypes(default_ctypes)
-            _mappings.append(mmap)
-        _target_platform = target.TargetPlatform(_mappings, cpu_bits=self._cpu_bits, os_name=self._os_name)
+        _target_platform = target.TargetPlatform(_mappings, cpu_bits=self._cpu_bits, os_name=self._os_name,
+                                                 cache_name=self.dumpname)
         self._memory_handler = MemoryHandler(_mappings, _target_platform, self.dumpname)
         self._memory_handler.reset_mappings()
         return
@@ -254,14 +237,20 @@ def load(dumpname, bits=None, os_name=None):
     if os.path.isdir(dumpname):
         mapper = VeryLazyProcessMemoryDumpLoader(dumpname, bits=bits, os_name=os_name)
     elif os.path.isfile(dumpname):
-        # try minidump
-        from haystack.mappings import minidump
-        mapper = minidump.MinidumpLoader(dumpname, bits=bits, os_name=os_name)
+        from haystack.mappings import container
+        from haystack.mappings import archive
+        if container.is_container(dumpname):
+            mapper = container.ContainerDumpLoader(dumpname, bits=bits, os_name=os_name)
+        elif archive.is_archive(dumpname):
+            mapper = archive.TarDumpLoader(dumpname, bits=bits, os_name=os_name)
+        else:
+            # try minidump
+            from haystack.mappings import minidump
+            mapper = minidump.MinidumpLoader(dumpname, bits=bits, os_name=os_name)
     else:
         raise IOError('couldnt load %s' % dumpname)
     memory_handler = mapper.make_memory_handler()
     log.debug('%d dump file loaded' % len(memory_handler))
-    # excep mmap.error - to much openfile - increase ulimit
     return memory_handler
 
 
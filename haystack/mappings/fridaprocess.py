@@ -2,10 +2,12 @@
 
 import logging
 import struct
+import sys
 
 # from haystack.mappings import FileMapping
 from haystack import target
 from haystack.abc import interfaces
+from haystack.mappings import cached
 from haystack.mappings.base import MemoryHandler, AMemoryMapping
 
 log = logging.getLogger("frida")
@@ -15,12 +17,13 @@ class FridaMapper(interfaces.IMemoryLoader):
     """
     """
 
-    def __init__(self, process_name_or_pid, bits=None, os_name=None):
+    def __init__(self, process_name_or_pid, bits=None, os_name=None, block_cache=True):
         import frida
         self.session = frida.attach(process_name_or_pid)
         self.name = process_name_or_pid
         self.cpu = bits
         self.os_name = os_name
+        self.block_cache = block_cache
         self._init_mappings()
 
     def _init_mappings(self):
@@ -35,6 +38,8 @@ class FridaMapper(interfaces.IMemoryLoader):
             mappings.append(FridaMemoryMapping(self.session, start, end, perms, None))
             if not is_64 and len(hex(start)) > 8:
                 is_64 = True
+        if self.block_cache:
+            mappings = cached.make_cached_mappings(mappings)
         #
         self.mappings = mappings
         log.debug("nb maps: %d", len(self.mappings))
@@ -120,7 +125,8 @@ class FridaLoader(interfaces.IMemoryLoader):
     desc = 'Load a Minidump memory dump'
 
     def __init__(self, opts):
-        self.loader = FridaMapper(opts.target.netloc, bits=opts.bits, os_name=opts.osname)
+        self.loader = FridaMapper(opts.target.netloc, bits=opts.bits, os_name=opts.osname,
+                                  block_cache=getattr(opts, 'block_cache', True))
 
     def make_memory_handler(self):
         return self.loader.make_memory_handler()
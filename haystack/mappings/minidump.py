@@ -986,128 +986,203 @@ from haystack.mappings import base
 import os
 import mmap
 import logging
+import struct
+
+import numpy
 
 
 log = logging.getLogger("minidump")
 
+THREAD_LIST_STREAM = 3
+MODULE_LIST_STREAM = 4
+SYSTEM_INFO_STREAM = 7
+MEMORY64_LIST_STREAM = 9
+HANDLE_DATA_STREAM = 12
+MEMORY_INFO_LIST_STREAM = 16
+
+# Signature, Version, ImplementationVersion, NumberOfStreams, StreamDirectoryRva
+HEADER_FORMAT = '<4sHHII'
+DIRECTORY_DTYPE = numpy.dtype([('StreamType', '<u4'), ('DataSize', '<u4'), ('RVA', '<u4')])
+MEMORY_DESCRIPTOR64_DTYPE = numpy.dtype([('StartOfMemoryRange', '<u8'), ('DataSize', '<u8')])
+MEMORY_INFO_FIELDS = {'names': ['BaseAddress', 'RegionSize', 'State', 'Protect', 'Type'],
+                      'formats': ['<u8', '<u8', '<u4', '<u4', '<u4'],
+                      'offsets': [0, 24, 32, 36, 40]}
+MODULE_FIELDS = {'names': ['BaseOfImage', 'SizeOfImage', 'ModuleNameRva'],
+                 'formats': ['<u8', '<u4', '<u4'],
+                 'offsets': [0, 8, 20],
+                 'itemsize': 108}
+MODULE_DTYPE = numpy.dtype(MODULE_FIELDS)
+PROCESSOR_ARCHITECTURE_X86 = 0
+PROCESSOR_ARCHITECTURE_X86_WIN64 = 10
+# the PAGE_ACCESS flags, in the order MEM_PROTECT_to_string checks them
+PAGE_ACCESS_FLAGS = [(0x01, "---"), (0x02, "r--"), (0x04, "rw-"), (0x08, "rc-"),
+                     (0x10, "--x"), (0x20, "r-x"), (0x40, "rwx"), (0x80, "rcx")]
+
+
+def protect_to_string(protect):
+    """ the permissions of a MEM_PROTECT value, like MEM_PROTECT_to_string """
+    for flag, permissions in PAGE_ACCESS_FLAGS:
+        if protect & flag:
+            return permissions
+    return "---"
+
+
+class ModuleIndex(object):
+    """
+    An interval index of the module images.
+    """
+    def __init__(self, bases, sizes, names):
+        order = numpy.argsort(bases, kind='mergesort')
+        self._bases = numpy.asarray(bases, dtype=numpy.uint64)[order]
+        self._ends = self._bases + numpy.asarray(sizes, dtype=numpy.uint64)[order]
+        self._names = [names[i] for i in order]
+
+    def __len__(self):
+        return len(self._names)
+
+    def lookup(self, addresses):
+        """
+        :return: the module name of each address, or None
+        """
+        addresses = numpy.asarray(addresses, dtype=numpy.uint64)
+        if len(self._names) == 0:
+            return [None] * len(addresses)
+        i = numpy.searchsorted(self._bases, addresses, side='right') - 1
+        found = (i >= 0) & (addresses < self._ends[numpy.maximum(i, 0)])
+        return [self._names[j] if ok else None for j, ok in zip(i.tolist(), found.tolist())]
+
 
 class MinidumpLoader(interfaces.IMemoryLoader):
-    """Container:
-            StreamType = 'Memory64ListStream'
-            Location = Container:
-                DataSize = 3856
-                RVA = 11883
-            DirectoryData = Container:
-                NumberOfMemoryRanges = 240
-                BaseRva = 15739
-                MINIDUMP_MEMORY_DESCRIPTOR64 = [
-                    Container:
-                        StartOfMemoryRange = 65536
-                        DataSize = 4096
+    """
+    Loads the Memory64ListStream memory ranges of a full memory Minidump.
+
+    The header, the directory and the memory, memory info and module streams are read with
+    struct and numpy from a mmap of the file. The other streams are parsed with construct
+    on demand, with get_stream().
     """
 
     def __init__(self, filename, bits=None, os_name=None):
-        construct_data = MINIDUMP_HEADER.parse_stream(open(filename, 'rb'))
-        #
         self.filename = os.path.abspath(filename)
         self.dumpname = os.path.basename(filename)
         self.cpu = bits
         self.os_name = os_name
-        self._init_mappings(construct_data)
-
-    def _init_mappings(self, construct_data):
-        content_file = open(self.filename, 'rb')
-        fsize = os.path.getsize(self.filename)
-        # FIXME, can't close it because we need fileno ? mmap usage
-        mmap_content = mmap.mmap(
-                    content_file.fileno(),
-                    fsize,
-                    access=mmap.ACCESS_READ)
+        self._content_file = open(self.filename, 'rb')
+        self._mmap = mmap.mmap(self._content_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._read_directory()
+        self._init_mappings()
+
+    def _read_directory(self):
+        signature, version, impl_version, nb_streams, directory_rva = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if signature != b'MDMP':
+            raise TypeError('%s is not a Minidump' % self.filename)
+        self._directory_rva = directory_rva
+        self.directory = numpy.frombuffer(self._mmap, DIRECTORY_DTYPE, nb_streams, directory_rva)
+        return
+
+    def _get_stream_rva(self, stream_type):
+        """ returns the RVA of the first stream of that type, or None """
+        rvas = self.directory['RVA'][self.directory['StreamType'] == stream_type]
+        if len(rvas) == 0:
+            return None
+        return int(rvas[0])
+
+    def get_stream(self, stream_type):
+        """
+        Parse a stream with construct, on demand. ex: THREAD_LIST_STREAM, HANDLE_DATA_STREAM
+
+        :return: the construct Container of the directory entry, or None
+        """
+        for i, entry in enumerate(self.directory):
+            if entry['StreamType'] == stream_type:
+                self._mmap.seek(self._directory_rva + i * DIRECTORY_DTYPE.itemsize)
+                return MINIDUMP_DIRECTORY.parse_stream(self._mmap)
+        return None
+
+    def get_threads(self):
+        stream = self.get_stream(THREAD_LIST_STREAM)
+        return stream.DirectoryData.MINIDUMP_THREAD if stream is not None else []
+
+    def get_handles(self):
+        stream = self.get_stream(HANDLE_DATA_STREAM)
+        return stream.DirectoryData.HandleDataList if stream is not None else []
+
+    def _read_string(self, rva):
+        length = struct.unpack_from('<I', self._mmap, rva)[0]
+        return self._mmap[rva + 4:rva + 4 + length].decode('utf-16-le')
+
+    def _make_module_index(self):
+        rva = self._get_stream_rva(MODULE_LIST_STREAM)
+        if rva is None:
+            return ModuleIndex([], [], [])
+        count = struct.unpack_from('<I', self._mmap, rva)[0]
+        modules = numpy.frombuffer(self._mmap, MODULE_DTYPE, count, rva + 4)
+        names = [self._read_string(int(name_rva)) for name_rva in modules['ModuleNameRva']]
+        return ModuleIndex(modules['BaseOfImage'], modules['SizeOfImage'], names)
+
+    def _read_memory_info(self):
+        rva = self._get_stream_rva(MEMORY_INFO_LIST_STREAM)
+        if rva is None:
+            return None
+        header_size, entry_size, count = struct.unpack_from('<IIQ', self._mmap, rva)
+        dtype = numpy.dtype(dict(MEMORY_INFO_FIELDS, itemsize=entry_size))
+        return numpy.frombuffer(self._mmap, dtype, count, rva + header_size)
+
+    def _init_mappings(self):
+        fsize = len(self._mmap)
         log.debug("fsize: %d", fsize)
-        maps = []
-        maps_info = {}
-        #
-        # get the named modules
-        named_modules = {}
-        for directory in construct_data.MINIDUMP_DIRECTORY:
-            if directory.StreamType == 'ModuleListStream':
-                for _range in directory.DirectoryData.MINIDUMP_MODULE:
-                    start = _range.BaseOfImage
-                    size = _range.SizeOfImage
-                    for page_start in range(start, start+size, 0x1000):
-                        named_modules[page_start] = (size, _range.ModuleName)
-        # BUG ?
-        # the last mapping is sometimes incomplete, and seems to be the PE file.
-        for directory in construct_data.MINIDUMP_DIRECTORY:
-            if directory.StreamType == 'Memory64ListStream':
-                #print directory
-                #print directory.DirectoryData.NumberOfMemoryRanges, "mappings"
-                offset = directory.DirectoryData.BaseRva
-                map_offset = offset
-                prev_size = 0
-                for _range in directory.DirectoryData.MINIDUMP_MEMORY_DESCRIPTOR64:
-                    map_offset += prev_size
-                    start = _range.StartOfMemoryRange
-                    size = _range.DataSize
-                    if map_offset+size > fsize:
-                        log.error('BAD FILE: reducing mapping 0x%x-0x%x size 0x%x -> 0x%x bytes', start, start+size, size, fsize - map_offset)
-                        size = fsize - map_offset
-                    end = start + size
-                    log.debug("Memory64ListStream 0x%x-0x%x size:0x%x offset_in_file:0x%x", start, start+size, size, map_offset)
-                    ## BUG FIXME, offset reading ???
-                    name = 'None'
-                    if start in named_modules:
-                        name = named_modules[start][1]
-                    maps.append(file.MMapProcessMapping(mmap_content, start, end, offset=map_offset, pathname=name))
-                    prev_size = size
-            elif directory.StreamType == 'MemoryInfoListStream':
-                ## Collect all metadata information
-                nb_entries = directory.DirectoryData.NumberOfEntries
-                for _range in directory.DirectoryData.MINIDUMP_MEMORY_INFO:
-                    start = _range.BaseAddress
-                    size = _range.RegionSize
-                    log.debug("MemoryInfoListStream 0x%x-0x%x size:0x%x ", start, start+size, size)
-                    maps_info[start] = (_range, start, size)
+        rva = self._get_stream_rva(MEMORY64_LIST_STREAM)
         ## FAST FAIL
-        if len(maps) == 0:
+        if rva is None:
             raise TypeError('This Minidump does not contain Memory64ListStream memory dump. ' +
                             'Please use full memory dump options in the memory acquisition tool.')
-        missing_info = [x.start for x in maps if x.start not in maps_info]
-        if len(missing_info) > 0:
-            log.debug('Missing metadata MemoryInfoListStream. %d mappings missing', len(missing_info))
+        count, base_rva = struct.unpack_from('<QQ', self._mmap, rva)
+        ranges = numpy.frombuffer(self._mmap, MEMORY_DESCRIPTOR64_DTYPE, count, rva + 16)
+        starts = ranges['StartOfMemoryRange']
+        sizes = ranges['DataSize']
+        # the memory ranges are stored one after the other from BaseRva
+        offsets = base_rva + numpy.concatenate(([0], numpy.cumsum(sizes)[:-1])).astype(numpy.uint64)
+        names = self._make_module_index().lookup(starts)
+        maps = []
+        # BUG ?
+        # the last mapping is sometimes incomplete, and seems to be the PE file.
+        for start, size, map_offset, name in zip(starts.tolist(), sizes.tolist(), offsets.tolist(), names):
+            if map_offset + size > fsize:
+                log.error('BAD FILE: reducing mapping 0x%x-0x%x size 0x%x -> 0x%x bytes', start, start+size, size, fsize - map_offset)
+                size = fsize - map_offset
+            end = start + size
+            maps.append(file.MMapProcessMapping(self._mmap, start, end, offset=map_offset, pathname=name or 'None',
+                                                filename=self.filename))
+        # enrich data with MemoryInfoListStream
+        infos = self._read_memory_info()
+        if infos is None:
+            log.debug('Missing metadata MemoryInfoListStream.')
         else:
-            # enrich data with MemoryInfoListStream
-            for m in maps:
-                if m.start not in maps_info:
-                    continue
-                # fix permissions
-                info, start, size = maps_info[m.start]
-                del maps_info[m.start]
-                if size != len(m):
-                    log.warning("incorrect size metadata on 0x%x", m.start)
-                m.permissions = MEM_PROTECT_to_string(info.Protect)
-        # Ignore the remaining mappiongs
-        for start, (info, start, size) in maps_info.items():
-            permissions = MEM_PROTECT_to_string(info.Protect)
-            # maps.append(base.AMemoryMapping(start, start+size, permissions, 0, 0, 0, 0, "*unknown*"))
-            log.debug("ignore uncaptured MemoryMapping: %s", base.AMemoryMapping(start, start+size, permissions, 0, 0, 0, 0, "*unknown*"))
+            info_index = dict((base_address, i) for i, base_address in enumerate(infos['BaseAddress'].tolist()))
+            missing_info = [m.start for m in maps if m.start not in info_index]
+            if len(missing_info) > 0:
+                log.debug('Missing metadata MemoryInfoListStream. %d mappings missing', len(missing_info))
+            else:
+                for m in maps:
+                    info = infos[info_index[m.start]]
+                    if int(info['RegionSize']) != len(m):
+                        log.warning("incorrect size metadata on 0x%x", m.start)
+                    m.permissions = protect_to_string(int(info['Protect']))
         # target
         cpu = os_name = None
         if self.os_name is None or self.cpu is None:
             # then resolve it
-            for directory in construct_data.MINIDUMP_DIRECTORY:
-                if directory.StreamType == 'SystemInfoStream':
-                    data = directory.DirectoryData
-                    if data.MajorVersion == 5:
-                        os_name = 'winxp'
-                    else:
-                        os_name = 'win7'
-                    # the heapfinder would have to make a difference.
-                    if 'X86' in data.ProcessorArchitecture:
-                        cpu = 32
-                    else:
-                        cpu = 64
-                    break
+            rva = self._get_stream_rva(SYSTEM_INFO_STREAM)
+            if rva is not None:
+                architecture, major_version = struct.unpack_from('<H6xI', self._mmap, rva)
+                if major_version == 5:
+                    os_name = 'winxp'
+                else:
+                    os_name = 'win7'
+                # the heapfinder would have to make a difference.
+                if architecture in [PROCESSOR_ARCHITECTURE_X86, PROCESSOR_ARCHITECTURE_X86_WIN64]:
+                    cpu = 32
+                else:
+                    cpu = 64
         if self.os_name is None:
             self.os_name = os_name
         if self.os_name not in ['winxp', 'win7']:
@@ -1123,7 +1198,7 @@ class MinidumpLoader(interfaces.IMemoryLoader):
             raise NotImplementedError('Unsupported cpu : %s' % self.cpu)
         #
         self.mappings = maps
-        self.maps_info = maps_info
+        self.maps_info = infos
         log.debug("nb maps: %d", len(self.mappings))
         log.debug("target: %s", self._target)
         # Use a folder name for its cache later on
@@ -6,10 +6,14 @@ Provides memory mapping wrappers for live processes.
 
 Classes:
 - ProcessMemoryMapping: memory space from a live process with the possibility to mmap the memspace at any moment.
+
+Functions:
+- make_snapshot_memory_handler: copy the heaps of a live process, and resume it.
 """
 
 import ctypes
 import logging
+import time
 from weakref import ref
 
 import os
@@ -18,7 +22,7 @@ import re
 from haystack import dbg
 from haystack import target
 from haystack.abc import interfaces
-from haystack.mappings.base import MemoryHandler, AMemoryMapping
+from haystack.mappings.base import MemoryHandler, AMemoryMapping, read_coalesced
 from haystack.mappings.file import LocalMemoryMapping
 
 log = logging.getLogger('process')
@@ -93,6 +97,18 @@ class ProcessMemoryMapping(AMemoryMapping):
         array = self._base.read_array(address, basetype, count)
         return array
 
+    def read_bytes_many(self, addresses, size):
+        """ a live process reads the groups of close addresses with one scatter read """
+        if self.is_mmaped() or not hasattr(self._base, 'read_bytes_many'):
+            return super(ProcessMemoryMapping, self).read_bytes_many(addresses, size)
+        addresses = self._check_addresses(addresses, size).tolist()
+        return read_coalesced(self._base.read_bytes_many, addresses, size)
+
+    def _get_content_array(self):
+        if self.is_mmaped():
+            return self._local_mmap._get_content_array()
+        return None
+
     def is_mmaped(self):
         return not (self._local_mmap is None)
 
@@ -127,6 +143,8 @@ class ProcessMemoryMapping(AMemoryMapping):
         self._base = self._process()
         self._local_mmap = None
         self._local_mmap_content = None
+        # live memory changes
+        self._page_presence = None
 
     def __getstate__(self):
         d = dict(self.__dict__)
@@ -187,6 +205,42 @@ def make_process_memory_handler(process):
     return _memory_handler
 
 
+def is_heap_candidate(mapping):
+    """ the brk heap, or an anonymous writable mapping, where mmap-ed arenas and chunks are """
+    if 'rw' not in mapping.permissions:
+        return False
+    return mapping.pathname in ['[heap]', '', None]
+
+
+def make_snapshot_memory_handler(pid, heaps_only=True, max_age=dbg.DEFAULT_MAX_AGE):
+    """
+    Stop the process, copy its heap mappings with batched process_vm_readv calls, and resume it.
+
+    The copied mappings are LocalMemoryMapping. The other mappings are still read from the
+    live process with process_vm_readv, without stopping it.
+
+    :param heaps_only: if False, copy all readable mappings
+    """
+    my_debugger = dbg.ProcessVMReadvDebugger(pid, stop=True, max_age=max_age)
+    t0 = time.time()
+    try:
+        memory_handler = make_process_memory_handler(my_debugger.get_process())
+        mappings = memory_handler.get_mappings()
+        selected = [m for m in mappings if 'r' in m.permissions and (not heaps_only or is_heap_candidate(m))]
+        contents = my_debugger.get_process().read_bytes_many([(m.start, len(m)) for m in selected])
+    finally:
+        my_debugger.quit()
+    log.info('%d mappings copied, process released after %0.3f secs', len(selected), time.time() - t0)
+    copies = dict()
+    for m, content in zip(selected, contents):
+        if content is None:
+            log.debug('could not copy %s', m)
+            continue
+        copies[m.start] = LocalMemoryMapping.fromBytebuffer(m, content)
+    _mappings = [copies.get(m.start, m) for m in mappings]
+    return MemoryHandler(_mappings, memory_handler.get_target_platform(), memory_handler.get_name())
+
+
 __LOCAL_MAPPINGS = None
 
 
@@ -202,7 +256,14 @@ class ProcessLoader(interfaces.IMemoryLoader):
 
     def __init__(self, opts):
         opts.pid = int(opts.target.netloc)
-        self.memory_handler = dbg.make_local_process_memory_handler(pid=opts.pid, use_mmap=opts.mmap)
+        max_age = getattr(opts, 'max_age', dbg.DEFAULT_MAX_AGE)
+        if getattr(opts, 'snapshot', False):
+            self.memory_handler = make_snapshot_memory_handler(opts.pid, max_age=max_age)
+        elif getattr(opts, 'vm_readv', False):
+            my_debugger = dbg.ProcessVMReadvDebugger(opts.pid, max_age=max_age)
+            self.memory_handler = make_process_memory_handler(my_debugger.get_process())
+        else:
+            self.memory_handler = dbg.make_local_process_memory_handler(pid=opts.pid, use_mmap=opts.mmap)
 
     def make_memory_handler(self):
         return self.memory_handler
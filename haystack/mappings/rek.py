@@ -18,6 +18,7 @@ import struct
 from functools import partial
 
 from haystack.mappings import base
+from haystack.mappings import cached
 from haystack.abc import interfaces
 from haystack import target
 
@@ -71,10 +72,11 @@ class RekallProcessMappingA(base.AMemoryMapping):
 
 class RekallProcessMapper(interfaces.IMemoryLoader):
 
-    def __init__(self, imgname, pid):
+    def __init__(self, imgname, pid, block_cache=True):
         log.debug("RekallProcessMapper %s %p",imgname, pid)
         self.pid = pid
         self.imgname = imgname
+        self.block_cache = block_cache
         self._memory_handler = None
         self._init_rekall()
 
@@ -147,6 +149,8 @@ class RekallProcessMapper(interfaces.IMemoryLoader):
             else:
                 self._target = target.TargetPlatform.make_target_linux_64()
 
+        if self.block_cache:
+            maps = cached.make_cached_mappings(maps)
         memory_handler = base.MemoryHandler(maps, self._target, self.imgname)
         self._memory_handler = memory_handler
 
@@ -225,7 +229,7 @@ class RekallLoader(interfaces.IMemoryLoader):
         opts.dump_filename = opts.target.path
         opts.pid = opts.target.path.split(':')[1]
         # FIXME bits, os_name from args
-        self.loader = RekallProcessMapper(opts.dump_filename, opts.pid)
+        self.loader = RekallProcessMapper(opts.dump_filename, opts.pid, block_cache=getattr(opts, 'block_cache', True))
 
     def make_memory_handler(self):
         return self.loader.make_memory_handler()
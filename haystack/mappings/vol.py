@@ -15,6 +15,7 @@ import sys
 import struct
 from functools import partial
 
+from haystack.mappings import cached
 from haystack.mappings.base import MemoryHandler, AMemoryMapping
 from haystack.abc import interfaces
 from haystack import target
@@ -75,9 +76,10 @@ class VolatilityProcessMappingA(AMemoryMapping):
 
 class VolatilityProcessMapper(interfaces.IMemoryLoader):
 
-    def __init__(self, imgname, profile, pid):
+    def __init__(self, imgname, profile, pid, block_cache=True):
         self.pid = pid
         self.imgname = imgname
+        self.block_cache = block_cache
         # FIXME for some reason volatility is able to autodetect.
         # but not with this piece of code.
         self.profile = profile
@@ -202,6 +204,8 @@ def my_render_text(mapper, cmd, outfd, data):
 
     if mapper.config.PROFILE == "WinXPSP2x86":
         mapper._target = target.TargetPlatform.make_target_win_32('winxp')
+    if mapper.block_cache:
+        maps = cached.make_cached_mappings(maps)
     memory_handler = MemoryHandler(maps, mapper._target, mapper.imgname)
     # print _memory_handler
     #mappings.init_config()
@@ -215,7 +219,8 @@ class VolatilityLoader(interfaces.IMemoryLoader):
         opts.dump_filename = opts.target.path
         opts.pid = opts.target.path.split(':')[1]
         # FIXME bits, os_name from args
-        self.loader = VolatilityProcessMapper(opts.dump_filename, "WinXPSP2x86", opts.pid)
+        self.loader = VolatilityProcessMapper(opts.dump_filename, "WinXPSP2x86", opts.pid,
+                                              block_cache=getattr(opts, 'block_cache', True))
 
     def make_memory_handler(self):
         return self.loader.make_memory_handler()
@@ -5,12 +5,24 @@
 
 import logging
 import argparse
+import fnmatch
 import shutil
 import sys
 import tempfile
+import threading
+import time
 
 import os
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from haystack import argparse_utils
 from haystack import dbg
+from haystack.mappings import delta
+from haystack.mappings.base import PAGE_SIZE
 from haystack.mappings.process import make_process_memory_handler
 
 __author__ = "Loic Jaquemet"
@@ -22,6 +34,77 @@ __status__ = "Production"
 
 log = logging.getLogger('dumper')
 
+# read the process memory by chunks of 1 MB
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_WRITERS = 2
+# chunks waiting to be written, per writer thread
+QUEUE_DEPTH = 4
+
+ZERO_PAGE = b'\x00' * PAGE_SIZE
+
+
+def write_sparse(fd, data, offset, keep=None):
+    """
+    Write data at offset in fd, skipping the pages holding only zeroes.
+    The file has to be truncated to its full size afterwards, the skipped pages are holes.
+
+    :param keep: list of bool, one per page of data. Pages with a False are not written.
+    :return: the number of pages skipped
+    """
+    view = memoryview(data)
+    skipped = 0
+    run_start = None
+    for i, page in enumerate(range(0, len(data), PAGE_SIZE)):
+        page_data = view[page:page + PAGE_SIZE]
+        if (keep is not None and not keep[i]) or page_data == ZERO_PAGE[:len(page_data)]:
+            skipped += 1
+            if run_start is not None:
+                os.pwrite(fd, view[run_start:page], offset + run_start)
+                run_start = None
+        elif run_start is None:
+            run_start = page
+    if run_start is not None:
+        os.pwrite(fd, view[run_start:], offset + run_start)
+    return skipped
+
+
+class _MappingFile(object):
+    """
+    The dump file of one mapping, shared by the writer threads.
+    Truncated to the mapping size, and closed when all its chunks are written.
+    """
+    def __init__(self, filename, size):
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.filename = filename
+        self.name = os.path.basename(filename)
+        # a chunk could not be read or written
+        self.failed = False
+        self._size = size
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._done = False
+
+    def add_chunk(self):
+        with self._lock:
+            self._pending += 1
+
+    def chunk_written(self):
+        with self._lock:
+            self._pending -= 1
+            self._close_if_done()
+
+    def finish(self):
+        with self._lock:
+            self._done = True
+            self._close_if_done()
+
+    def _close_if_done(self):
+        if self._done and self._pending == 0 and self.fd is not None:
+            # zero pages at the end are holes too
+            os.ftruncate(self.fd, self._size)
+            os.close(self.fd)
+            self.fd = None
+
 
 class MemoryDumper:
     """
@@ -29,16 +112,78 @@ class MemoryDumper:
     """
     ARCHIVE_TYPES = ["dir", "tar", "gztar"]
 
-    def __init__(self, pid, dest):
+    def __init__(self, pid, dest, chunk_size=DEFAULT_CHUNK_SIZE, writers=DEFAULT_WRITERS, base=None):
         self._pid = pid
         self._dest = os.path.normpath(dest)
+        # page aligned, for the page hashes
+        self._chunk_size = max(PAGE_SIZE, chunk_size - chunk_size % PAGE_SIZE)
+        if writers < 1:
+            raise ValueError('writers should be at least 1')
+        self._writers = writers
+        self._base = base
         self.dbg = None
         self._memory_handler = None
+        # bytes dumped, dump time and process pause time
+        self.stats = dict()
+        self._pause_start = None
+        # selective dump
+        self._include = []
+        self._permissions = None
+        self._anon_only = False
+        self._heaps_only = False
+        self._max_size = None
+        self._heap_starts = None
+
+    def set_filters(self, include=None, permissions=None, anon_only=False, heaps_only=False, max_size=None):
+        """
+        Only dump the content of some mappings. The other mappings are written in the index only,
+        and loaded as metadata.
+
+        A mapping content is dumped if it matches one of the selectors (if any):
+            - include: list of pathname glob patterns, or exact pathnames like '[stack]'
+            - heaps_only: the mappings used by the heaps found by the heap finder
+        and all the restrictions:
+            - permissions: str, the mapping has all these permissions. ex: 'rw'
+            - anon_only: the mapping is not backed by a file
+            - max_size: int, the mapping size is lower or equal
+        """
+        self._include = list(include or [])
+        self._permissions = permissions
+        self._anon_only = anon_only
+        self._heaps_only = heaps_only
+        self._max_size = max_size
+        self._heap_starts = None
+        return
+
+    def _get_heap_starts(self):
+        if self._heap_starts is None:
+            finder = self._memory_handler.get_heap_finder()
+            self._heap_starts = set()
+            for walker in finder.list_heap_walkers():
+                self._heap_starts.update(m.start for m in walker.list_used_mappings())
+            log.debug('%d heap mappings found', len(self._heap_starts))
+        return self._heap_starts
+
+    def _is_selected(self, m):
+        """ returns True if the mapping content should be dumped """
+        if self._permissions is not None and not all(p in m.permissions for p in self._permissions):
+            return False
+        if self._anon_only and m.pathname.startswith('/'):
+            return False
+        if self._max_size is not None and len(m) > self._max_size:
+            return False
+        if not self._include and not self._heaps_only:
+            return True
+        for pattern in self._include:
+            if m.pathname == pattern or fnmatch.fnmatchcase(m.pathname, pattern):
+                return True
+        return self._heaps_only and m.start in self._get_heap_starts()
 
     def make_mappings(self):
         """Connect the debugguer to the process and gets the memory mappings
         metadata."""
         self.dbg = dbg.get_debugger(self._pid)
+        self._pause_start = time.time()
         self._memory_handler = make_process_memory_handler(self.dbg.get_process())
         log.debug('Memory Mappings read. Dropping ptrace on pid.')
         return
@@ -77,9 +222,30 @@ class MemoryDumper:
 
     def _dump_all_mappings(self, destdir):
         """Iterates on all _memory_handler and dumps them to file."""
+        try:
+            mem_fd = os.open('/proc/%d/mem' % self._pid, os.O_RDONLY)
+        except (OSError, IOError):
+            mem_fd = None
+        if mem_fd is None or not hasattr(os, 'pread'):
+            log.debug('No /proc/%d/mem, reading through the debugger', self._pid)
+            if self._base is not None:
+                log.warning('Incremental dumps need /proc/%d/mem, making a full dump', self._pid)
+            return self._dump_all_mappings_buffered(destdir)
+        try:
+            self._dump_all_mappings_streaming(mem_fd, destdir)
+        finally:
+            os.close(mem_fd)
+        return
+
+    def _dump_all_mappings_buffered(self, destdir):
+        """Iterates on all _memory_handler and dumps them to file, one mapping buffer at a time."""
         self.index = open(os.path.join(destdir, 'mappings'), 'w+')
         err = 0
         for m in self._memory_handler:
+            if self._is_dumpable(m) and not self._is_selected(m):
+                log.debug('Metadata only for %s', m)
+                self._write_index_line(m)
+                continue
             try:
                 self._dump_mapping(m, destdir)
             except IOError as e:
@@ -90,24 +256,142 @@ class MemoryDumper:
         self.index.close()
         return
 
+    def _dump_all_mappings_streaming(self, mem_fd, destdir):
+        """
+        Reads all mappings by chunks from /proc/pid/mem, and hands the chunks to writer threads.
+        The bounded queue caps the memory used by the dumper.
+        Zero pages are not written, the mapping files are sparse.
+        With a base dump, only the pages that changed since the base dump are written.
+        """
+        chunks = queue.Queue(maxsize=self._writers * QUEUE_DEPTH)
+        errors = []
+        skipped_pages = []
+        delta_writer = delta.DeltaWriter(self._base)
+
+        def _writer():
+            while True:
+                item = chunks.get()
+                if item is None:
+                    break
+                mapping_file, offset, data = item
+                try:
+                    changed = delta_writer.update(mapping_file.name, offset, data)
+                    skipped_pages.append(write_sparse(mapping_file.fd, data, offset, changed))
+                except (OSError, IOError) as e:
+                    mapping_file.failed = True
+                    errors.append('%s: %s' % (mapping_file.name, e))
+                finally:
+                    mapping_file.chunk_written()
+
+        threads = [threading.Thread(target=_writer, name='dumper-writer-%d' % i) for i in range(self._writers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        t0 = time.time()
+        total = 0
+        err = 0
+        metadata_only = 0
+        # the mappings and their files, in the index order. None for metadata only.
+        dumped = []
+        try:
+            for m in self._memory_handler:
+                if not self._is_dumpable(m):
+                    continue
+                if not self._is_selected(m):
+                    log.debug('Metadata only for %s', m)
+                    metadata_only += 1
+                    dumped.append((m, None))
+                    continue
+                log.debug('Dump %s', m)
+                mapping_file = _MappingFile(os.path.join(destdir, self._get_mapping_filename(m)), len(m))
+                delta_writer.add_mapping(mapping_file.name, len(m))
+                try:
+                    for offset in range(0, len(m), self._chunk_size):
+                        size = min(self._chunk_size, len(m) - offset)
+                        data = os.pread(mem_fd, size, m.start + offset)
+                        if len(data) != size:
+                            raise IOError('short read at 0x%x' % (m.start + offset))
+                        mapping_file.add_chunk()
+                        chunks.put((mapping_file, offset, data))
+                        total += size
+                except (OSError, IOError) as e:
+                    mapping_file.failed = True
+                    log.warning('%s: %s', m, e)
+                finally:
+                    mapping_file.finish()
+                dumped.append((m, mapping_file))
+        finally:
+            for t in threads:
+                chunks.put(None)
+            for t in threads:
+                t.join()
+        for e in errors:
+            log.warning(e)
+        # the index only lists the mappings written completely
+        self.index = open(os.path.join(destdir, 'mappings'), 'w+')
+        try:
+            for m, mapping_file in dumped:
+                if mapping_file is not None and mapping_file.failed:
+                    err += 1
+                    os.remove(mapping_file.filename)
+                    delta_writer.discard_mapping(mapping_file.name)
+                    continue
+                self._write_index_line(m)
+        finally:
+            self.index.close()
+        delta_writer.save(destdir)
+        self.stats['changed_pages'] = delta_writer.changed_pages()
+        elapsed = time.time() - t0
+        self.stats['bytes'] = total
+        self.stats['skipped_pages'] = sum(skipped_pages)
+        self.stats['metadata_only'] = metadata_only
+        self.stats['dump_time'] = elapsed
+        self.stats['throughput'] = total / elapsed / (1024 * 1024) if elapsed else 0.
+        log.info('Dumped %d bytes in %0.2fs, %0.2f MB/s, %d zero or unchanged pages not written', total, elapsed,
+                 self.stats['throughput'], self.stats['skipped_pages'])
+        log.debug('%d mapping in error, destdir: %s', err, destdir)
+        return
+
     def _free_process(self):
         """continue() the process."""
         self.dbg.quit()
+        if self._pause_start is not None:
+            self.stats['pause_time'] = time.time() - self._pause_start
+            log.info('Process %d was paused for %0.2fs', self._pid, self.stats['pause_time'])
         return
 
-    def _dump_mapping(self, m, tmpdir):
-        """Dump one mapping to one file in one tmpdir."""
-        my_utils = self._memory_handler.get_target_platform().get_target_ctypes_utils()
+    def _is_dumpable(self, m):
         if m.permissions[0] != 'r':
             log.debug('Ignore read protected mapping %s', m)
-            return
+            return False
         elif m.pathname in ['[vdso]', '[vsyscall]', '[vvar]']:
             log.debug('Ignore system mapping %s', m)
-            return
-        # make filename
+            return False
+        return True
+
+    def _get_mapping_filename(self, m):
         # We don't really care about the filename but we need to be coherent.
-        mname = b'%s-%s' % (my_utils.formatAddress(m.start), my_utils.formatAddress(m.end))
-        mmap_fname = os.path.join(tmpdir, mname)
+        my_utils = self._memory_handler.get_target_platform().get_target_ctypes_utils()
+        return '%s-%s' % (my_utils.formatAddress(m.start), my_utils.formatAddress(m.end))
+
+    def _write_index_line(self, m):
+        """Dump the mapping metadata in the index."""
+        my_utils = self._memory_handler.get_target_platform().get_target_ctypes_utils()
+        start = my_utils.formatAddress(m.start)
+        end = my_utils.formatAddress(m.end)
+        perms = m.permissions
+        offset = '0x%0.8x' % m.offset
+        device = '%0.2x:%0.2x' % (m.major_device, m.minor_device)
+        inode = '%0.7d' % m.inode
+        text = ' '.join([start, end, perms, offset, device, inode, str(m.pathname)])
+        self.index.write('%s\n' % text)
+        return
+
+    def _dump_mapping(self, m, tmpdir):
+        """Dump one mapping to one file in one tmpdir."""
+        if not self._is_dumpable(m):
+            return
+        mmap_fname = os.path.join(tmpdir, self._get_mapping_filename(m))
         # dumping the memorymap
         log.debug('Dump %s', m)
         with open(mmap_fname, 'wb') as mmap_fout:
@@ -116,29 +400,49 @@ class MemoryDumper:
             except Exception as e:
                 raise IOError(e)
         # dump all the metadata
-        start = my_utils.formatAddress(m.start)
-        end =  my_utils.formatAddress(m.end)
-        perms = m.permissions
-        offset = '0x%0.8x' % m.offset
-        device = '%0.2x:%0.2x' % (m.major_device, m.minor_device)
-        inode = '%0.7d' % m.inode
-        text = ' '.join([start, end, perms, offset, device, inode, str(m.pathname)])
-        self.index.write('%s\n' % text)
+        self._write_index_line(m)
         return
 
 
-def dump(pid, outfile):
-    """Dumps a process memory to Haystack dump format."""
-    dumper = MemoryDumper(pid, outfile)
+def dump(pid, outfile, chunk_size=DEFAULT_CHUNK_SIZE, writers=DEFAULT_WRITERS, base=None, filters=None):
+    """Dumps a process memory to Haystack dump format.
+    With a base dump, only writes the pages that changed since the base dump.
+    filters are the keyword arguments of MemoryDumper.set_filters."""
+    dumper = MemoryDumper(pid, outfile, chunk_size=chunk_size, writers=writers, base=base)
+    if filters:
+        dumper.set_filters(**filters)
     dumper.make_mappings()
     dumper.dump()
     log.info('Process %d memory dumped to folder %s', pid, outfile)
     return outfile
 
 
+def make_archive(dumpname, archive_type):
+    """
+    Archive a folder dump to a tar or tar.gz file, and removes the folder.
+    The archive can be loaded without extracting it.
+
+    :return: the archive filename
+    """
+    if archive_type not in MemoryDumper.ARCHIVE_TYPES:
+        raise ValueError('archive_type should be one of %s' % ', '.join(MemoryDumper.ARCHIVE_TYPES))
+    if archive_type == 'dir':
+        return dumpname
+    dumpname = os.path.normpath(dumpname)
+    filename = shutil.make_archive(dumpname, archive_type, root_dir=os.path.dirname(os.path.abspath(dumpname)),
+                                   base_dir=os.path.basename(dumpname))
+    shutil.rmtree(dumpname)
+    log.info('Archived the dump to %s', filename)
+    return filename
+
+
 def _dump(opt):
     """Dumps a process memory _memory_handler to Haystack dump format."""
-    return dump(opt.pid, opt.dumpname)
+    filters = dict(include=opt.include, permissions=opt.permissions, anon_only=opt.anon_only,
+                   heaps_only=opt.heaps_only, max_size=opt.max_size)
+    dumpname = dump(opt.pid, opt.dumpname, chunk_size=opt.chunk_size, writers=opt.writers, base=opt.base,
+                    filters=filters)
+    return make_archive(dumpname, opt.archive)
 
 
 def argparser():
@@ -147,6 +451,25 @@ def argparser():
     dump_parser.add_argument('pid', type=int, action='store',
                              help='Target PID.')
     dump_parser.add_argument('dumpname', action='store', help='The dump name.')
+    dump_parser.add_argument('--chunk-size', type=int, action='store', default=DEFAULT_CHUNK_SIZE,
+                             help='Read the process memory by chunks of that size.')
+    dump_parser.add_argument('--writers', type=argparse_utils.positive_int, action='store', default=DEFAULT_WRITERS,
+                             help='Number of threads writing the dump files.')
+    dump_parser.add_argument('--archive', action='store', default='dir', choices=MemoryDumper.ARCHIVE_TYPES,
+                             help='Archive the dump folder in a tar or tar.gz file.')
+    dump_parser.add_argument('--base', action='store', default=None,
+                             help='A previous dump of that process. Only the pages changed since are written.')
+    selection = dump_parser.add_argument_group('selective dump', 'The content of the other mappings is not dumped.')
+    selection.add_argument('--include', action='append', default=[], metavar='GLOB',
+                           help='Dump the mappings with a matching pathname. ex: "[stack]", "*libc*"')
+    selection.add_argument('--heaps-only', action='store_true', default=False,
+                           help='Dump the mappings used by the heaps found by the heap finder.')
+    selection.add_argument('--permissions', action='store', default=None,
+                           help='Only dump mappings with these permissions. ex: rw')
+    selection.add_argument('--anon-only', action='store_true', default=False,
+                           help='Only dump mappings not backed by a file.')
+    selection.add_argument('--max-size', type=int, action='store', default=None,
+                           help='Only dump mappings up to that size.')
     dump_parser.set_defaults(func=_dump)
 
     return dump_parser
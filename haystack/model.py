@@ -5,6 +5,7 @@ import inspect
 import sys
 import logging
 import importlib
+import threading
 
 """
 Defines
@@ -70,6 +71,10 @@ class Model(object):
         """Clean the book"""
         log.info('RESET MODEL')
         self.__book = dict()
+        self.__modules = dict()
+        # the next import_module imports from source
+        clear_imported_modules()
+        clear_numpy_dtypes()
         # FIXME: that is probably useless now.
         for mod in list(sys.modules.keys()):
             if 'haystack.reverse' in mod:
@@ -168,6 +173,7 @@ class Model(object):
     def import_module(self, module_name):
         """
         Import the python ctypes module with this target ctypes platform.
+        The module is shared with the other Model instances of the same target ctypes.
 
         :param module_name:
         :return:
@@ -188,6 +194,15 @@ class Model(object):
         """
         return self.__modules[name]
 
+    def get_numpy_dtype(self, record_type):
+        """
+        Returns the numpy structured dtype of a ctypes record of this target ctypes.
+
+        :param record_type: a ctypes Structure or Union type
+        :return: numpy.dtype
+        """
+        return get_numpy_dtype(record_type, self._ctypes)
+
 
 def copy_generated_classes(src_module, dst_module):
     """Copies the ctypes Records of a module into another module.
@@ -218,27 +233,131 @@ def copy_generated_classes(src_module, dst_module):
     return
 
 
+# modules imported for a target ctypes, by (module name, ctypes signature)
+__IMPORTED_MODULES = {}
+# sys.modules['ctypes'] is swapped during the import
+__IMPORT_LOCK = threading.RLock()
+
+
+def get_ctypes_signature(target_ctypes):
+    """Returns the (long, pointer, long double) sizes of a ctypes module"""
+    return (target_ctypes.sizeof(target_ctypes.c_long),
+            target_ctypes.sizeof(target_ctypes.c_void_p),
+            target_ctypes.sizeof(target_ctypes.c_longdouble))
+
+
+def clear_imported_modules():
+    """Forget the modules imported for a target ctypes. They will be imported from source again."""
+    with __IMPORT_LOCK:
+        __IMPORTED_MODULES.clear()
+
+
 def import_module_for_target_ctypes(module_name, target_ctypes):
     """
     Import the python ctypes module for a specific ctypes platform.
+    The module is imported once per process for each ctypes signature.
 
     :param module_name: module
     :param _target: ICTypesProxy
     :return:
     """
-    # save ctypes
-    real_ctypes = sys.modules['ctypes']
-    sys.modules['ctypes'] = target_ctypes
-    if module_name in sys.modules:
-        del sys.modules[module_name]
-    my_module = None
-    try:
-        # try to load that module with our ctypes proxy
-        my_module = importlib.import_module(module_name)
-        # FIXME debug and TU this to be sure it is removed from modules
-        #if module_name in sys.modules:
-        #    del sys.modules[module_name]
-    finally:
-        # always clean up
-        sys.modules['ctypes'] = real_ctypes
+    key = (module_name, get_ctypes_signature(target_ctypes))
+    # sys.modules is shared by all threads
+    with __IMPORT_LOCK:
+        if key in __IMPORTED_MODULES:
+            return __IMPORTED_MODULES[key]
+        # save ctypes
+        real_ctypes = sys.modules['ctypes']
+        sys.modules['ctypes'] = target_ctypes
+        if module_name in sys.modules:
+            del sys.modules[module_name]
+        my_module = None
+        try:
+            # try to load that module with our ctypes proxy
+            my_module = importlib.import_module(module_name)
+            # FIXME debug and TU this to be sure it is removed from modules
+            #if module_name in sys.modules:
+            #    del sys.modules[module_name]
+        finally:
+            # always clean up
+            sys.modules['ctypes'] = real_ctypes
+        __IMPORTED_MODULES[key] = my_module
     return my_module
+
+
+# numpy dtypes of the ctypes types, by type
+__NUMPY_DTYPES = {}
+__NUMPY_DTYPES_LOCK = threading.Lock()
+# ctypes simple type codes of signed, unsigned and floating point numbers
+__NUMPY_KINDS = dict([(c, 'i') for c in 'bhilq'] + [(c, 'u') for c in 'BHILQ'] + [(c, 'f') for c in 'fdg'])
+
+
+def clear_numpy_dtypes():
+    """Forget the numpy dtypes made for the ctypes types"""
+    with __NUMPY_DTYPES_LOCK:
+        __NUMPY_DTYPES.clear()
+
+
+def get_numpy_dtype(ctypes_type, target_ctypes):
+    """
+    Returns the numpy dtype of a ctypes type of that target ctypes.
+    The records are numpy structured dtypes with the ctypes fields offsets and record size.
+    Pointers are unsigned integers of the target pointer size. Bit fields are ignored.
+    A field whose size in the record differs from the size of its type is kept as raw bytes,
+    or ignored if it has no size.
+
+    :param ctypes_type: a ctypes type
+    :param target_ctypes: the ICTypesProxy of ctypes_type
+    :return: numpy.dtype
+    """
+    with __NUMPY_DTYPES_LOCK:
+        if ctypes_type not in __NUMPY_DTYPES:
+            __NUMPY_DTYPES[ctypes_type] = _make_numpy_dtype(ctypes_type, target_ctypes)
+        return __NUMPY_DTYPES[ctypes_type]
+
+
+def _make_numpy_dtype(ctypes_type, target_ctypes):
+    # numpy is only needed by the bulk readers
+    import numpy
+    size = target_ctypes.sizeof(ctypes_type)
+    if ctypes_type is target_ctypes.c_longdouble and size != ctypes.sizeof(ctypes.c_longdouble):
+        # an emulated long double, keep the bytes
+        return numpy.dtype('V%d' % size)
+    elif issubclass(ctypes_type, (ctypes.Structure, ctypes.Union)):
+        names = []
+        formats = []
+        offsets = []
+        for field in ctypes_type._fields_:
+            if len(field) > 2:
+                log.debug('%s.%s: bit fields are ignored', ctypes_type.__name__, field[0])
+                continue
+            name, field_type = field
+            descriptor = getattr(ctypes_type, name)
+            field_dtype = _make_numpy_dtype(field_type, target_ctypes)
+            if field_dtype.itemsize != descriptor.size:
+                # a field declared while its type was incomplete has a different size in the record
+                log.debug('%s.%s: %d bytes in the record, the type is %d bytes', ctypes_type.__name__, name,
+                          descriptor.size, field_dtype.itemsize)
+                if descriptor.size == 0:
+                    continue
+                field_dtype = numpy.dtype('V%d' % descriptor.size)
+            names.append(name)
+            formats.append(field_dtype)
+            offsets.append(descriptor.offset)
+        return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': size})
+    elif issubclass(ctypes_type, ctypes.Array) and getattr(ctypes_type._type_, '_type_', None) == 'c':
+        # a char array is a string
+        return numpy.dtype('S%d' % ctypes_type._length_)
+    elif issubclass(ctypes_type, ctypes.Array):
+        return numpy.dtype((_make_numpy_dtype(ctypes_type._type_, target_ctypes), (ctypes_type._length_,)))
+    elif target_ctypes.is_pointer_type(ctypes_type) or ctypes_type in [target_ctypes.c_char_p, target_ctypes.c_void_p]:
+        return numpy.dtype('u%d' % size)
+    type_code = getattr(ctypes_type, '_type_', None)
+    if type_code in __NUMPY_KINDS:
+        return numpy.dtype('%s%d' % (__NUMPY_KINDS[type_code], size))
+    elif type_code == '?':
+        return numpy.dtype(bool)
+    elif type_code == 'c':
+        return numpy.dtype('S1')
+    # c_wchar and others, keep the bytes
+    return numpy.dtype('V%d' % size)
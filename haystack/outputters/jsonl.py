@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+"""
+This class streams the results as JSON lines, straight from the ctypes records.
+
+Each result is written as soon as it is encoded, on its own line:
+    {"address": 1234, "type": "struct_Node", "value": {"field": ..., ...}}
+
+A pointer field value is:
+ - null for a null pointer,
+ - the pointee record, the first time a loaded record is reached,
+ - {"$ref": address} when that record was already written, in this line or a previous line,
+ - the pointee address, when the pointee is not a loaded record.
+"""
+
+import json
+import logging
+
+from haystack.outputters import Outputter
+from haystack import basicmodel
+
+
+log = logging.getLogger('jsonl')
+
+# kinds of fields
+BASIC, RECORD, BASIC_ARRAY, ARRAY, CSTRING, FUNCTION, POINTER, OTHER = range(8)
+
+
+class JSONLinesOutputter(Outputter):
+
+    """ Writes ctypes records as JSON lines. Only the addresses of the records already written are kept. """
+
+    def __init__(self, memory_handler):
+        super(JSONLinesOutputter, self).__init__(memory_handler)
+        # record type: list of (field name, kind, field type)
+        self._layouts = {}
+        # (record type, address) of the records already written
+        self._written = set()
+
+    def write(self, results, stream, depth=50):
+        """
+        Writes one JSON line per result.
+
+        :param results: iterable of (ctypes record, address)
+        :param stream: a text file object
+        :return: the number of results written
+        """
+        count = 0
+        for record, addr in results:
+            stream.write(self.encode(record, addr, depth))
+            stream.write('\n')
+            count += 1
+        return count
+
+    def encode(self, record, addr, depth=50):
+        """ Returns the JSON line of a result, without the end of line. """
+        self._written.add((type(record), addr))
+        line = {'address': addr,
+                'type': type(record).__name__,
+                'value': self.parse(record, depth=depth)}
+        return json.dumps(line)
+
+    def parse(self, obj, prefix='', depth=50):
+        """ Returns the fields of a record in a dict """
+        ret = {}
+        for field, kind, attrtype in self._get_layout(type(obj)):
+            ret[field] = self._encode_value(getattr(obj, field), kind, attrtype, depth)
+        return ret
+
+    def _get_layout(self, record_type):
+        if record_type not in self._layouts:
+            layout = []
+            for field, attrtype in basicmodel.get_record_type_fields(record_type):
+                layout.append((field, self._get_kind(attrtype), attrtype))
+            self._layouts[record_type] = layout
+        return self._layouts[record_type]
+
+    def _get_kind(self, attrtype):
+        if self._ctypes.is_basic_type(attrtype):
+            return BASIC
+        elif self._ctypes.is_struct_type(attrtype) or self._ctypes.is_union_type(attrtype):
+            return RECORD
+        elif self._ctypes.is_array_of_basic_type(attrtype):
+            return BASIC_ARRAY
+        elif self._ctypes.is_array_type(attrtype):
+            return ARRAY
+        elif self._ctypes.is_cstring_type(attrtype):
+            return CSTRING
+        elif self._ctypes.is_function_type(attrtype):
+            return FUNCTION
+        elif self._ctypes.is_pointer_type(attrtype):
+            return POINTER
+        return OTHER
+
+    def _encode_value(self, attr, kind, attrtype, depth):
+        if kind == BASIC:
+            value = attr.value if self._ctypes.is_basic_ctype(type(attr)) else attr
+            return self._encode_bytes(value)
+        elif kind == RECORD:
+            return self.parse(attr, depth=depth)
+        elif kind == BASIC_ARRAY:
+            if isinstance(attr, bytes):
+                # char[]
+                return self._encode_bytes(attr)
+            return [self._encode_bytes(el) for el in attr]
+        elif kind == ARRAY:
+            eltype = attrtype._type_
+            elkind = self._get_kind(eltype)
+            return [self._encode_value(el, elkind, eltype, depth) for el in attr]
+        elif kind == CSTRING:
+            addr = self._utils.get_pointee_address(attr.ptr)
+            if addr == 0:
+                return None
+            string = self._memory_handler.getRef(self._ctypes.CString, addr)
+            if string is None:
+                return addr
+            return self._encode_bytes(string)
+        elif kind == FUNCTION:
+            return self._utils.get_pointee_address(attr)
+        elif kind == POINTER:
+            addr = self._utils.get_pointee_address(attr)
+            if addr == 0:
+                return None
+            if self._ctypes.is_pointer_to_void_type(attrtype):
+                return addr
+            subtype = self._utils.get_subtype(attrtype)
+            if (subtype, addr) in self._written:
+                return {'$ref': addr}
+            pointee = self._memory_handler.getRef(subtype, addr)
+            if pointee is None or depth <= 0 or not self._ctypes.is_struct_type(type(pointee)) \
+                    and not self._ctypes.is_union_type(type(pointee)):
+                return addr
+            self._written.add((subtype, addr))
+            return self.parse(pointee, depth=depth - 1)
+        log.debug('default to the repr of %s', type(attr))
+        return repr(attr)
+
+    def _encode_bytes(self, value):
+        if isinstance(value, bytes):
+            return value.decode('latin-1')
+        return value
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Discovery of the haystack plugins: memory mappings loaders and heap finders.
+
+Plugins are declared as entry points of the haystack.mappings_loader and haystack.heap_finder groups.
+The entry points are read with importlib.metadata, once, and cached on disk until a python path
+folder changes. A plugin module is only imported when the plugin is used.
+
+Usage:
+    loaders = plugins.PluginRegistry(plugins.MAPPINGS_LOADER_GROUP, plugins.BUILTIN_MAPPINGS_LOADERS)
+    if 'dir' in loaders:
+        loader = loaders['dir'](opts)
+"""
+
+from __future__ import print_function
+
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__status__ = "Production"
+
+log = logging.getLogger('plugins')
+
+MAPPINGS_LOADER_GROUP = 'haystack.mappings_loader'
+HEAP_FINDER_GROUP = 'haystack.heap_finder'
+
+# the plugins shipped with haystack, usable from a source checkout
+BUILTIN_MAPPINGS_LOADERS = {
+    'dir': 'haystack.mappings.folder:FolderLoader',
+    'hsd': 'haystack.mappings.container:ContainerLoader',
+    'tar': 'haystack.mappings.archive:TarLoader',
+    'core': 'haystack.mappings.core:CoreLoader',
+    'dmp': 'haystack.mappings.minidump:DMPLoader',
+    'volatility': 'haystack.mappings.vol:VolatilityLoader',
+    'rekall': 'haystack.mappings.rek:RekallLoader',
+    'live': 'haystack.mappings.process:ProcessLoader',
+    'frida': 'haystack.mappings.fridaprocess:FridaLoader',
+    'cuckoo': 'haystack.mappings.cuckoo:CuckooProcessLoader',
+}
+BUILTIN_HEAP_FINDERS = {
+    'ptmalloc2': 'haystack.allocators.libc.libcheapwalker:LibcHeapFinder',
+    'winxp': 'haystack.allocators.win32.winxpheapwalker:WinXPHeapFinder',
+    'win7': 'haystack.allocators.win32.win7heapwalker:Win7HeapFinder',
+}
+
+# change it when the file layout changes
+CACHE_FORMAT = 1
+CACHE_FILENAME = 'plugins.json'
+
+
+def get_cache_filename():
+    """Returns the entry points cache file name"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'haystack', CACHE_FILENAME)
+
+
+def _make_path_fingerprint():
+    """Installing or removing a distribution changes the mtime of its python path folder"""
+    fingerprint = []
+    for path in sys.path:
+        try:
+            fingerprint.append([path, int(os.stat(path or '.').st_mtime)])
+        except OSError:
+            fingerprint.append([path, None])
+    return fingerprint
+
+
+def _read_entry_points(groups):
+    """
+    Reads the entry points of these groups from the installed distributions.
+
+    :return: dict(group, dict(name, 'module:attr'))
+    """
+    entry_points = dict([(group, dict()) for group in groups])
+    try:
+        from importlib import metadata
+    except ImportError:
+        # python 2
+        import pkg_resources
+        for group in groups:
+            for ep in pkg_resources.iter_entry_points(group):
+                entry_points[group][ep.name] = '%s:%s' % (ep.module_name, '.'.join(ep.attrs))
+        return entry_points
+    all_entry_points = metadata.entry_points()
+    for group in groups:
+        if hasattr(all_entry_points, 'select'):
+            selected = all_entry_points.select(group=group)
+        else:
+            # python < 3.10
+            selected = all_entry_points.get(group, [])
+        for ep in selected:
+            entry_points[group][ep.name] = ep.value
+    return entry_points
+
+
+def _load_cache(filename, fingerprint):
+    try:
+        with open(filename) as fin:
+            data = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get('format') != CACHE_FORMAT or data.get('fingerprint') != fingerprint:
+        return None
+    return data['entry_points']
+
+
+def _save_cache(filename, fingerprint, entry_points):
+    data = {'format': CACHE_FORMAT,
+            'fingerprint': fingerprint,
+            'entry_points': entry_points}
+    try:
+        folder = os.path.dirname(filename)
+        if not os.access(folder, os.F_OK):
+            os.makedirs(folder)
+        # write to a temporary file, then rename.
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as fout:
+            json.dump(data, fout)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as e:
+        log.debug('Could not write the plugins cache %s: %s', filename, e)
+    return
+
+
+__ENTRY_POINTS = None
+__ENTRY_POINTS_LOCK = threading.Lock()
+
+
+def get_entry_points(group):
+    """
+    Returns the entry points of that group, read once per process, and cached on disk.
+
+    :return: dict(name, 'module:attr')
+    """
+    global __ENTRY_POINTS
+    with __ENTRY_POINTS_LOCK:
+        if __ENTRY_POINTS is None:
+            groups = [MAPPINGS_LOADER_GROUP, HEAP_FINDER_GROUP]
+            filename = get_cache_filename()
+            fingerprint = _make_path_fingerprint()
+            entry_points = _load_cache(filename, fingerprint)
+            if entry_points is None:
+                log.debug('Reading the plugins entry points')
+                entry_points = _read_entry_points(groups)
+                _save_cache(filename, fingerprint, entry_points)
+            __ENTRY_POINTS = entry_points
+        if group not in __ENTRY_POINTS:
+            __ENTRY_POINTS[group] = _read_entry_points([group])[group]
+        return dict(__ENTRY_POINTS[group])
+
+
+def clear_entry_points():
+    """Forget the entry points read in this process"""
+    global __ENTRY_POINTS
+    with __ENTRY_POINTS_LOCK:
+        __ENTRY_POINTS = None
+
+
+def load_object(spec):
+    """Imports a 'module:attr' object"""
+    module_name, _, attrs = spec.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in attrs.split('.'):
+        if attr:
+            obj = getattr(obj, attr)
+    return obj
+
+
+class PluginRegistry(object):
+    """
+    The plugins of an entry points group, by name.
+    The entry points of installed distributions override the builtin plugins.
+    A plugin is imported on first access.
+    """
+    def __init__(self, group, builtins=None):
+        self._group = group
+        self._builtins = dict(builtins or {})
+        self._specs = None
+        self._plugins = dict()
+        self._lock = threading.Lock()
+
+    def _get_specs(self):
+        if self._specs is None:
+            specs = dict(self._builtins)
+            specs.update(get_entry_points(self._group))
+            self._specs = specs
+        return self._specs
+
+    def keys(self):
+        return list(self._get_specs().keys())
+
+    def __contains__(self, name):
+        return name in self._get_specs()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._get_specs())
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._plugins:
+                self._plugins[name] = load_object(self._get_specs()[name])
+            return self._plugins[name]
+
+    def __setitem__(self, name, plugin):
+        """Registers a plugin object"""
+        with self._lock:
+            self._get_specs()[name] = None
+            self._plugins[name] = plugin
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+    def get_spec(self, name):
+        """Returns the 'module:attr' of a plugin, without importing it"""
+        return self._get_specs()[name]
@@ -9,6 +9,7 @@ import json
 from haystack.search import searcher
 from haystack.outputters import text
 from haystack.outputters import python
+from haystack.outputters import jsonl
 from haystack import listmodel
 
 log = logging.getLogger('api')
@@ -124,6 +125,19 @@ def output_to_json(memory_handler, results):
     return json.dumps(ret, default=python.json_encode_pyobj)
 
 
+def output_to_json_lines(memory_handler, results, stream):
+    """
+    Writes ctypes results to a stream in a json lines format, one json object per result.
+    The results are encoded one by one, and a record that was already written is a {"$ref": address}.
+    :param memory_handler: IMemoryHandler
+    :param results: an iterable of results from the search_record
+    :param stream: a text file object
+    :return: the number of results written
+    """
+    parser = jsonl.JSONLinesOutputter(memory_handler)
+    return parser.write(results, stream)
+
+
 def output_to_pickle(memory_handler, results):
     """
     Transform ctypes results in a pickled format.
@@ -194,15 +194,17 @@ class AnyOffsetRecordSearcher(RecordSearcher):
         start = mem_map.start
         end = mem_map.end
         # pointer len for alignment
-        plen = mem_map.get_target_platform().get_word_size()
+        my_target = self._memory_handler.get_target_platform()
+        plen = my_target.get_word_size()
         # # check the word size to use aligned words only
         if align is None:
             align = plen
         else:
             align = align - align % plen
         # the struct cannot fit after that point.
-        my_ctypes = mem_map.get_target_platform().get_target_ctypes()
-        end = end - my_ctypes.sizeof(struct_type) + 1
+        my_ctypes = my_target.get_target_ctypes()
+        struct_size = my_ctypes.sizeof(struct_type)
+        end = end - struct_size + 1
         if end <= start:
             raise ValueError("The record is too big for this memory mapping")
         log.debug("scanning 0x%lx --> 0x%lx %s every %d bytes", start, end, mem_map.pathname, plen)
@@ -211,8 +213,7 @@ class AnyOffsetRecordSearcher(RecordSearcher):
         # parse for structType on each aligned word
         t0 = time.time()
         p = 0
-        # python 2.7 xrange doesn't handle long int. replace with ours.
-        for offset in utils.xrange(start, end, align):
+        for offset in self._iter_offsets(mem_map, start, end, align, struct_size):
             # print a debug message every now and then
             if offset % (1024 << 6) == 0:
                 p2 = offset - start
@@ -232,3 +233,15 @@ class AnyOffsetRecordSearcher(RecordSearcher):
                     log.debug('_search_in: Found enough instance.')
                     break
         return outputs
+
+    def _iter_offsets(self, mem_map, start, end, align, struct_size):
+        """
+        Iterates on the aligned offsets in [start, end), skipping the offsets where the record
+        would only cover zero pages.
+        """
+        for r_start, r_end in mem_map.get_present_ranges(margin=struct_size - 1):
+            # keep the offsets aligned on the mapping start
+            r_start = start + (max(r_start, start) - start + align - 1) // align * align
+            # python 2.7 xrange doesn't handle long int. replace with ours.
+            for offset in utils.xrange(r_start, min(r_end, end), align):
+                yield offset
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
+import os
 import platform
 import struct
 import sys
+import time
 
+import haystack
 from haystack import types
 from haystack import utils
 from haystack.abc import interfaces
+from haystack.allocators import heapindex
 
 
 log = logging.getLogger("target")
@@ -22,6 +27,16 @@ TARGET_TRIPLETS = [
 ]
 
 
+# the number of mappings read by the os and cpu detection
+MAX_PROBED_MAPPINGS = 16
+# the images that identify the target, probed first
+PRIORITY_PATHNAMES = ['ntdll.dll', 'kernel32.dll', 'libc.so', 'libc-', 'ld-linux', 'ld-2.']
+# the detection verdict is saved in <dumpname>.d/target.json
+DETECTION_FILENAME = 'target.json'
+# change it when the file layout changes
+DETECTION_FORMAT = 1
+
+
 class TargetPlatform(interfaces.ITargetPlatform):
     """The guest platform information for the process memory handled by IMemoryHandler.
     Immutable, its characteristics should be set once at creation time.
@@ -30,7 +45,11 @@ class TargetPlatform(interfaces.ITargetPlatform):
     WIN7 = 'win7'
     LINUX = 'linux'
 
-    def __init__(self, mappings, os_name=None, cpu_bits=None, word_size=None, ptr_size=None, ld_size=None):
+    def __init__(self, mappings, os_name=None, cpu_bits=None, word_size=None, ptr_size=None, ld_size=None,
+                 cache_name=None):
+        """
+        :param cache_name: the dump name. The detection verdict is cached in <cache_name>.d/
+        """
         if mappings is None:
             # we cant detect the os_name and cpu_bits without _memory_mappings
             assert os_name is not None and cpu_bits is not None
@@ -40,17 +59,62 @@ class TargetPlatform(interfaces.ITargetPlatform):
             raise TypeError("list with at least one IMemoryMapping expected")
         elif not isinstance(mappings[0], interfaces.IMemoryMapping):
             raise TypeError("IMemoryMapping list expected")
-        self.__os_name = os_name or self._detect_os(mappings)
-        self.__cpu_bits = cpu_bits or self._detect_cpu(mappings, self.__os_name)
-        self.__word_size = word_size or self._detect_word_size()
-        self.__ptr_size = ptr_size or self._detect_ptr_size()
-        self.__ld_size = ld_size or self._detect_ld_size()  # long double
+        self.__report = []
+        ties = []
+        cached = None
+        if mappings is not None and cache_name is not None and (os_name is None or cpu_bits is None):
+            cached = _load_detection(cache_name, mappings)
+            if cached is not None and (os_name or cached['os_name']) != cached['os_name']:
+                cached = None
+            if cached is not None and (cpu_bits or cached['cpu_bits']) != cached['cpu_bits']:
+                cached = None
+        self.__os_name = self._run_step('os_name', os_name, cached,
+                                        lambda probes: self._detect_os(mappings, probes, ties))
+        self.__cpu_bits = self._run_step('cpu_bits', cpu_bits, cached,
+                                         lambda probes: self._detect_cpu(mappings, self.__os_name, probes))
+        self.__word_size = self._run_step('word_size', word_size, cached, lambda probes: self._detect_word_size())
+        self.__ptr_size = self._run_step('ptr_size', ptr_size, cached, lambda probes: self._detect_ptr_size())
+        # long double
+        self.__ld_size = self._run_step('ld_size', ld_size, cached, lambda probes: self._detect_ld_size())
         # win  32 bits, 4,4,8
         # linux 32 bits, 4,4,12
         # linux 64 bits, 8,8,16
         self.__ctypes_proxy = types.build_ctypes_proxy(self.__word_size, self.__ptr_size, self.__ld_size)
+        # only save a verdict that was not forced by the user, nor reached by a tie
+        if cache_name is not None and cached is None and os_name is None and cpu_bits is None and not ties:
+            _save_detection(cache_name, mappings, self._get_verdict())
         pass
 
+    def _run_step(self, name, value, cached, detect):
+        """Returns the forced, cached or detected value of a platform characteristic"""
+        t0 = time.time()
+        probes = []
+        if value:
+            source = 'forced'
+        elif cached is not None:
+            source = 'cached'
+            value = cached[name]
+        else:
+            source = 'detected'
+            value = detect(probes)
+        self.__report.append((name, value, source, time.time() - t0, len(probes)))
+        return value
+
+    def _get_verdict(self):
+        return {'os_name': self.__os_name,
+                'cpu_bits': self.__cpu_bits,
+                'word_size': self.__word_size,
+                'ptr_size': self.__ptr_size,
+                'ld_size': self.__ld_size}
+
+    def get_detection_report(self):
+        """
+        Returns how each characteristic of the platform was found.
+
+        :return: list of (name, value, 'forced'|'cached'|'detected', seconds, number of mappings read)
+        """
+        return list(self.__report)
+
     def get_os_name(self):
         return self.__os_name
 
@@ -62,8 +126,8 @@ class TargetPlatform(interfaces.ITargetPlatform):
         return self.__ctypes_proxy
 
     def get_target_ctypes_utils(self):
-        """Returns the ctypes proxy instance adequate for the target process' platform """
-        return utils.Utils(self.__ctypes_proxy)
+        """Returns the ctypes utils instance adequate for the target process' platform """
+        return utils.get_ctypes_utils(self.__ctypes_proxy)
 
     def get_word_size(self):
         return self.__word_size
@@ -90,8 +154,45 @@ class TargetPlatform(interfaces.ITargetPlatform):
         return 'Target: OS:%s CPU:%s WordSize:%d' % (self.get_os_name(), self.get_cpu_bits(), self.get_word_size())
 
     @classmethod
-    def _detect_os(cls, mappings):
-        """Arch independent way to assess the os of a captured process"""
+    def _probe_mappings(cls, mappings):
+        """
+        Returns the mappings most likely to start with an executable image header, best first.
+        ntdll, kernel32, libc and the loader first, then the executable images, then the other file mappings.
+        """
+        def priority(m):
+            pathname = (m.pathname or '').lower()
+            for i, name in enumerate(PRIORITY_PATHNAMES):
+                if name in pathname:
+                    return 0, i, m.offset != 0
+            if pathname == '' or pathname[0] == '[':
+                return 3, 0, False
+            if m.offset != 0:
+                return 2, 0, False
+            if 'x' in m.permissions:
+                return 1, 0, False
+            return 2, 0, False
+        return sorted(mappings, key=priority)[:MAX_PROBED_MAPPINGS]
+
+    @classmethod
+    def _heap_candidates(cls, mappings):
+        """
+        Returns the mappings that could start with a windows heap, the writable ones first.
+        The mappings that are file images, or whose first page was not dumped, are ignored.
+        """
+        candidates = [m for m in mappings if len(m) >= 0x1000 and
+                      '/' not in (m.pathname or '') and '\\' not in (m.pathname or '') and
+                      m.get_page_presence()[0]]
+        return sorted(candidates, key=lambda m: 'w' not in m.permissions)
+
+    @classmethod
+    def _detect_os(cls, mappings, probes=None, ties=None):
+        """
+        Arch independent way to assess the os of a captured process
+
+        :param ties: a list, filled with the os names that had the best score, if there is more than one
+        """
+        if probes is None:
+            probes = []
         scores = {'linux': 0, 'winxp': 0, 'win7': 0}
         for pathname in [m.pathname.lower() for m in mappings
                          if m.pathname is not None and m.pathname != '']:
@@ -101,11 +202,11 @@ class TargetPlatform(interfaces.ITargetPlatform):
             if 'ntdll.dll' in pathname:
                 scores['winxp'] += 1
                 scores['win7'] += 1
-            elif 'Documents and Settings' in pathname:
+            elif 'documents and settings' in pathname:
                 scores['winxp'] += 1
             elif 'xpsp2res.dll' in pathname:
                 scores['winxp'] += 1
-            elif 'SysWOW64' in pathname:
+            elif 'syswow64' in pathname:
                 scores['win7'] += 1
             elif '\\wer.dll' in pathname:
                 scores['win7'] += 1
@@ -117,29 +218,46 @@ class TargetPlatform(interfaces.ITargetPlatform):
                 scores['linux'] += 1
             elif '/' == pathname[0]:
                 scores['linux'] += 1
-        for m in mappings:
-            # winxp versus win7 - try out heap Signature
-            for os_name, bits, offset in [('winxp', 32, 8), ('winxp', 64, 16), ('win7', 32, 100), ('win7', 64, 160)]:
-                signature = struct.unpack('I', m.read_bytes(m.start+offset, 4))[0]
-                if signature == 0xeeffeeff:
-                    scores[os_name] += 1
+        # winxp versus win7 - try out the heap signature of the mappings that are not file images,
+        # until one is found. Only the head of each mapping is read.
+        if scores['linux'] <= scores['winxp']:
+            for m in cls._heap_candidates(mappings):
+                probes.append(m)
+                try:
+                    head = m.read_bytes(m.start, 164)
+                except Exception as e:
+                    log.debug('read_bytes failed on %s: %s', m, e)
+                    continue
+                found = False
+                for os_name, bits, offset in [('winxp', 32, 8), ('winxp', 64, 16), ('win7', 32, 100), ('win7', 64, 160)]:
+                    signature = struct.unpack('I', head[offset:offset + 4])[0]
+                    if signature == 0xeeffeeff:
+                        scores[os_name] += 1
+                        found = True
+                if found:
+                    break
         # if nothing is found that way, try pefile detection
         # volatility case usually
-        if scores.values() == [0, 0, 0]:
+        if sum(scores.values()) == 0:
             try:
-                cls._detect_cpu_arch_pe(mappings)
+                cls._detect_cpu_arch_pe(mappings, probes)
                 scores['winxp'] += 1
                 scores['win7'] += 1
-            except NotImplementedError as e:
+            except (NotImplementedError, ImportError) as e:
                 pass
             try:
-                cls._detect_cpu_arch_elf(mappings)
+                cls._detect_cpu_arch_elf(mappings, probes)
                 scores['linux'] += 1
             except NotImplementedError as e:
                 pass
 
         log.debug('detect_os: scores linux:%d winxp:%d win7:%d', scores['linux'], scores['winxp'], scores['win7'])
         res = sorted(scores.items(), key=lambda x: x[1], reverse=True)[0]
+        best = [os_name for os_name, score in scores.items() if score == res[1]]
+        if len(best) > 1:
+            log.info('detect_os: %s have the same score, choosing %s', ', '.join(sorted(best)), res[0])
+            if ties is not None:
+                ties.extend(best)
         if res[0] == 'linux':
             return cls.LINUX
         elif res[0] == 'winxp':
@@ -148,36 +266,41 @@ class TargetPlatform(interfaces.ITargetPlatform):
             return cls.WIN7
 
     @classmethod
-    def _detect_cpu(cls, mappings, os_name=None):
+    def _detect_cpu(cls, mappings, os_name=None, probes=None):
         if os_name is None:
-            os_name = cls._detect_os(mappings)
+            os_name = cls._detect_os(mappings, probes)
         cpu = 'unknown'
         if os_name == cls.LINUX:
-            cpu = cls._detect_cpu_arch_elf(mappings)
+            cpu = cls._detect_cpu_arch_elf(mappings, probes)
         elif os_name == cls.WINXP or os_name == cls.WIN7:
-            cpu = cls._detect_cpu_arch_pe(mappings)
+            cpu = cls._detect_cpu_arch_pe(mappings, probes)
         return cpu
 
     @classmethod
-    def _detect_cpu_arch_pe(cls, mappings):
+    def _detect_cpu_arch_pe(cls, mappings, probes=None):
         import pefile
-        # get the maps with read-only data
+        if probes is None:
+            probes = []
         # find the executable image and get the PE header
+        # volatility dumps VAD differently than winappdbg, so permissions are not reliable
         pe = None
-        for m in mappings:
-            # volatility dumps VAD differently than winappdbg
-            # we have to look at all _memory_handler
-            # if m.permissions != 'r--':
-            #    continue
+        for m in cls._probe_mappings(mappings):
+            probes.append(m)
+            try:
+                head = m.read_bytes(m.start, min(0x1000, len(m)))
+            except Exception as e:
+                log.debug('read_bytes failed on %s: %s', m, e)
+                continue
+            if head[:2] != b'MZ':
+                continue
             try:
-                head = m.read_bytes(m.start, 0x1000)
-                pe = pefile.PE(data=head, fast_load=True)
                 # only get the First one that works
-                if pe is None:
-                    continue
+                pe = pefile.PE(data=head, fast_load=True)
                 break
             except pefile.PEFormatError as e:
                 pass
+        if pe is None:
+            raise NotImplementedError('PE header has not been found.')
         machine = pe.FILE_HEADER.Machine
         arch = pe.OPTIONAL_HEADER.Magic
         if arch == 0x10b:
@@ -188,19 +311,22 @@ class TargetPlatform(interfaces.ITargetPlatform):
             raise NotImplementedError('MACHINE is %s' % machine)
 
     @classmethod
-    def _detect_cpu_arch_elf(cls, mappings):
+    def _detect_cpu_arch_elf(cls, mappings, probes=None):
         from haystack.allocators.libc.ctypes_elf import struct_Elf_Ehdr
+        if probes is None:
+            probes = []
         # find an executable image and get the ELF header
-        for m in mappings:
-            # FIXME
-            if 'r-xp' not in m.permissions:
+        for m in cls._probe_mappings(mappings):
+            if len(m) < 0x40:
                 continue
-            #head = m.read_bytes(m.start, 0x40)  # 0x34 really
+            probes.append(m)
             try:
                 head = m.read_bytes(m.start, 0x40)  # 0x34 really
             except Exception as e:
-                log.debug('read_bytes failed '+ str(e))
-                raise e
+                log.debug('read_bytes failed on %s: %s', m, e)
+                continue
+            if head[:4] != b'\x7fELF':
+                continue
             x = struct_Elf_Ehdr.from_buffer_copy(head)
             log.debug('MACHINE:%s pathname:%s' % (x.e_machine, m.pathname))
             if x.e_machine == 3:
@@ -289,3 +415,62 @@ def _make_target_platform_local():
         elif os_name == TargetPlatform.LINUX:
             __LOCAL_PLATFORM = TargetPlatform.make_target_linux_64()
     return __LOCAL_PLATFORM
+
+
+def _get_detection_filename(cache_name):
+    if not cache_name.endswith(heapindex.CACHE_FOLDER_SUFFIX):
+        cache_name += heapindex.CACHE_FOLDER_SUFFIX
+    return os.path.join(cache_name, DETECTION_FILENAME)
+
+
+def _make_detection_fingerprint(cache_name, mappings):
+    dumpname = os.path.dirname(_get_detection_filename(cache_name))[:-len(heapindex.CACHE_FOLDER_SUFFIX)]
+    return heapindex.make_fingerprint(dumpname, mappings)
+
+
+def _load_detection(cache_name, mappings):
+    """
+    Loads the detection verdict saved next to the dump.
+
+    :return: dict of the platform characteristics, or None if it is missing or stale
+    """
+    filename = _get_detection_filename(cache_name)
+    fingerprint = _make_detection_fingerprint(cache_name, mappings)
+    if fingerprint is None or not os.access(filename, os.F_OK):
+        return None
+    try:
+        with open(filename) as fin:
+            data = json.load(fin)
+    except (IOError, OSError, ValueError) as e:
+        log.warning('Could not read %s: %s', filename, e)
+        return None
+    if (data.get('format') != DETECTION_FORMAT or data.get('version') != haystack.__version__
+            or data.get('fingerprint') != fingerprint):
+        log.info('Target platform cache %s is stale, ignoring it', filename)
+        return None
+    return data
+
+
+def _save_detection(cache_name, mappings, verdict):
+    """Saves the detection verdict next to the dump."""
+    filename = _get_detection_filename(cache_name)
+    fingerprint = _make_detection_fingerprint(cache_name, mappings)
+    if fingerprint is None:
+        return False
+    data = dict(verdict)
+    data.update({'format': DETECTION_FORMAT,
+                 'version': haystack.__version__,
+                 'fingerprint': fingerprint})
+    folder = os.path.dirname(filename)
+    try:
+        if not os.access(folder, os.F_OK):
+            os.mkdir(folder)
+        # write to a temporary file, then rename.
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as fout:
+            json.dump(data, fout)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as e:
+        log.warning('Could not write %s: %s', filename, e)
+        return False
+    return True
@@ -7,11 +7,13 @@ from past.builtins import long
 import ctypes
 import logging
 import sys
+import threading
 
 log = logging.getLogger('types')
 
-# let's use a cache
+# let's use a cache. One proxy per (long, pointer, long double) sizes for the whole process.
 __PROXIES = {}
+__PROXIES_LOCK = threading.Lock()
 
 
 def load_ctypes_default():
@@ -24,13 +26,15 @@ def load_ctypes_default():
 
 
 def build_ctypes_proxy(longsize, pointersize, longdoublesize):
-    """Make a ctypes proxy with these charateristics."""
-    if (longsize, pointersize, longdoublesize) in __PROXIES:
-        instance = __PROXIES[(longsize, pointersize, longdoublesize)]
-        return instance
-    instance = CTypesProxy(longsize, pointersize, longdoublesize)
-    __PROXIES[(longsize, pointersize, longdoublesize)] = instance
-    return instance
+    """Make a ctypes proxy with these charateristics.
+    The proxy is interned: all target platforms with the same sizes share one proxy,
+    its emulated types and its pointer type cache."""
+    key = (int(longsize), int(pointersize), int(longdoublesize))
+    with __PROXIES_LOCK:
+        if key not in __PROXIES:
+            log.debug('building ctypes proxy %d:%d:%d', *key)
+            __PROXIES[key] = CTypesProxy(*key)
+        return __PROXIES[key]
 
 
 def is_ctypes_instance(obj):
@@ -8,6 +8,7 @@ from past.builtins import long
 import ctypes
 import logging
 import struct
+import threading
 from struct import pack
 
 import os
@@ -23,6 +24,18 @@ __author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
 
 log = logging.getLogger('utils')
 
+# one Utils per ctypes proxy
+__UTILS = {}
+__UTILS_LOCK = threading.Lock()
+
+
+def get_ctypes_utils(_target_ctypes):
+    """Returns the Utils instance shared by all users of this ctypes proxy"""
+    with __UTILS_LOCK:
+        if _target_ctypes not in __UTILS:
+            __UTILS[_target_ctypes] = Utils(_target_ctypes)
+        return __UTILS[_target_ctypes]
+
 
 class Utils(interfaces.ICTypesUtils):
 
@@ -30,6 +43,8 @@ class Utils(interfaces.ICTypesUtils):
         self._ctypes = _target_ctypes
         assert isinstance(_target_ctypes, types.CTypesProxy)
         self.__local_process_memory_handler = None
+        # type: reader function, see get_pointee_address
+        self.__pointee_readers = {}
 
     def formatAddress(self, addr):
         if self._ctypes.sizeof(self._ctypes.c_void_p) == 8:
@@ -73,12 +88,44 @@ class Utils(interfaces.ICTypesUtils):
 
         :param obj: a pointer.
         """
+        try:
+            reader = self.__pointee_readers[type(obj)]
+        except KeyError:
+            reader = self._make_pointee_reader(type(obj))
+            self.__pointee_readers[type(obj)] = reader
+        if reader is None:
+            return self._get_pointee_address(obj)
+        return reader(obj)
+
+    def _make_pointee_reader(self, obj_type):
+        """
+        Selects, once per type, the function that reads the address from a pointer of that type.
+        Returns None when only the generic path can do it.
+        """
+        if issubclass(obj_type, (int, long)):
+            # basictype pointers are created as int.
+            return lambda obj: obj
+        sub_addr = getattr(obj_type, '_sub_addr_', None)
+        if isinstance(sub_addr, property):
+            # homebrew POINTER, the value is the address
+            return sub_addr.fget
+        elif sub_addr is not None:
+            return None
+        elif not self._ctypes.is_pointer_type(obj_type):
+            return lambda obj: 0
+        c_void_p = self._ctypes.c_void_p
+        if not self._ctypes.is_function_type(obj_type) and self._ctypes.sizeof(obj_type) == self._ctypes.sizeof(c_void_p):
+            # read the pointer value in place, a cast builds a new pointer
+            return lambda obj: c_void_p.from_buffer(obj).value or 0
+        cast = self._ctypes.cast
+        return lambda obj: cast(obj, c_void_p).value or 0
+
+    def _get_pointee_address(self, obj):
+        """ The generic path of get_pointee_address """
         # check for homebrew POINTER
         if hasattr(obj, '_sub_addr_'):
             if callable(obj._sub_addr_):
-                log.debug('obj._sub_addr_: 0x%x', obj._sub_addr_())
                 return obj._sub_addr_()
-            log.debug('obj._sub_addr_: 0x%x', obj._sub_addr_)
             return obj._sub_addr_
         elif isinstance(obj, int) or isinstance(obj, long):
             # basictype pointers are created as int.
@@ -89,13 +136,6 @@ class Utils(interfaces.ICTypesUtils):
             return self._ctypes.cast(obj, self._ctypes.c_void_p).value
         elif self._ctypes.is_pointer_type(type(obj)):
             return self._ctypes.cast(obj, self._ctypes.c_void_p).value
-            # check for null pointers
-            # if bool(obj):
-            # FIXME unreachable
-            if not hasattr(obj, 'contents'):
-                return 0
-            # print '** NOT MY HAYSTACK POINTER'
-            return self.__ctypes.addressof(obj.contents)
         else:
             return 0
 
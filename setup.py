@@ -83,10 +83,14 @@ setup(name="haystack",
                 'haystack-live-watch = haystack.cli:live_watch',
                 'haystack-rekall-dump = haystack.cli:rekall_dump',
                 'haystack-volatility-dump = haystack.cli:volatility_dump',
+                'haystack-convert-dump = haystack.mappings.container:main',
             ],
             # memory mappings loader haystack.abc.interfaces.IMemoryLoader
             'haystack.mappings_loader': [
                 'dir = haystack.mappings.folder:FolderLoader',
+                'hsd = haystack.mappings.container:ContainerLoader',
+                'tar = haystack.mappings.archive:TarLoader',
+                'core = haystack.mappings.core:CoreLoader',
                 'dmp = haystack.mappings.minidump:DMPLoader',
                 'volatility = haystack.mappings.vol:VolatilityLoader',
                 'rekall = haystack.mappings.rek:RekallLoader',
@@ -96,15 +100,16 @@ setup(name="haystack",
             ],
             # HEAP parsing haystack.abc.interfaces.IHeapFinder
             'haystack.heap_finder': [
-                'ptmalloc2 = haystack.allocators.libc.libcheapwalker.LibcHeapFinder',
-                'winxp = haystack.allocators.win32.winxpheapwalker.WinXPHeapFinder',
-                'win7 = haystack.allocators.win32.win7heapwalker.Win7HeapFinder',
+                'ptmalloc2 = haystack.allocators.libc.libcheapwalker:LibcHeapFinder',
+                'winxp = haystack.allocators.win32.winxpheapwalker:WinXPHeapFinder',
+                'win7 = haystack.allocators.win32.win7heapwalker:Win7HeapFinder',
             ]
       },
       # search: install requires only pefile, python-ptrace for memory-dump
       # reverse: install requires networkx, numpy, Levenshtein for signatures
       install_requires=["pefile",  # >=1.2.10_139
                         "construct<2.8",
+                        "numpy",
                         ] + ["python-ptrace>=0.8.1"] if "win" not in sys.platform else []
                           + ["winappdbg"] if "win" in sys.platform else [],
       dependency_links=[
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.allocators.heapindex ."""
+
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import haystack
+from haystack import target
+from haystack.allocators import heapindex
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MemoryHandler
+
+log = logging.getLogger('test_heapindex')
+
+
+class FakeWalker(object):
+    """A heap walker with fixed results"""
+    def __init__(self, my_target, mapping, address, allocs, free_chunks):
+        self._target = my_target
+        self._mapping = mapping
+        self._address = address
+        self._allocs = allocs
+        self._free_chunks = free_chunks
+
+    def get_target_platform(self):
+        return self._target
+
+    def get_heap_mapping(self):
+        return self._mapping
+
+    def get_heap_address(self):
+        return self._address
+
+    def get_user_allocations(self):
+        if self._allocs is None:
+            raise ValueError('bad heap')
+        elif isinstance(self._allocs, Exception):
+            raise self._allocs
+        return self._allocs
+
+    def get_free_chunks(self):
+        return self._free_chunks
+
+
+class TestHeapIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dumpname = tempfile.mkdtemp()
+        self.target = target.TargetPlatform.make_target_linux_64()
+        self.mappings = [AMemoryMapping(0x1000, 0x5000, 'rw-p', 0, 0, 0, 0, '[heap]'),
+                         AMemoryMapping(0x8000, 0x9000, 'rw-p', 0, 0, 0, 0, 'None')]
+        self.memory_handler = MemoryHandler(self.mappings, self.target, self.dumpname)
+
+    def tearDown(self):
+        shutil.rmtree(self.dumpname)
+        shutil.rmtree(self.dumpname + '.d', ignore_errors=True)
+
+    def _make_walkers(self):
+        return [FakeWalker(self.target, self.mappings[0], 0x1010,
+                           set([(0x1020, 0x10), (0x1040, 0x20)]), set([(0x1070, 0x30)])),
+                FakeWalker(self.target, self.mappings[1], 0x8000, None, None),
+                FakeWalker(self.target, self.mappings[1], 0x8800, TypeError('broken record'), None),
+                FakeWalker(self.target, self.mappings[1], 0x8c00, set([(0x8c10, 0x10)]), set())]
+
+    def test_save_load(self):
+        index = heapindex.HeapIndex(self.memory_handler)
+        self.assertTrue(index.is_enabled())
+        self.assertIsNone(index.load())
+        self.assertTrue(index.save(self._make_walkers()))
+        self.assertEqual(index.get_filename(), os.path.join(self.dumpname + '.d', 'heapindex.npz'))
+
+        heaps = heapindex.HeapIndex(self.memory_handler).load()
+        self.assertEqual(len(heaps), 4)
+        self.assertEqual(heaps[0]['address'], 0x1010)
+        self.assertEqual(heaps[0]['mapping_start'], 0x1000)
+        self.assertEqual(heaps[0]['offset'], 0x10)
+        self.assertEqual(heaps[0]['bits'], 64)
+        self.assertTrue(heaps[0]['valid'])
+        self.assertEqual(heaps[0]['error'], '')
+        self.assertEqual(heaps[0]['allocations'], set([(0x1020, 0x10), (0x1040, 0x20)]))
+        self.assertEqual(heaps[0]['free_chunks'], set([(0x1070, 0x30)]))
+        # the second heap could not be walked
+        self.assertFalse(heaps[1]['valid'])
+        self.assertEqual(heaps[1]['error'], 'ValueError: bad heap')
+        self.assertEqual(heaps[1]['allocations'], set())
+        # any error is recorded, and the following heaps are saved
+        self.assertFalse(heaps[2]['valid'])
+        self.assertEqual(heaps[2]['error'], 'TypeError: broken record')
+        self.assertTrue(heaps[3]['valid'])
+        self.assertEqual(heaps[3]['allocations'], set([(0x8c10, 0x10)]))
+
+    def test_stale(self):
+        index = heapindex.HeapIndex(self.memory_handler)
+        index.save(self._make_walkers())
+        # another version of haystack
+        old_version = haystack.__version__
+        try:
+            haystack.__version__ = 'test'
+            self.assertIsNone(heapindex.HeapIndex(self.memory_handler).load())
+        finally:
+            haystack.__version__ = old_version
+        # another mapping table
+        mappings = self.mappings + [AMemoryMapping(0xa000, 0xb000, 'r--p', 0, 0, 0, 0, 'None')]
+        memory_handler = MemoryHandler(mappings, self.target, self.dumpname)
+        self.assertIsNone(heapindex.HeapIndex(memory_handler).load())
+        # a rewritten mapping file
+        self.assertIsNotNone(heapindex.HeapIndex(self.memory_handler).load())
+        filename = os.path.join(self.dumpname, '0x1000-0x5000')
+        with open(filename, 'wb') as fout:
+            fout.write(b'\x00' * 0x4000)
+        index = heapindex.HeapIndex(self.memory_handler)
+        self.assertIsNone(index.load())
+        index.save(self._make_walkers())
+        self.assertIsNotNone(heapindex.HeapIndex(self.memory_handler).load())
+        os.utime(filename, (0, 0))
+        self.assertIsNone(heapindex.HeapIndex(self.memory_handler).load())
+        # reset
+        index = heapindex.HeapIndex(self.memory_handler)
+        index.save(self._make_walkers())
+        self.assertIsNotNone(index.load())
+        index.reset()
+        self.assertFalse(os.access(index.get_filename(), os.F_OK))
+        self.assertIsNone(index.load())
+
+    def test_no_dump(self):
+        memory_handler = MemoryHandler(self.mappings, self.target, 'localhost-1234')
+        index = heapindex.HeapIndex(memory_handler)
+        self.assertFalse(index.is_enabled())
+        self.assertFalse(index.save(self._make_walkers()))
+        self.assertIsNone(index.load())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
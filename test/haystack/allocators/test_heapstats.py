@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.allocators.heapstats ."""
+
+from __future__ import print_function
+
+import csv
+import io
+import json
+import logging
+import unittest
+
+import numpy
+
+from haystack import target
+from haystack.allocators import heapstats
+from haystack.mappings.base import AMemoryMapping
+
+log = logging.getLogger('test_heapstats')
+
+
+class FakeWalker(object):
+    def __init__(self, mappings, allocs, free_chunks):
+        self._target = target.TargetPlatform.make_target_linux_64()
+        self._mappings = mappings
+        self._allocs = allocs
+        self._free_chunks = free_chunks
+
+    def get_target_platform(self):
+        return self._target
+
+    def get_heap_address(self):
+        return self._mappings[0].start
+
+    def get_user_allocations(self):
+        return self._allocs
+
+    def get_free_chunks(self):
+        return self._free_chunks
+
+    def list_used_mappings(self):
+        return self._mappings
+
+    def list_segments(self):
+        return [(self._mappings[0].start, self._mappings[-1].end)]
+
+
+class FakeFinder(object):
+    def __init__(self, walkers):
+        self._walkers = walkers
+
+    def list_heap_walkers(self):
+        return self._walkers
+
+
+class TestHeapStats(unittest.TestCase):
+
+    def setUp(self):
+        self.mappings = [AMemoryMapping(0x1000, 0x2000, 'rw-p', 0, 0, 0, 0, 'None'),
+                         AMemoryMapping(0x2000, 0x3000, 'rw-p', 0, 0, 0, 0, 'None')]
+        allocs = set([(0x1000, 0x10), (0x1010, 0x20), (0x1100, 0x100), (0x2000, 0x400)])
+        free_chunks = set([(0x1030, 0x30), (0x2400, 0x800)])
+        self.walker = FakeWalker(self.mappings, allocs, free_chunks)
+        other = FakeWalker([AMemoryMapping(0x8000, 0x9000, 'rw-p', 0, 0, 0, 0, 'None')],
+                           set([(0x8000, 0x10)]), set())
+        self.finder = FakeFinder([self.walker, other])
+
+    def test_heap_statistics(self):
+        stats = heapstats.make_heap_statistics(self.walker)
+        self.assertEqual(stats['heap'], 0x1000)
+        self.assertEqual(stats['bits'], 64)
+        self.assertEqual(stats['used_count'], 4)
+        self.assertEqual(stats['used_size'], 0x530)
+        self.assertEqual(stats['free_count'], 2)
+        self.assertEqual(stats['free_size'], 0x830)
+        self.assertEqual(stats['largest_free'], 0x800)
+        self.assertAlmostEqual(stats['free_ratio'], 0x830 / float(0x530 + 0x830))
+        self.assertAlmostEqual(stats['fragmentation'], 1 - 0x800 / float(0x830))
+        # 0x10 in [16, 32), 0x20 in [32, 64), 0x100 in [256, 512), 0x400 in [1024, 2048)
+        self.assertEqual(stats['histogram'], [[16, 1], [32, 1], [256, 1], [1024, 1]])
+        # per mapping
+        self.assertEqual(len(stats['mappings']), 2)
+        self.assertEqual(stats['mappings'][0]['used_size'], 0x130)
+        self.assertEqual(stats['mappings'][0]['free_size'], 0x30)
+        self.assertEqual(stats['mappings'][1]['used_size'], 0x400)
+        self.assertAlmostEqual(stats['mappings'][1]['occupancy'], 0.25)
+        # per segment
+        self.assertEqual(len(stats['segments']), 1)
+        self.assertEqual(stats['segments'][0]['used_count'], 4)
+        self.assertEqual(stats['segments'][0]['free_count'], 2)
+
+    def test_sum_by_range(self):
+        addrs = numpy.array([0x10, 0x1000, 0x1800, 0x3000], dtype=numpy.uint64)
+        sizes = numpy.array([1, 2, 3, 4], dtype=numpy.uint64)
+        totals, counts = heapstats.sum_by_range([(0x1000, 0x2000), (0x3000, 0x3001)], addrs, sizes)
+        self.assertEqual(totals.tolist(), [5, 4])
+        self.assertEqual(counts.tolist(), [2, 1])
+
+    def test_process_statistics(self):
+        stats = heapstats.make_process_statistics(self.finder)
+        self.assertEqual(len(stats['heaps']), 2)
+        self.assertEqual(stats['used_count'], 5)
+        self.assertEqual(stats['used_size'], 0x540)
+        # exports
+        self.assertEqual(json.loads(heapstats.output_to_json(stats))['used_size'], 0x540)
+        fout = io.StringIO() if bytes is not str else io.BytesIO()
+        heapstats.output_to_csv(stats, fout)
+        rows = list(csv.reader(io.StringIO(fout.getvalue())))
+        self.assertEqual(rows[0], heapstats.CSV_FIELDS)
+        self.assertEqual(rows[1][0], '0x1000')
+        self.assertEqual(rows[-1][0], 'total')
+        self.assertEqual(len(rows), 4)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -8,11 +8,18 @@ __author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
 
 # init ctypes with a controlled type size
 import logging
+import struct
+import threading
 import unittest
 
+from haystack import target
 from haystack.abc import interfaces
 from haystack.allocators import heapwalker
+from haystack.allocators.win32 import winxpheapwalker
 from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MemoryHandler
+from haystack.mappings.file import LocalMemoryMapping
 from test.testfiles import putty_1_win7
 
 
@@ -182,6 +189,117 @@ class TestHeapFinder2(unittest.TestCase):
             '''C:\Program Files (x86)\PuTTY\putty.exe''')
 
 
+class FakeWalker(object):
+    def __init__(self, mapping):
+        self._mapping = mapping
+
+    def get_heap_address(self):
+        return self._mapping.start
+
+    def get_user_allocations(self):
+        return set([(self._mapping.start + 0x10, 0x10)])
+
+    def get_free_chunks(self):
+        if self._mapping.pathname == 'bad':
+            raise ValueError('bad heap')
+        return set()
+
+
+class FakeHeapFinder(heapwalker.HeapFinder):
+    def _find_heap(self, mapping):
+        if mapping.pathname in ['heap', 'bad']:
+            return FakeWalker(mapping)
+        return None
+
+
+class TestParallelHeapFinder(unittest.TestCase):
+
+    def setUp(self):
+        my_target = target.TargetPlatform.make_target_linux_64()
+        mappings = []
+        for i in range(64):
+            pathname = ['heap', 'None', 'bad'][i % 3]
+            mappings.append(AMemoryMapping(0x10000 * (i+1), 0x10000 * (i+1) + 0x1000, 'rw-p', 0, 0, 0, 0, pathname))
+        self.memory_handler = MemoryHandler(mappings, my_target, 'localhost-0')
+
+    def test_workers(self):
+        finder = FakeHeapFinder(self.memory_handler)
+        self.assertRaises(ValueError, finder.set_workers, 0)
+        finder.set_workers(8)
+        heaps = finder.list_heap_walkers()
+        # same result as sequential, sorted by address
+        finder_1 = FakeHeapFinder(self.memory_handler)
+        heaps_1 = finder_1.list_heap_walkers()
+        self.assertEqual(len(heaps), 43)
+        self.assertEqual([h.get_heap_address() for h in heaps], [h.get_heap_address() for h in heaps_1])
+        # timings for all heaps
+        timings = finder.get_heap_timings()
+        self.assertEqual([t[0] for t in timings], [h.get_heap_address() for h in heaps])
+        for addr, find_time, walk_time in timings:
+            self.assertGreaterEqual(find_time, 0.)
+            self.assertGreaterEqual(walk_time, 0.)
+
+
+class TestWinHeapProfiles(unittest.TestCase):
+
+    def _make_memory_handler(self, my_target, contents):
+        mappings = []
+        for i, content in enumerate(contents):
+            start = 0x10000 * (i+1)
+            m = AMemoryMapping(start, start + len(content), 'rw-p', 0, 0, 0, 0, '')
+            mappings.append(LocalMemoryMapping.fromBytebuffer(m, content))
+        return MemoryHandler(mappings, my_target, 'localhost-0')
+
+    def test_single_arch(self):
+        """A 32 bits dump never loads the 64 bits heap profile"""
+        my_target = target.TargetPlatform.make_target_win_32('winxp')
+        memory_handler = self._make_memory_handler(my_target, [b'\x01' * 0x1000, b'\x00' * 0x1000])
+        finder = winxpheapwalker.WinXPHeapFinder(memory_handler)
+        self.assertEqual(finder.list_heap_walkers(), [])
+        self.assertEqual(list(finder._cpu.keys()), [])
+        self.assertIn('HEAP', dir(finder._get_cpu(32)['module']))
+        self.assertEqual(list(finder._cpu.keys()), [32])
+
+    def test_lazy_profile(self):
+        """A 64 bits dump loads a heap profile when it finds a heap signature for it"""
+        my_target = target.TargetPlatform.make_target_win_64('winxp')
+        heap = bytearray(b'\x01' * 0x1000)
+        struct.pack_into('I', heap, winxpheapwalker.WinXPHeapFinder.signature_offsets[64], 0xeeffeeff)
+        memory_handler = self._make_memory_handler(my_target, [b'\x01' * 0x1000, bytes(heap)])
+        finder = winxpheapwalker.WinXPHeapFinder(memory_handler)
+        self.assertEqual(finder.list_heap_walkers(), [])
+        self.assertEqual(list(finder._cpu.keys()), [64])
+
+    def test_kernel_heaps_serial(self):
+        """Kernel heap candidates are rebased after the workers are done, in the calling thread"""
+        my_target = target.TargetPlatform.make_target_win_64('winxp')
+        heap = bytearray(b'\x01' * 0x1000)
+        struct.pack_into('I', heap, winxpheapwalker.WinXPHeapFinder.signature_offsets[64], 0xeeffeeff)
+        memory_handler = self._make_memory_handler(my_target, [bytes(heap)] * 8)
+        starts = [m.start for m in memory_handler.get_mappings()]
+
+        class KernelHeapFinder(winxpheapwalker.WinXPHeapFinder):
+            def _get_heap_possible_kernel_pointer_from_heap(self, target_platform, heap):
+                return 0xFFFFF90000010000
+
+        finder = KernelHeapFinder(memory_handler)
+        finder.set_workers(4)
+        rebases = []
+        rebase_mapping = memory_handler.rebase_mapping
+
+        def _rebase_mapping(mapping, new_start):
+            rebases.append((threading.current_thread(), finder._defer_kernel_heaps))
+            return rebase_mapping(mapping, new_start)
+        memory_handler.rebase_mapping = _rebase_mapping
+        self.assertEqual(finder.list_heap_walkers(), [])
+        # each candidate was rebased, then rebased back
+        self.assertEqual(len(rebases), 16)
+        for thread, deferred in rebases:
+            self.assertIs(thread, threading.current_thread())
+            self.assertFalse(deferred)
+        self.assertEqual([m.start for m in memory_handler.get_mappings()], starts)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     # logging.basicConfig(level=logging.DEBUG)
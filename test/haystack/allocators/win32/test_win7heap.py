@@ -8,6 +8,7 @@ import sys
 import unittest
 
 from haystack.allocators.win32 import win7heapwalker
+from haystack.allocators.win32 import winheap
 from haystack.mappings import folder
 from test.testfiles import putty_1_win7
 
@@ -371,6 +372,27 @@ class TestWin7Heap(unittest.TestCase):
             self.assertEqual(heap.Counters.TotalSizeInVirtualBlocks, size)
 
 
+class TestUCRSkipList(unittest.TestCase):
+
+    def test_find(self):
+        # unsorted, with an overlap and an empty UCR
+        skiplist = winheap.UCRSkipList([(0x5000, 0x1000), (0x1000, 0x2000), (0x2000, 0x2000), (0x8000, 0)])
+        self.assertEqual(len(skiplist), 2)
+        self.assertEqual(skiplist.find(0x1000), (0x1000, 0x4000))
+        self.assertEqual(skiplist.find(0x3ff8), (0x1000, 0x4000))
+        self.assertIsNone(skiplist.find(0x4000))
+        self.assertIsNone(skiplist.find(0x800))
+        self.assertEqual(skiplist.find(0x5800), (0x5000, 0x6000))
+        self.assertIsNone(skiplist.find(0x8000))
+
+    def test_next_start(self):
+        skiplist = winheap.UCRSkipList([(0x1000, 0x1000), (0x5000, 0x1000)])
+        self.assertEqual(skiplist.next_start(0), 0x1000)
+        self.assertEqual(skiplist.next_start(0x1000), 0x5000)
+        self.assertEqual(skiplist.next_start(0x4ff8), 0x5000)
+        self.assertIsNone(skiplist.next_start(0x5000))
+
+
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
     # logging.getLogger('testwin7heap').setLevel(level=logging.DEBUG)
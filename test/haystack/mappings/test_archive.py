@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.archive ."""
+
+from __future__ import print_function
+
+import gzip
+import logging
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from haystack import memory_dumper
+from haystack.mappings import archive
+from haystack.mappings import folder
+from test.haystack.mappings.test_container import make_folder_dump
+
+log = logging.getLogger('test_archive')
+
+
+class TestGzipIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rand = random.Random(42)
+        self.data = b''.join([struct.pack('<I', rand.randint(0, 2**16)) for i in range(0x3000)])
+        self.data += bytes(bytearray([i % 251 for i in range(0x5123)]))
+        # several deflate blocks
+        self.data *= 4
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, content):
+        filename = os.path.join(self.tmpdir, 'test.gz')
+        with open(filename, 'wb') as fout:
+            fout.write(content)
+        return filename
+
+    def test_read(self):
+        index = archive.GzipIndex(self._write(gzip.compress(self.data)), span=0x2000, block_size=0x1000)
+        self.assertEqual(index.size, len(self.data))
+        # an access point at the gzip header, then at deflate block ends
+        self.assertEqual(index._bits[0], archive.MEMBER_START)
+        self.assertGreater(len(index._outs), 2)
+        for out_offset, window in zip(index._outs[1:], index._windows[1:]):
+            self.assertEqual(zlib.decompress(window), self.data[max(0, out_offset - archive.WINDOW_SIZE):out_offset])
+        for offset, size in [(0, 0x10), (0x1ff8, 0x10), (0x7000, 0x3000), (len(self.data) - 8, 8)]:
+            self.assertEqual(index.read(offset, size), self.data[offset:offset + size])
+        rand = random.Random(42)
+        for i in range(100):
+            offset, size = rand.randrange(len(self.data)), rand.randrange(0x3000)
+            self.assertEqual(index.read(offset, size), self.data[offset:offset + size])
+        # past the end
+        self.assertEqual(index.read(len(self.data) - 4, 8), self.data[-4:])
+        self.assertEqual(index.read(len(self.data) + 4, 8), b'')
+        # the blocks up to the next access point are cached
+        index.cache.clear()
+        misses = index.cache.misses
+        self.assertEqual(index.read(0, len(self.data)), self.data)
+        self.assertEqual(index.cache.misses, misses + len(index._outs))
+        index.close()
+
+    def test_members(self):
+        content = gzip.compress(self.data[:0x5000]) + gzip.compress(self.data[0x5000:])
+        filename = self._write(content)
+        index = archive.GzipIndex(filename, span=0x2000, block_size=0x1000)
+        self.assertEqual(index.size, len(self.data))
+        self.assertIn(0x5000, [out_offset for out_offset, bits in zip(index._outs, index._bits)
+                               if bits == archive.MEMBER_START])
+        self.assertEqual(index.read(0x4ff0, 0x20), self.data[0x4ff0:0x5010])
+        self.assertEqual(index.read(0, len(self.data)), self.data)
+        index.close()
+        # without libz, from the start of each member
+        os.remove(archive.get_gzip_index_filename(filename))
+        libz = archive._libz
+        try:
+            archive._libz = None
+            index = archive.GzipIndex(filename, span=0x2000, block_size=0x1000)
+        finally:
+            archive._libz = libz
+        self.assertEqual(index._outs, [0, 0x5000])
+        self.assertEqual(index.read(0x4ff0, 0x20), self.data[0x4ff0:0x5010])
+        self.assertEqual(index.read(0, len(self.data)), self.data)
+        index.close()
+
+    def test_saved(self):
+        filename = self._write(gzip.compress(self.data))
+        index = archive.GzipIndex(filename, span=0x2000, block_size=0x1000)
+        self.assertTrue(os.access(os.path.join(filename + '.d', 'gzipindex.npz'), os.F_OK))
+
+        def _build(index):
+            raise AssertionError('the saved index was not used')
+        build = archive.GzipIndex._build
+        try:
+            archive.GzipIndex._build = _build
+            index_2 = archive.GzipIndex(filename, span=0x2000, block_size=0x1000)
+            self.assertEqual(index_2.size, index.size)
+            self.assertEqual(index_2._outs, index._outs)
+            self.assertEqual(index_2._ins, index._ins)
+            self.assertEqual(index_2._bits, index._bits)
+            self.assertEqual(index_2._windows, index._windows)
+            self.assertEqual(index_2.read(0, len(self.data)), self.data)
+            index_2.close()
+            # another span, or another archive
+            self.assertRaises(AssertionError, archive.GzipIndex, filename, span=0x4000, block_size=0x1000)
+            os.utime(filename, (0, 0))
+            self.assertRaises(AssertionError, archive.GzipIndex, filename, span=0x2000, block_size=0x1000)
+        finally:
+            archive.GzipIndex._build = build
+        index.close()
+
+
+class TestTarDumpLoader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.dumpname = os.path.join(cls.tmpdir, 'test.dump')
+        rand = random.Random(42)
+        cls.heap = b''.join([struct.pack('<Q', rand.randint(0, 2**64 - 1)) for i in range(0x30000 // 8)])
+        cls.stack = bytes(bytearray([i % 251 for i in range(0x2000)]))
+        cls.mappings = [(0x400000, 0x401000, 'r-xp', '/bin/test', None),
+                        (0x600000, 0x630000, 'rw-p', '[heap]', cls.heap),
+                        (0x7ffff000, 0x80001000, 'rw-p', '[stack]', cls.stack)]
+        make_folder_dump(cls.dumpname, cls.mappings)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def _archive(self, archive_type):
+        dumpname = os.path.join(self.tmpdir, archive_type, 'test.dump')
+        shutil.copytree(self.dumpname, dumpname)
+        filename = memory_dumper.make_archive(dumpname, archive_type)
+        self.assertFalse(os.access(dumpname, os.F_OK))
+        self.assertTrue(archive.is_archive(filename))
+        self.assertFalse(archive.is_archive(self.dumpname))
+        return filename
+
+    def _check_content(self, memory_handler):
+        binary, heap, stack = memory_handler.get_mappings()
+        self.assertEqual(binary.pathname, '/bin/test')
+        self.assertEqual(heap.pathname, '[heap]')
+        self.assertEqual(heap.read_bytes(heap.start, len(heap)), self.heap)
+        self.assertEqual(heap.read_word(heap.start + 0x10000), struct.unpack('<Q', self.heap[0x10000:0x10008])[0])
+        self.assertEqual(heap.read_bytes(heap.start + 0xfffc, 8), self.heap[0xfffc:0x10004])
+        self.assertEqual(stack.read_bytes(stack.start + 0x1ff0, 0x10), self.stack[0x1ff0:])
+        self.assertRaises(ValueError, stack.read_bytes, stack.start + 0x1ff0, 0x11)
+
+    def test_tar(self):
+        filename = self._archive('tar')
+        self.assertTrue(filename.endswith('.tar'))
+        memory_handler = folder.load(filename, bits=64, os_name='linux')
+        self._check_content(memory_handler)
+        # zero copy
+        heap = memory_handler.get_mappings()[1]
+        self.assertIsInstance(heap, archive.ArchiveMemoryMapping)
+        self.assertIsInstance(heap._source, memoryview)
+
+    def test_gztar(self):
+        filename = self._archive('gztar')
+        self.assertTrue(filename.endswith('.tar.gz'))
+        loader = archive.TarDumpLoader(filename, bits=64, os_name='linux', span=0x20000)
+        memory_handler = loader.make_memory_handler()
+        self._check_content(memory_handler)
+        heap = memory_handler.get_mappings()[1]
+        self.assertIsInstance(heap._source, archive.GzipIndex)
+        self.assertGreater(len(heap._source._outs), 1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
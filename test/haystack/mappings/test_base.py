@@ -8,12 +8,23 @@ from __future__ import print_function
 import logging
 import mmap
 import os
+import shutil
 import struct
+import tempfile
 import unittest
 
+import numpy
+
 from haystack import listmodel
+from haystack import memory_dumper
 from haystack import target
+from haystack.mappings import base
 from haystack.mappings.base import AMemoryMapping
+from haystack.mappings import cached
+from haystack.mappings import file
+from haystack.mappings.file import FileBackedMemoryMapping
+from haystack.mappings.file import FilenameBackedMemoryMapping
+from haystack.mappings.file import LocalMemoryMapping
 from haystack.mappings.process import make_local_memory_handler
 from haystack.mappings import folder
 from test.haystack import SrcTests
@@ -342,6 +353,203 @@ class TestReferenceBook(unittest.TestCase):
         self.assertFalse(self.memory_handler.hasRef(str, 0xcafecafe))
 
 
+class TestPagePresence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # zero, data, zero, zero, data, zero
+        self.content = b''.join([b'\x00' * 0x1000, b'\x01' * 0x1000, b'\x00' * 0x2000,
+                                 b'\x00' * 0xfff + b'\x02', b'\x00' * 0x1000])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_make_page_presence(self):
+        presence = base.make_page_presence(self.content)
+        self.assertEqual(presence.tolist(), [False, True, False, False, True, False])
+        # partial last page
+        self.assertEqual(base.make_page_presence(b'\x00' * 0x1001 + b'\x01').tolist(), [False, True])
+
+    def test_presence_to_ranges(self):
+        presence = base.make_page_presence(self.content)
+        self.assertEqual(base.presence_to_ranges(presence, 0x10000, 0x16000),
+                         [(0x11000, 0x12000), (0x14000, 0x15000)])
+        # the margin extends and merges the ranges
+        self.assertEqual(base.presence_to_ranges(presence, 0x10000, 0x16000, margin=0x10),
+                         [(0x10ff0, 0x12000), (0x13ff0, 0x15000)])
+        self.assertEqual(base.presence_to_ranges(presence, 0x10000, 0x16000, margin=0x2000),
+                         [(0x10000, 0x15000)])
+
+    def test_sparse_file(self):
+        filename = os.path.join(self.tmpdir, 'mapping')
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT)
+        try:
+            skipped = memory_dumper.write_sparse(fd, self.content, 0)
+            os.ftruncate(fd, len(self.content))
+        finally:
+            os.close(fd)
+        self.assertEqual(skipped, 4)
+        with open(filename, 'rb') as fin:
+            self.assertEqual(fin.read(), self.content)
+        mapping = FilenameBackedMemoryMapping(filename, 0x10000, 0x16000, 'rw-p', 0, 0, 0, 0, 'None')
+        presence = mapping.get_page_presence()
+        self.assertTrue(presence[1])
+        self.assertTrue(presence[4])
+        self.assertEqual(mapping.read_bytes(0x14fff, 2), b'\x02\x00')
+        if file.make_file_page_presence(filename, 0, len(self.content)) is None:
+            # without sparse files support, the file is not read, and all the pages are present
+            self.assertTrue(presence.all())
+            return
+        # holes are absent
+        self.assertFalse(presence[0])
+        self.assertFalse(presence[5])
+        # a mapping at an offset in the file
+        presence = file.make_file_page_presence(filename, 0x800, 0x3000)
+        self.assertEqual(presence.tolist(), [True, True, False])
+
+    def test_unknown_presence(self):
+        reads = []
+
+        class CountingMapping(cached.CachedMemoryMapping):
+            def read_bytes(self, addr, size):
+                reads.append(addr)
+                return cached.CachedMemoryMapping.read_bytes(self, addr, size)
+        local = LocalMemoryMapping.fromBytebuffer(AMemoryMapping(0x10000, 0x16000, 'rw-p', 0, 0, 0, 0, ''),
+                                                  self.content)
+        self.assertEqual(local.get_page_presence().tolist(), [False, True, False, False, True, False])
+        # the other backends are not read
+        mapping = CountingMapping(local)
+        self.assertTrue(mapping.get_page_presence().all())
+        self.assertEqual(reads, [])
+
+
+
+class TestBatchedReads(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = target.TargetPlatform.make_target_platform_local()
+        _ctypes = self.target.get_target_ctypes()
+
+        class Node(_ctypes.Structure):
+            _fields_ = [('value', _ctypes.c_uint32),
+                        ('next', _ctypes.c_void_p),
+                        ('name', _ctypes.c_char * 6)]
+        self.Node = Node
+        self.content = bytes(bytearray([(i * 13) % 256 for i in range(0x2000)]))
+        self.addresses = [0x10000, 0x10018, 0x10100, 0x11ff0 - _ctypes.sizeof(Node), 0x10018]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_local(self, start=0x10000):
+        mapping = LocalMemoryMapping.fromBytebuffer(AMemoryMapping(start, start + 0x2000, 'rw-p', 0, 0, 0, 0, ''),
+                                                    self.content)
+        mapping.set_ctypes(self.target.get_target_ctypes())
+        return mapping
+
+    def _check(self, mapping):
+        mapping.set_ctypes(self.target.get_target_ctypes())
+        reference = self._make_local()
+        records = mapping.read_record_array(self.addresses, self.Node)
+        self.assertEqual(len(records), len(self.addresses))
+        for addr, record in zip(self.addresses, records):
+            node = reference.read_struct(addr, self.Node)
+            self.assertEqual(record['value'], node.value)
+            self.assertEqual(record['next'], node.next)
+            self.assertEqual(record['name'], node.name)
+        self.assertEqual(len(mapping.read_record_array([], self.Node)), 0)
+        self.assertRaises(ValueError, mapping.read_record_array, [0x12000 - 4], self.Node)
+        self.assertRaises(ValueError, mapping.read_record_array, [0x10], self.Node)
+        self.assertEqual(mapping.read_words(self.addresses).tolist(),
+                         [reference.read_word(addr) for addr in self.addresses])
+        self.assertEqual(mapping.read_bytes_many(self.addresses, 5),
+                         [reference.read_bytes(addr, 5) for addr in self.addresses])
+        nodes = mapping.read_struct_many(self.addresses, self.Node)
+        self.assertEqual([n._orig_address_ for n in nodes], self.addresses)
+        self.assertEqual([n.next for n in nodes], [reference.read_struct(a, self.Node).next for a in self.addresses])
+        self.assertRaises(ValueError, mapping.read_words, [0x12000 - 2])
+
+    def test_local(self):
+        mapping = self._make_local()
+        self.assertIsNotNone(mapping._get_content_array())
+        self._check(mapping)
+
+    def test_read_bytes(self):
+        mapping = cached.CachedMemoryMapping(self._make_local())
+        self.assertIsNone(mapping._get_content_array())
+        self._check(mapping)
+
+    def test_file_backed(self):
+        filename = os.path.join(self.tmpdir, 'mapping')
+        with open(filename, 'wb') as fout:
+            fout.write(self.content)
+        mapping = FileBackedMemoryMapping(open(filename, 'rb'), 0x10000, 0x12000)
+        self.assertIsNone(mapping._get_content_array())
+        self._check(mapping)
+        mapping = FilenameBackedMemoryMapping(filename, 0x10000, 0x12000)
+        self.assertIsNotNone(mapping._get_content_array())
+        self._check(mapping)
+
+    def test_read_coalesced(self):
+        reads = []
+
+        def read_ranges(ranges):
+            reads.extend(ranges)
+            return [self.content[start - 0x10000:start - 0x10000 + size] for start, size in ranges]
+        addresses = [0x11000, 0x10000, 0x10004, 0x10010, 0x11f00]
+        data = base.read_coalesced(read_ranges, addresses, 8, max_gap=0x100)
+        self.assertEqual(reads, [(0x10000, 0x18), (0x11000, 8), (0x11f00, 8)])
+        self.assertEqual(data, [self.content[a - 0x10000:a - 0x10000 + 8] for a in addresses])
+        self.assertRaises(ValueError, base.read_coalesced, lambda ranges: [None] * len(ranges), addresses, 8)
+        # groups are capped
+        del reads[:]
+        data = base.read_coalesced(read_ranges, addresses, 8, max_gap=0x1000, max_read=0x100)
+        self.assertEqual(reads, [(0x10000, 0x18), (0x11000, 8), (0x11f00, 8)])
+        self.assertEqual(data, [self.content[a - 0x10000:a - 0x10000 + 8] for a in addresses])
+        del reads[:]
+        addresses = list(range(0x10000, 0x12000, 0x10))
+        base.read_coalesced(read_ranges, addresses, 8, max_gap=0x100, max_read=0x800)
+        self.assertEqual(reads, [(start, 0x7f8) for start in range(0x10000, 0x12000, 0x800)])
+
+    def test_gather(self):
+        mapping = self._make_local()
+        addresses = numpy.array([0x10000, 0x11ff0, 0x10003], dtype=numpy.uint64)
+        rows = mapping._gather(mapping._get_content_array(), addresses, 0x10)
+        self.assertEqual(rows.shape, (3, 0x10))
+        self.assertEqual([row.tobytes() for row in rows], [mapping.read_bytes(int(a), 0x10) for a in addresses])
+        self.assertEqual(mapping._gather(mapping._get_content_array(), addresses[:0], 0x10).shape, (0, 0x10))
+        # a record as large as the mapping
+        rows = mapping._gather(mapping._get_content_array(), addresses[:1], 0x2000)
+        self.assertEqual(rows[0].tobytes(), self.content)
+
+    def test_memory_handler(self):
+        mappings = [self._make_local(0x10000), self._make_local(0x20000)]
+        memory_handler = base.MemoryHandler(mappings, self.target, 'test')
+        addresses = [0x20010, 0x10010, 0x21000, 0x10000]
+        words = memory_handler.read_words(addresses)
+        self.assertEqual(words.tolist(), [memory_handler.get_mapping_for_address(a).read_word(a) for a in addresses])
+        self.assertEqual(memory_handler.read_bytes_many(addresses, 3),
+                         [self.content[a & 0xffff:(a & 0xffff) + 3] for a in addresses])
+        nodes = memory_handler.read_struct_many(addresses, self.Node)
+        self.assertEqual([n._orig_address_ for n in nodes], addresses)
+        self.assertEqual(len(memory_handler.read_words([])), 0)
+        self.assertRaises(ValueError, memory_handler.read_words, [0x10000, 0x18000])
+        self.assertRaises(ValueError, memory_handler.read_words, [0x100])
+
+    def test_are_valid_address_values(self):
+        mappings = [self._make_local(0x10000), self._make_local(0x20000)]
+        memory_handler = base.MemoryHandler(mappings, self.target, 'test')
+        addresses = [0x10000, 0x11fff, 0x12000, 0x1ffff, 0x20000, 0x22000]
+        self.assertEqual(memory_handler.are_valid_address_values(addresses).tolist(),
+                         [bool(memory_handler.is_valid_address_value(a)) for a in addresses])
+        self.assertEqual(memory_handler.are_valid_address_values(addresses).tolist(),
+                         [True, True, False, False, True, False])
+        self.assertEqual(memory_handler.are_valid_address_values([0x11ff8, 0x11ff8], 8).tolist(), [True, True])
+        self.assertEqual(memory_handler.are_valid_address_values([0x11ff8], 9).tolist(), [False])
+        self.assertRaises(ValueError, memory_handler.read_words, [0x12000])
+
+
 if __name__ == '__main__':
     # logging.basicConfig(level=logging.DEBUG)
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.cached ."""
+
+from __future__ import print_function
+
+import logging
+import random
+import struct
+import unittest
+
+from haystack import target
+from haystack.mappings import cached
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MemoryHandler
+
+log = logging.getLogger('test_cached')
+
+
+class SlowMemoryMapping(AMemoryMapping):
+    """ a backend that counts its reads """
+
+    def __init__(self, start, content):
+        AMemoryMapping.__init__(self, start, start + len(content), 'rw-', 0, 0, 0, 0, '')
+        self._content = content
+        self.reads = []
+
+    def read_bytes(self, addr, size):
+        self.reads.append((addr, size))
+        return self._content[addr - self.start:addr - self.start + size]
+
+    def reset(self):
+        pass
+
+
+class TestCachedMemoryMapping(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.content = b''.join([struct.pack('<Q', rand.randint(0, 2**64 - 1)) for i in range(0x30000 // 8)])
+        # not aligned on a block
+        self.backend = SlowMemoryMapping(0x7f0000, self.content)
+        self.other = SlowMemoryMapping(0x820000, self.content[:0x1000])
+        mappings = cached.make_cached_mappings([self.backend, self.other], block_size=0x10000, cache_size=2)
+        self.memory_handler = MemoryHandler(mappings, target.TargetPlatform.make_target_linux_64(), 'test')
+        self.mapping = self.memory_handler.get_mapping_for_address(0x7f0000)
+
+    def test_read(self):
+        m = self.mapping
+        self.assertEqual(m.read_word(0x7f0010), struct.unpack('<Q', self.content[0x10:0x18])[0])
+        self.assertEqual(self.backend.reads, [(0x7f0000, 0x10000)])
+        # served from the cache
+        self.assertEqual(m.read_bytes(0x7f8000, 0x20), self.content[0x8000:0x8020])
+        record = m.read_struct(0x7f0100, self.memory_handler.get_target_platform().get_target_ctypes().c_uint64)
+        self.assertEqual(record._orig_address_, 0x7f0100)
+        self.assertEqual(len(self.backend.reads), 1)
+        self.assertEqual(m.cache.hit_rate(), 2. / 3)
+        # across two blocks
+        self.assertEqual(m.read_bytes(0x7ffff8, 0x10), self.content[0xfff8:0x10008])
+        self.assertEqual(self.backend.reads[-1], (0x800000, 0x10000))
+        # large reads bypass the cache
+        self.assertEqual(m.read_bytes(m.start, len(m)), self.content)
+        self.assertEqual(self.backend.reads[-1], (m.start, len(m)))
+        self.assertRaises(ValueError, m.read_bytes, m.end - 4, 8)
+
+    def test_shared_cache(self):
+        other = self.memory_handler.get_mapping_for_address(0x820000)
+        self.assertIs(other.cache, self.mapping.cache)
+        # same block index, different mappings
+        self.assertEqual(other.read_bytes(0x820000, 8), self.content[:8])
+        self.assertEqual(self.mapping.read_bytes(0x820000 - 0x10, 8), self.content[-0x10:-8])
+        self.assertEqual(self.other.reads, [(0x820000, 0x1000)])
+        # bounded
+        self.mapping.read_bytes(0x7f0000, 8)
+        self.mapping.read_bytes(0x800000, 8)
+        self.assertEqual(len(self.mapping.cache._blocks), 2)
+        self.memory_handler.reset_mappings()
+        self.assertEqual(len(self.mapping.cache._blocks), 0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.container ."""
+
+from __future__ import print_function
+
+import ctypes
+import logging
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from haystack.mappings import container
+from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+
+log = logging.getLogger('test_container')
+
+
+def make_folder_dump(dumpname, mappings):
+    """Write a haystack folder dump. mappings is a list of (start, end, permissions, pathname, content)"""
+    os.mkdir(dumpname)
+    with open(os.path.join(dumpname, 'mappings'), 'w') as index:
+        for start, end, permissions, pathname, content in mappings:
+            index.write('0x%0.16x 0x%0.16x %s 0x00000000 00:00 0000000 %s\n' % (start, end, permissions, pathname))
+            if content is not None:
+                with open(os.path.join(dumpname, '0x%0.16x-0x%0.16x' % (start, end)), 'wb') as fout:
+                    fout.write(content)
+
+
+class TestContainer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.dumpname = os.path.join(cls.tmpdir, 'test.dump')
+        rand = random.Random(42)
+        cls.heap = b''.join([struct.pack('<Q', rand.randint(0, 2**64 - 1)) for i in range(0x3000 // 8)])
+        cls.heap += b'\x00' * 0x5000
+        cls.stack = bytes(bytearray([i % 251 for i in range(0x2000)]))
+        cls.mappings = [(0x400000, 0x401000, 'r-xp', '/bin/test', None),
+                        (0x600000, 0x608000, 'rw-p', '[heap]', cls.heap),
+                        (0x7ffff000, 0x80001000, 'rw-p', '[stack]', cls.stack)]
+        make_folder_dump(cls.dumpname, cls.mappings)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def _convert(self, codec, block_size=0x1000):
+        filename = os.path.join(self.tmpdir, 'test.%s.hsd' % codec)
+        container.convert_folder(self.dumpname, filename, block_size=block_size, codec=codec)
+        self.assertTrue(container.is_container(filename))
+        self.assertFalse(container.is_container(self.dumpname))
+        loader = container.ContainerDumpLoader(filename, bits=64, os_name='linux')
+        return loader.make_memory_handler()
+
+    def _check_content(self, memory_handler):
+        self.assertEqual(len(memory_handler.get_mappings()), 3)
+        binary, heap, stack = memory_handler.get_mappings()
+        self.assertEqual(binary.pathname, '/bin/test')
+        self.assertEqual(binary.permissions, 'r-xp')
+        self.assertEqual(heap.pathname, '[heap]')
+        self.assertEqual(len(heap), 0x8000)
+        self.assertEqual(heap.read_bytes(heap.start, len(heap)), self.heap)
+        # across blocks
+        self.assertEqual(heap.read_bytes(heap.start + 0xffc, 8), self.heap[0xffc:0x1004])
+        self.assertEqual(heap.read_word(heap.start + 0x1000), struct.unpack('<Q', self.heap[0x1000:0x1008])[0])
+        record = heap.read_struct(heap.start + 0x2ff8, ctypes.c_uint64 * 2)
+        self.assertEqual(list(record), list(struct.unpack('<QQ', self.heap[0x2ff8:0x3008])))
+        self.assertEqual(record._orig_address_, heap.start + 0x2ff8)
+        self.assertEqual(stack.read_bytes(stack.start + 0x1ff0, 0x10), self.stack[0x1ff0:])
+        self.assertRaises(ValueError, stack.read_bytes, stack.start + 0x1ff0, 0x11)
+        # the folder dump content is the same
+        folder_handler = folder.ProcessMemoryDumpLoader(self.dumpname, bits=64, os_name='linux').make_memory_handler()
+        for m1, m2 in zip(folder_handler.get_mappings()[1:], memory_handler.get_mappings()[1:]):
+            self.assertEqual(m1.read_bytes(m1.start, len(m1)), m2.read_bytes(m2.start, len(m2)))
+
+    def test_zlib(self):
+        memory_handler = self._convert('zlib')
+        self._check_content(memory_handler)
+        heap = memory_handler.get_mappings()[1]
+        # the random part is stored raw, the zeroes are compressed
+        self.assertIsNone(heap._raw)
+        codecs = heap._container.blocks['codec'][heap._first_block:heap._first_block + heap._block_count].tolist()
+        self.assertEqual(codecs, [0, 0, 0, 1, 1, 1, 1, 1])
+        # the compressed blocks of zeroes are absent
+        self.assertEqual(heap.get_page_presence().tolist(), [True] * 3 + [False] * 5)
+        cache = heap._container.cache
+        cache.clear()
+        hits, misses = cache.hits, cache.misses
+        heap.read_bytes(heap.start + 0x4000, 0x10)
+        heap.read_bytes(heap.start + 0x4010, 0x10)
+        self.assertEqual(cache.misses, misses + 1)
+        self.assertEqual(cache.hits, hits + 1)
+
+    def test_lzma(self):
+        try:
+            import lzma
+        except ImportError:
+            self.skipTest('lzma is not available')
+        self._check_content(self._convert('lzma'))
+
+    def test_raw(self):
+        memory_handler = self._convert('raw', block_size=0x800)
+        self._check_content(memory_handler)
+        # zero copy
+        for m in memory_handler.get_mappings()[1:]:
+            self.assertIsNotNone(m._raw)
+            # raw blocks are not read
+            self.assertTrue(m.get_page_presence().all())
+
+    def test_content_length(self):
+        filename = os.path.join(self.tmpdir, 'test.short.hsd')
+        heap = AMemoryMapping(0x600000, 0x608000, 'rw-p', 0, 0, 0, 0, '[heap]')
+        stack = AMemoryMapping(0x7ffff000, 0x80001000, 'rw-p', 0, 0, 0, 0, '[stack]')
+        with container.ContainerWriter(filename, block_size=0x1000) as writer:
+            self.assertRaises(ValueError, writer.add_mapping, heap, self.heap[:-1])
+            writer.add_mapping(heap, self.heap)
+            writer.add_mapping(stack, self.stack)
+        loaded = container.ContainerFile(filename)
+        # a mapping table that does not match its blocks
+        short = container.ContainerMemoryMapping(loaded, 0, 7, heap.start, heap.end)
+        self.assertEqual(short.read_bytes(heap.start, 8), self.heap[:8])
+        self.assertRaises(ValueError, short.read_bytes, heap.start + 0x7000, 8)
+        self.assertRaises(ValueError, short.read_bytes, heap.start + 0x6ff8, 0x10)
+
+    def test_block_cache(self):
+        cache = container.BlockCache(2)
+        self.assertEqual(cache.get(1, lambda k: k * 10), 10)
+        self.assertEqual(cache.get(2, lambda k: k * 10), 20)
+        self.assertEqual(cache.get(1, lambda k: None), 10)
+        # 2 is the least recently used
+        cache.get(3, lambda k: k * 10)
+        self.assertIsNone(cache.get(2, lambda k: None))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 4)
+        self.assertAlmostEqual(cache.hit_rate(), 0.2)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.core ."""
+
+from __future__ import print_function
+
+import ctypes
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from haystack.mappings import core
+
+log = logging.getLogger('test_core')
+
+
+def make_core(filename, segments, files, bits=64):
+    """
+    Write a minimal ELF core file.
+
+    :param segments: list of (vaddr, memsz, flags, content)
+    :param files: list of (start, end, page offset, pathname) for the NT_FILE note
+    """
+    word = 'Q' if bits == 64 else 'I'
+    ehsize, phentsize = (64, 56) if bits == 64 else (52, 32)
+    # NT_FILE note
+    desc = struct.pack('<' + word * 2, len(files), 0x1000)
+    for start, end, page_offset, pathname in files:
+        desc += struct.pack('<' + word * 3, start, end, page_offset)
+    desc += b''.join([pathname.encode() + b'\x00' for start, end, page_offset, pathname in files])
+    desc += b'\x00' * (-len(desc) % 4)
+    note = struct.pack('<III', 5, len(desc), core.NT_FILE) + b'CORE\x00\x00\x00\x00' + desc
+    phnum = len(segments) + 1
+    offset = ehsize + phnum * phentsize
+    phdrs = []
+    data = [note]
+    headers = [(core.PT_NOTE, 0, offset, 0, len(note), 0)]
+    offset += len(note)
+    for vaddr, memsz, flags, content in segments:
+        headers.append((core.PT_LOAD, flags, offset, vaddr, len(content), memsz))
+        data.append(content)
+        offset += len(content)
+    for p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz in headers:
+        if bits == 64:
+            phdrs.append(struct.pack('<IIQQQQQQ', p_type, p_flags, p_offset, p_vaddr, 0, p_filesz, p_memsz, 0x1000))
+        else:
+            phdrs.append(struct.pack('<IIIIIIII', p_type, p_offset, p_vaddr, 0, p_filesz, p_memsz, p_flags, 0x1000))
+    e_ident = core.ELF_MAGIC + struct.pack('<BBBB8x', bits // 32, core.ELFDATA2LSB, 1, 0)
+    if bits == 64:
+        ehdr = e_ident + struct.pack('<HHIQQQIHHHHHH', core.ET_CORE, 62, 1, 0, ehsize, 0, 0, ehsize, phentsize, phnum, 0, 0, 0)
+    else:
+        ehdr = e_ident + struct.pack('<HHIIIIIHHHHHH', core.ET_CORE, 3, 1, 0, ehsize, 0, 0, ehsize, phentsize, phnum, 0, 0, 0)
+    with open(filename, 'wb') as fout:
+        fout.write(ehdr + b''.join(phdrs) + b''.join(data))
+
+
+class TestCoreDumpLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'core.1234')
+        self.text = bytes(bytearray([i % 251 for i in range(0x2000)]))
+        self.heap = struct.pack('<Q', 0x601010) * 0x200
+        self.segments = [(0x400000, 0x2000, core.PF_R | core.PF_X, self.text),
+                         (0x601000, 0x1000, core.PF_R | core.PF_W, b'\x01' * 0x1000),
+                         # bss and heap, the last pages are not stored
+                         (0x602000, 0x4000, core.PF_R | core.PF_W, self.heap)]
+        self.files = [(0x400000, 0x402000, 0, '/bin/test'), (0x601000, 0x602000, 1, '/bin/test')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        make_core(self.filename, self.segments, self.files)
+        self.assertTrue(core.is_core(self.filename))
+        loader = core.CoreDumpLoader(self.filename, os_name='linux')
+        memory_handler = loader.make_memory_handler()
+        self.assertEqual(memory_handler.get_target_platform().get_cpu_bits(), 64)
+        text, data, heap = memory_handler.get_mappings()
+        self.assertEqual((text.start, text.end, text.permissions, text.pathname), (0x400000, 0x402000, 'r-xp', '/bin/test'))
+        self.assertEqual((data.permissions, data.pathname, data.offset), ('rw-p', '/bin/test', 0x1000))
+        self.assertEqual(heap.pathname, '')
+        self.assertEqual(text.read_bytes(0x400ff0, 0x20), self.text[0xff0:0x1010])
+        # zero copy
+        self.assertIsInstance(text._read(0x400000, 8), memoryview)
+        self.assertEqual(heap.read_word(0x602ff8), 0x601010)
+        record = heap.read_struct(0x602000, ctypes.c_uint64)
+        self.assertEqual(record.value, 0x601010)
+        self.assertEqual(record._orig_address_, 0x602000)
+        # zero filled
+        self.assertEqual(heap.read_bytes(0x602ffc, 8), self.heap[-4:] + b'\x00' * 4)
+        self.assertEqual(heap.read_word(0x605ff8), 0)
+        self.assertRaises(ValueError, heap.read_bytes, 0x605ff8, 0x10)
+        self.assertEqual(heap.get_page_presence().tolist(), [True, False, False, False])
+        self.assertEqual(memory_handler.get_mapping_for_address(0x603000), heap)
+
+    def test_32bits(self):
+        make_core(self.filename, self.segments, self.files, bits=32)
+        memory_handler = core.CoreDumpLoader(self.filename, os_name='linux').make_memory_handler()
+        self.assertEqual(memory_handler.get_target_platform().get_cpu_bits(), 32)
+        text, data, heap = memory_handler.get_mappings()
+        self.assertEqual(data.pathname, '/bin/test')
+        self.assertEqual(heap.read_word(0x602000), 0x601010)
+
+    def test_not_core(self):
+        with open(self.filename, 'wb') as fout:
+            fout.write(b'\x7fELF' + b'\x00' * 60)
+        self.assertFalse(core.is_core(self.filename))
+        self.assertRaises(ValueError, core.CoreDumpLoader, self.filename)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.delta ."""
+
+from __future__ import print_function
+
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+
+from haystack import memory_dumper
+from haystack.mappings import archive
+from haystack.mappings import container
+from haystack.mappings import delta
+from haystack.mappings import folder
+from test.haystack.mappings.test_container import make_folder_dump
+
+log = logging.getLogger('test_delta')
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'base.dump')
+        self.heap = bytes(bytearray([i % 253 for i in range(0x4000)]))
+        self.stack = b'\x01' * 0x2000
+        make_folder_dump(self.base, [(0x400000, 0x401000, 'r-xp', '/bin/test', None),
+                                     (0x600000, 0x604000, 'rw-p', '[heap]', self.heap),
+                                     (0x7ffff000, 0x80001000, 'rw-p', '[stack]', self.stack)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_delta(self, heap, stack):
+        """write a delta dump of the heap and the stack, the way MemoryDumper does"""
+        dumpname = os.path.join(self.tmpdir, 'delta.dump')
+        make_folder_dump(dumpname, [(0x400000, 0x401000, 'r-xp', '/bin/test', None),
+                                    (0x600000, 0x604000, 'rw-p', '[heap]', b''),
+                                    (0x7ffff000, 0x80001000, 'rw-p', '[stack]', b'')])
+        writer = delta.DeltaWriter(self.base)
+        for start, end, content in [(0x600000, 0x604000, heap), (0x7ffff000, 0x80001000, stack)]:
+            mmap_fname = '0x%0.16x-0x%0.16x' % (start, end)
+            writer.add_mapping(mmap_fname, len(content))
+            changed = writer.update(mmap_fname, 0, content)
+            with open(os.path.join(dumpname, mmap_fname), 'wb') as fout:
+                for i, page_changed in enumerate(changed):
+                    if page_changed:
+                        fout.seek(i * 0x1000)
+                        fout.write(content[i * 0x1000:(i + 1) * 0x1000])
+                fout.truncate(len(content))
+        writer.save(dumpname)
+        return dumpname, writer
+
+    def test_hash_pages(self):
+        hashes = delta.hash_pages(self.heap)
+        self.assertEqual(len(hashes), 4)
+        self.assertEqual(len(set(hashes.tolist())), 4)
+        self.assertEqual(delta.hash_pages(self.heap[0x1000:0x2000])[0], hashes[1])
+        # dumps without page hashes are hashed from the files
+        hashes = delta.load_page_hashes(self.base)
+        self.assertEqual(sorted(hashes.keys()), ['0x0000000000600000-0x0000000000604000',
+                                                 '0x000000007ffff000-0x0000000080001000'])
+
+    def test_overlay(self):
+        heap = self.heap[:0x2000] + b'\x42' * 0x1000 + self.heap[0x3000:]
+        dumpname, writer = self._make_delta(heap, self.stack)
+        self.assertEqual(writer.changed_pages(), 1)
+        self.assertTrue(delta.is_delta(dumpname))
+        self.assertEqual(delta.get_base_dumpname(dumpname), self.base)
+        # the base path is relative to the delta dump
+        with open(os.path.join(dumpname, delta.BASE_FILENAME)) as fin:
+            self.assertEqual(fin.read().strip(), os.path.join('..', 'base.dump'))
+        for loader in [folder.ProcessMemoryDumpLoader, folder.VeryLazyProcessMemoryDumpLoader]:
+            memory_handler = loader(dumpname, bits=64, os_name='linux').make_memory_handler()
+            binary, m_heap, m_stack = memory_handler.get_mappings()
+            self.assertIsInstance(m_heap, delta.OverlayMemoryMapping)
+            # the base mapping file, copy-on-write
+            self.assertIsInstance(m_heap._make_content(), mmap.mmap)
+            self.assertEqual(m_heap.read_bytes(m_heap.start, len(m_heap)), heap)
+            self.assertEqual(m_heap.read_word(0x602000), 0x4242424242424242)
+            self.assertEqual(m_stack.read_bytes(m_stack.start, len(m_stack)), self.stack)
+            memory_handler.reset_mappings()
+            self.assertEqual(m_stack.read_bytes(m_stack.start + 0x1ff8, 8), b'\x01' * 8)
+        # a delta of a delta
+        os.rename(dumpname, os.path.join(self.tmpdir, 'delta.0'))
+        self.base = os.path.join(self.tmpdir, 'delta.0')
+        stack = b'\x01' * 0x1000 + b'\x02' * 0x1000
+        dumpname, writer = self._make_delta(heap, stack)
+        self.assertEqual(writer.changed_pages(), 1)
+        memory_handler = folder.ProcessMemoryDumpLoader(dumpname, bits=64, os_name='linux').make_memory_handler()
+        binary, m_heap, m_stack = memory_handler.get_mappings()
+        self.assertIsInstance(m_stack._make_content(), mmap.mmap)
+        self.assertEqual(m_heap.read_bytes(m_heap.start, len(m_heap)), heap)
+        self.assertEqual(m_stack.read_bytes(m_stack.start, len(m_stack)), stack)
+        # the base dumps are not modified
+        with open(os.path.join(self.tmpdir, 'base.dump', '0x000000007ffff000-0x0000000080001000'), 'rb') as fin:
+            self.assertEqual(fin.read(), self.stack)
+        # the dumps can be moved together
+        moved = os.path.join(self.tmpdir, 'moved')
+        os.mkdir(moved)
+        for name in ['base.dump', 'delta.0', 'delta.dump']:
+            os.rename(os.path.join(self.tmpdir, name), os.path.join(moved, name))
+        dumpname = os.path.join(moved, 'delta.dump')
+        memory_handler = folder.ProcessMemoryDumpLoader(dumpname, bits=64, os_name='linux').make_memory_handler()
+        binary, m_heap, m_stack = memory_handler.get_mappings()
+        self.assertEqual(m_heap.read_bytes(m_heap.start, len(m_heap)), heap)
+        self.assertEqual(m_stack.read_bytes(m_stack.start, len(m_stack)), stack)
+
+    def test_archive(self):
+        """An archived delta dump is overlaid on its base"""
+        heap = self.heap[:0x2000] + b'\x42' * 0x1000 + self.heap[0x3000:]
+        for archive_type in ['tar', 'gztar']:
+            dumpname, writer = self._make_delta(heap, self.stack)
+            filename = memory_dumper.make_archive(dumpname, archive_type)
+            memory_handler = folder.load(filename, bits=64, os_name='linux')
+            binary, m_heap, m_stack = memory_handler.get_mappings()
+            self.assertIsInstance(m_heap, delta.OverlayMemoryMapping)
+            self.assertEqual(m_heap.read_bytes(m_heap.start, len(m_heap)), heap)
+            self.assertEqual(m_stack.read_bytes(m_stack.start, len(m_stack)), self.stack)
+            # the base path is relative to the archive
+            moved = os.path.join(self.tmpdir, 'moved')
+            os.mkdir(moved)
+            for name in ['base.dump', os.path.basename(filename)]:
+                os.rename(os.path.join(self.tmpdir, name), os.path.join(moved, name))
+            loader = archive.TarDumpLoader(os.path.join(moved, os.path.basename(filename)), bits=64, os_name='linux')
+            binary, m_heap, m_stack = loader.make_memory_handler().get_mappings()
+            self.assertEqual(m_heap.read_bytes(m_heap.start, len(m_heap)), heap)
+            os.rename(os.path.join(moved, 'base.dump'), self.base)
+            shutil.rmtree(moved)
+
+    def test_convert(self):
+        """A delta dump is converted to a container with the content of its base"""
+        heap = self.heap[:0x2000] + b'\x42' * 0x1000 + self.heap[0x3000:]
+        dumpname, writer = self._make_delta(heap, self.stack)
+        filename = container.convert_folder(dumpname, os.path.join(self.tmpdir, 'delta.hsk'))
+        memory_handler = container.ContainerDumpLoader(filename, bits=64, os_name='linux').make_memory_handler()
+        binary, m_heap, m_stack = memory_handler.get_mappings()
+        self.assertFalse(binary.get_page_presence().any())
+        self.assertEqual(m_heap.read_bytes(m_heap.start, len(m_heap)), heap)
+        self.assertEqual(m_stack.read_bytes(m_stack.start, len(m_stack)), self.stack)
+
+    def test_no_base(self):
+        """Without a base dump, the pages are not hashed"""
+        writer = delta.DeltaWriter()
+        hash_pages = delta.hash_pages
+
+        def _hash_pages(data):
+            raise AssertionError('hashed without a base')
+        delta.hash_pages = _hash_pages
+        try:
+            writer.add_mapping('0x600000-0x604000', len(self.heap))
+            self.assertEqual(writer.update('0x600000-0x604000', 0x1000, self.heap[:0x2000]), [True, True])
+        finally:
+            delta.hash_pages = hash_pages
+        self.assertEqual(writer.changed_pages(), 4)
+        dumpname = os.path.join(self.tmpdir, 'full.dump')
+        os.mkdir(dumpname)
+        writer.save(dumpname)
+        self.assertEqual(os.listdir(dumpname), [])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.folder ."""
+
+from __future__ import print_function
+
+import ctypes
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from haystack import constraints
+from haystack import listmodel
+from haystack.mappings import file
+from haystack.mappings import folder
+from haystack.mappings.base import MetadataMemoryMapping
+from haystack.mappings.file import FilenameBackedMemoryMapping
+from haystack.search import searcher
+from test.haystack.mappings.test_container import make_folder_dump
+
+log = logging.getLogger('test_folder')
+
+
+class TestLazyLoading(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.dumpname = os.path.join(cls.tmpdir, 'test.dump')
+        cls.mappings = [(0x400000, 0x401000, 'r-xp', '/bin/test', None)]
+        for i in range(16):
+            start = 0x600000 + i * 0x10000
+            content = struct.pack('<Q', i) * (0x2000 // 8)
+            cls.mappings.append((start, start + 0x2000, 'rw-p', '[heap]' if i == 0 else '', content))
+        make_folder_dump(cls.dumpname, cls.mappings)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def _load(self, loader_class, capacity):
+        loader = loader_class(self.dumpname, bits=64, os_name='linux')
+        loader.max_open_mappings = capacity
+        return loader, loader.make_memory_handler()
+
+    def test_metadata_only(self):
+        loader, memory_handler = self._load(folder.ProcessMemoryDumpLoader, 4)
+        mappings = memory_handler.get_mappings()
+        self.assertEqual(len(mappings), 17)
+        # absent file
+        self.assertEqual(type(mappings[0]), MetadataMemoryMapping)
+        self.assertFalse(mappings[0].get_page_presence().any())
+        for m in mappings[1:]:
+            self.assertIsInstance(m, FilenameBackedMemoryMapping)
+        self.assertLessEqual(len(loader._lru), 4)
+
+    def _count_fds(self):
+        return len(os.listdir('/proc/self/fd'))
+
+    def test_lru(self):
+        loader, memory_handler = self._load(folder.ProcessMemoryDumpLoader, 4)
+        mappings = memory_handler.get_mappings()[1:]
+        fds = None
+        if os.path.isdir('/proc/self/fd'):
+            fds = self._count_fds()
+        for i, m in enumerate(mappings):
+            self.assertEqual(m.read_word(m.start + 0x1ff8), i)
+            # the first mapping is read often
+            self.assertEqual(mappings[0].read_word(mappings[0].start), 0)
+            self.assertLessEqual(len(loader._lru), 4)
+        self.assertGreaterEqual(loader._lru.released, 11)
+        self.assertTrue(mappings[0].is_mmaped())
+        self.assertFalse(mappings[1].is_mmaped())
+        if fds is not None:
+            # the released mmaps are closed
+            self.assertLessEqual(self._count_fds(), fds + 4)
+        # a released mapping is mmap-ed again on read
+        self.assertEqual(mappings[1].read_bytes(mappings[1].start, 8), struct.pack('<Q', 1))
+        self.assertTrue(mappings[1].is_mmaped())
+        memory_handler.reset_mappings()
+        self.assertEqual(len(loader._lru), 0)
+
+    def test_pinned(self):
+        loader, memory_handler = self._load(folder.ProcessMemoryDumpLoader, 4)
+        mappings = memory_handler.get_mappings()[1:]
+        record = mappings[0].read_struct(mappings[0].start + 8, ctypes.c_uint64)
+        for i, m in enumerate(mappings[1:]):
+            m.read_word(m.start)
+            self.assertLessEqual(len(loader._lru), 4)
+        # the record pins its mapping
+        self.assertTrue(mappings[0].has_live_records())
+        self.assertTrue(mappings[0].is_mmaped())
+        self.assertEqual(record.value, 0)
+        del record
+        self.assertFalse(mappings[0].has_live_records())
+        mappings[1].read_word(mappings[1].start)
+        self.assertFalse(mappings[0].is_mmaped())
+
+    def test_release(self):
+        hack = file.MMAP_HACK_ACTIVE
+        try:
+            for file.MMAP_HACK_ACTIVE in [True, False]:
+                loader, memory_handler = self._load(folder.ProcessMemoryDumpLoader, 4)
+                m = memory_handler.get_mappings()[2]
+                record = m.read_struct(m.start + 8, ctypes.c_uint64)
+                array = m.read_array(m.start, ctypes.c_uint64, 4)
+                m.release()
+                self.assertFalse(m.is_mmaped())
+                # the records keep the content alive
+                self.assertEqual(record.value, 1)
+                self.assertEqual(list(array), [1] * 4)
+                m.release()
+                del record, array
+        finally:
+            file.MMAP_HACK_ACTIVE = hack
+
+    def test_lazy(self):
+        loader, memory_handler = self._load(folder.LazyProcessMemoryDumpLoader, 4)
+        mappings = memory_handler.get_mappings()
+        self.assertTrue(mappings[1].is_mmaped())
+        self.assertFalse(mappings[2].is_mmaped())
+        loader, memory_handler = self._load(folder.VeryLazyProcessMemoryDumpLoader, 4)
+        mappings = memory_handler.get_mappings()
+        self.assertFalse(mappings[1].is_mmaped())
+        self.assertEqual(mappings[16].read_word(mappings[16].start), 15)
+
+class TestHeapsOnly(unittest.TestCase):
+    """ a dump of the heaps only, where the pointers to the other mappings point to placeholders """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.dumpname = os.path.join(cls.tmpdir, 'test.dump')
+        heap = bytearray(0x2000)
+        # magic, next. the last node points to the stack, that was not dumped
+        for addr, next_addr in [(0x600000, 0x600100), (0x600100, 0), (0x600200, 0x600300), (0x600300, 0x7ffff000)]:
+            struct.pack_into('<QQ', heap, addr - 0x600000, 0xcafe, next_addr)
+        # a list entry in the heap, linked to the stack
+        struct.pack_into('<QQ', heap, 0x400, 0x7ffff000, 0x7ffff010)
+        cls.mappings = [(0x400000, 0x401000, 'r-xp', '/bin/test', None),
+                        (0x600000, 0x602000, 'rw-p', '[heap]', bytes(heap)),
+                        (0x7ffff000, 0x80001000, 'rw-p', '[stack]', None)]
+        make_folder_dump(cls.dumpname, cls.mappings)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.memory_handler = folder.ProcessMemoryDumpLoader(self.dumpname, bits=64,
+                                                             os_name='linux').make_memory_handler()
+        my_ctypes = self.memory_handler.get_target_platform().get_target_ctypes()
+
+        class Node(my_ctypes.Structure):
+            pass
+        Node._fields_ = [('magic', my_ctypes.c_uint64),
+                         ('next', my_ctypes.POINTER(Node))]
+        self.Node = Node
+        self.constraints = constraints.ModuleConstraints()
+        node_constraints = constraints.RecordConstraints()
+        node_constraints['magic'] = [0xcafe]
+        self.constraints.set_constraints('Node', node_constraints)
+
+    def test_placeholders_are_invalid(self):
+        stack = self.memory_handler.get_mapping_for_address(0x7ffff000)
+        self.assertIsInstance(stack, MetadataMemoryMapping)
+        self.assertFalse(self.memory_handler.is_valid_address_value(0x7ffff000))
+        self.assertFalse(self.memory_handler.is_valid_address_value(0x7ffff000, self.Node))
+        self.assertEqual(self.memory_handler.are_valid_address_values([0x600000, 0x7ffff000]).tolist(),
+                         [True, False])
+        self.assertEqual(self.memory_handler.read_words([0x600000]).tolist(), [0xcafe])
+        self.assertRaises(ValueError, self.memory_handler.read_words, [0x600000, 0x7ffff000])
+        self.assertRaises(ValueError, self.memory_handler.read_struct_many, [0x7ffff000], self.Node)
+
+    def test_validation(self):
+        validator = listmodel.ListModel(self.memory_handler, self.constraints)
+        heap = self.memory_handler.get_mapping_for_address(0x600000)
+        self.assertTrue(validator.load_members(heap.read_struct(0x600000, self.Node), 10))
+        # the pointer to the placeholder is an invalid pointer
+        self.assertFalse(validator.load_members(heap.read_struct(0x600200, self.Node), 10))
+
+    def test_search(self):
+        heap = self.memory_handler.get_mapping_for_address(0x600000)
+        stack = self.memory_handler.get_mapping_for_address(0x7ffff000)
+        my_searcher = searcher.AnyOffsetRecordSearcher(self.memory_handler, self.constraints, [heap, stack])
+        results = my_searcher.search(self.Node)
+        self.assertEqual(sorted(addr for _, addr in results), [0x600000, 0x600100])
+
+    def test_walk_lists(self):
+        members, bad_links = listmodel.walk_double_linked_lists(self.memory_handler, [(0x7ffff000, 0x7ffff010)],
+                                                                16, 0, 8, [{0x600400}])
+        self.assertEqual(bad_links, {0: 0x7ffff010})
+        self.assertEqual(len(members[0]), 0)
+        # batched
+        links = [(0x7ffff000, 0x7ffff010)] * 16
+        members, bad_links = listmodel.walk_double_linked_lists(self.memory_handler, links, 16, 0, 8,
+                                                                [{0x600400}] * 16)
+        self.assertEqual(sorted(bad_links.keys()), list(range(16)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
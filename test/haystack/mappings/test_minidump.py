@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.minidump ."""
+
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from haystack.mappings import minidump
+
+log = logging.getLogger('test_minidump')
+
+
+def make_minidump(filename, ranges, modules, architecture=9, major_version=6, infos=True):
+    """
+    Write a minimal full memory Minidump.
+
+    :param ranges: list of (start, content, protect)
+    :param modules: list of (base, size, name)
+    """
+    streams = []
+    # SystemInfoStream
+    streams.append((minidump.SYSTEM_INFO_STREAM,
+                    struct.pack('<HHHBBIIIIIHH24x', architecture, 6, 0, 4, 1, major_version, 1, 7601, 2, 0, 0, 0)))
+    # ThreadListStream, one thread without context
+    streams.append((minidump.THREAD_LIST_STREAM,
+                    struct.pack('<IIIIIQQIIII', 1, 0x1234, 0, 0x20, 0, 0x7ffde000, 0x12f000, 0, 0, 0, 0)))
+    if infos:
+        entries = b''.join([struct.pack('<QQIIQIIII', start, start, protect, 0, len(content), 0x1000, protect, 0x20000, 0)
+                            for start, content, protect in ranges])
+        streams.append((minidump.MEMORY_INFO_LIST_STREAM, struct.pack('<IIQ', 16, 48, len(ranges)) + entries))
+    # the module names are written after the module list
+    module_list_size = 4 + 108 * len(modules)
+    nb_streams = len(streams) + 2
+    offset = 32 + 12 * nb_streams + sum(len(data) for _, data in streams)
+    names_rva = offset + module_list_size
+    module_list = struct.pack('<I', len(modules))
+    names = b''
+    for base, size, name in modules:
+        encoded = name.encode('utf-16-le')
+        module_list += struct.pack('<QIIII', base, size, 0, 0, names_rva + len(names)) + b'\x00' * 84
+        names += struct.pack('<I', len(encoded)) + encoded
+    streams.append((minidump.MODULE_LIST_STREAM, module_list + names))
+    offset += len(module_list) + len(names)
+    base_rva = offset + 16 + 16 * len(ranges)
+    memory_list = struct.pack('<QQ', len(ranges), base_rva)
+    memory_list += b''.join([struct.pack('<QQ', start, len(content)) for start, content, protect in ranges])
+    streams.append((minidump.MEMORY64_LIST_STREAM, memory_list))
+    # layout
+    header = struct.pack('<4sHHIIIIQ', b'MDMP', 0xa793, 0, nb_streams, 32, 0, 0, 2)
+    directory = b''
+    data = b''
+    rva = 32 + 12 * nb_streams
+    for stream_type, content in streams:
+        directory += struct.pack('<III', stream_type, len(content), rva + len(data))
+        data += content
+    with open(filename, 'wb') as fout:
+        fout.write(header + directory + data + b''.join([content for start, content, protect in ranges]))
+
+
+class TestMinidumpLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'test.dmp')
+        self.ranges = [(0x10000, b'\x01' * 0x1000, 0x04),
+                       (0x400000, b'MZ' + b'\x00' * 0x1ffe, 0x02),
+                       (0x402000, b'\x90' * 0x1000, 0x20),
+                       (0x7ff0000, b'\x02' * 0x3000, 0x04)]
+        self.modules = [(0x7ff0000, 0x1000, u'C:\\Windows\\System32\\ntdll.dll'),
+                        (0x400000, 0x3000, u'C:\\test.exe')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        make_minidump(self.filename, self.ranges, self.modules)
+        loader = minidump.MinidumpLoader(self.filename)
+        memory_handler = loader.make_memory_handler()
+        self.assertEqual(memory_handler.get_target_platform().get_cpu_bits(), 64)
+        self.assertEqual(memory_handler.get_target_platform().get_os_name(), 'win7')
+        mappings = memory_handler.get_mappings()
+        self.assertEqual([(m.start, m.end) for m in mappings],
+                         [(start, start + len(content)) for start, content, protect in self.ranges])
+        self.assertEqual([m.pathname for m in mappings],
+                         ['None', u'C:\\test.exe', u'C:\\test.exe', u'C:\\Windows\\System32\\ntdll.dll'])
+        self.assertEqual([m.permissions for m in mappings], ['rw-', 'r--', 'r-x', 'rw-'])
+        self.assertEqual(mappings[1].read_bytes(0x400000, 2), b'MZ')
+        self.assertEqual(mappings[3].read_bytes(0x7ff2ffc, 4), b'\x02' * 4)
+        # other streams are parsed on demand
+        threads = loader.get_threads()
+        self.assertEqual(len(threads), 1)
+        self.assertEqual(threads[0].ThreadId, 0x1234)
+        self.assertEqual(loader.get_handles(), [])
+
+    def test_no_memory_info(self):
+        make_minidump(self.filename, self.ranges, [], architecture=0, major_version=5, infos=False)
+        memory_handler = minidump.MinidumpLoader(self.filename).make_memory_handler()
+        self.assertEqual(memory_handler.get_target_platform().get_cpu_bits(), 32)
+        self.assertEqual(memory_handler.get_target_platform().get_os_name(), 'winxp')
+        self.assertEqual(set(m.permissions for m in memory_handler.get_mappings()), set(['r--']))
+
+    def test_module_index(self):
+        index = minidump.ModuleIndex([0x400000, 0x10000], [0x3000, 0x1000], ['b', 'a'])
+        self.assertEqual(index.lookup([0x1000, 0x10000, 0x10fff, 0x11000, 0x402fff, 0x403000]),
+                         [None, 'a', 'a', None, 'b', None])
+
+    def test_protect(self):
+        self.assertEqual(minidump.protect_to_string(0x04 | 0x100), 'rw-')
+        self.assertEqual(minidump.protect_to_string(0x40), 'rwx')
+        self.assertEqual(minidump.protect_to_string(0), '---')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
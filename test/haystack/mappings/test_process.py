@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.mappings.process live snapshots."""
+
+from __future__ import print_function
+
+import logging
+import unittest
+
+from haystack.mappings import process
+from haystack.mappings.file import LocalMemoryMapping
+from test.haystack.test_dbg import start_child
+
+log = logging.getLogger('test_process')
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.process, self.address = start_child()
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def test_snapshot(self):
+        try:
+            memory_handler = process.make_snapshot_memory_handler(self.process.pid)
+        except (OSError, NotImplementedError) as e:
+            self.skipTest('process_vm_readv is not usable: %s' % e)
+        heap = memory_handler.get_mapping_for_address(self.address)
+        self.assertIsInstance(heap, LocalMemoryMapping)
+        self.assertEqual(heap.read_bytes(self.address, 16), b'haystack' * 2)
+        # the other mappings are read live
+        binary = [m for m in memory_handler.get_mappings() if m.pathname.startswith('/')][0]
+        self.assertIsInstance(binary, process.ProcessMemoryMapping)
+        self.assertEqual(binary.read_bytes(binary.start, 4), b'\x7fELF')
+        with open('/proc/%d/stat' % self.process.pid) as fin:
+            self.assertNotIn(fin.read().rsplit(')', 1)[1].split()[0], ['T', 't'])
+
+
+    def test_read_bytes_many(self):
+        try:
+            memory_handler = process.make_snapshot_memory_handler(self.process.pid)
+        except (OSError, NotImplementedError) as e:
+            self.skipTest('process_vm_readv is not usable: %s' % e)
+        binary = [m for m in memory_handler.get_mappings() if m.pathname.startswith('/')][0]
+        addresses = [binary.start + 0x20, binary.start, binary.start + 0x10]
+        self.assertEqual(binary.read_bytes_many(addresses, 4), [binary.read_bytes(a, 4) for a in addresses])
+        self.assertEqual(binary.read_words(addresses).tolist(), [binary.read_word(a) for a in addresses])
+        # the heap is a snapshot
+        self.assertEqual(memory_handler.read_bytes_many([self.address, binary.start], 4), [b'hays', b'\x7fELF'])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.outputters.jsonl ."""
+
+import io
+import json
+import logging
+import struct
+import unittest
+
+from haystack import target
+from haystack.mappings import base
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.file import LocalMemoryMapping
+from haystack.outputters import jsonl
+from haystack.search import api
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+class TestJSONLinesOutputter(unittest.TestCase):
+
+    def setUp(self):
+        self.target = target.TargetPlatform.make_target_platform_local()
+        _ctypes = self.target.get_target_ctypes()
+        ws = _ctypes.sizeof(_ctypes.c_void_p)
+
+        class Node(_ctypes.Structure):
+            pass
+        Node._fields_ = [('value', _ctypes.c_uint32),
+                         ('name', _ctypes.c_char * 8),
+                         ('data', _ctypes.c_void_p),
+                         ('next', _ctypes.POINTER(Node))]
+        self.Node = Node
+        memory = bytearray(0x1000)
+        # a ring of 3 nodes, and a node pointing to an unloaded record
+        self.nodes = [0x10000, 0x10100, 0x10200, 0x10300]
+        following = self.nodes[1:3] + self.nodes[:1] + [0x10800]
+        fmt = 'I8s%s' % ('Q' if ws == 8 else 'I')
+        for i, (addr, next_addr) in enumerate(zip(self.nodes, following)):
+            offset = addr - 0x10000
+            struct.pack_into(fmt, memory, offset, i, b'node%d' % i, 0x10900)
+            struct.pack_into('Q' if ws == 8 else 'I', memory, offset + Node.next.offset, next_addr)
+        mapping = LocalMemoryMapping.fromBytebuffer(AMemoryMapping(0x10000, 0x11000, 'rw-p', 0, 0, 0, 0, ''),
+                                                    bytes(memory))
+        self.memory_handler = base.MemoryHandler([mapping], self.target, 'test')
+        self.records = []
+        for addr in self.nodes:
+            record = mapping.read_struct(addr, Node)
+            self.memory_handler.keepRef(record, Node, addr)
+            self.records.append(record)
+
+    def test_write(self):
+        results = [(self.records[0], self.nodes[0]), (self.records[1], self.nodes[1]),
+                   (self.records[3], self.nodes[3])]
+        stream = io.StringIO()
+        self.assertEqual(api.output_to_json_lines(self.memory_handler, results, stream), 3)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        first, second, third = [json.loads(line) for line in lines]
+        self.assertEqual(first['address'], self.nodes[0])
+        self.assertEqual(first['type'], 'Node')
+        self.assertEqual(first['value']['value'], 0)
+        self.assertEqual(first['value']['name'], 'node0')
+        self.assertEqual(first['value']['data'], 0x10900)
+        # the ring is written once, then referenced
+        node1 = first['value']['next']
+        self.assertEqual(node1['name'], 'node1')
+        node2 = node1['next']
+        self.assertEqual(node2['value'], 2)
+        self.assertEqual(node2['next'], {'$ref': self.nodes[0]})
+        # a result already written in a previous line
+        self.assertEqual(second['address'], self.nodes[1])
+        self.assertEqual(second['value']['name'], 'node1')
+        self.assertEqual(second['value']['next'], {'$ref': self.nodes[2]})
+        # an unloaded pointee is its address
+        self.assertEqual(third['value']['next'], 0x10800)
+
+    def test_layout_cache(self):
+        parser = jsonl.JSONLinesOutputter(self.memory_handler)
+        parser.encode(self.records[0], self.nodes[0])
+        self.assertEqual(list(parser._layouts.keys()), [self.Node])
+        kinds = [kind for name, kind, attrtype in parser._layouts[self.Node]]
+        self.assertEqual(kinds, [jsonl.BASIC, jsonl.BASIC_ARRAY, jsonl.POINTER, jsonl.POINTER])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
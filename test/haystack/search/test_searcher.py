@@ -4,9 +4,13 @@
 import logging
 import unittest
 
+from haystack import target
 from haystack.search import api
 from haystack.search import searcher
 from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MemoryHandler
+from haystack.mappings.file import LocalMemoryMapping
 
 
 class TestApiWin32Dump(unittest.TestCase):
@@ -84,6 +88,27 @@ class TestApiWin32Dump(unittest.TestCase):
         return
 
 
+
+class TestAnyOffsetZeroPages(unittest.TestCase):
+    """
+    test that the any offset search skips zero pages
+    """
+
+    def test_iter_offsets(self):
+        my_target = target.TargetPlatform.make_target_linux_64()
+        content = b'\x00' * 0x2000 + b'\x01' * 0x1000 + b'\x00' * 0x3000
+        mapping = LocalMemoryMapping.fromBytebuffer(AMemoryMapping(0x10000, 0x16000, 'rw-p', 0, 0, 0, 0, 'None'),
+                                                    content)
+        mapping.set_ctypes(my_target.get_target_ctypes())
+        memory_handler = MemoryHandler([mapping], my_target, 'test')
+        my_searcher = searcher.AnyOffsetRecordSearcher(memory_handler, target_mappings=[mapping])
+        offsets = list(my_searcher._iter_offsets(mapping, 0x10000, 0x16000 - 0x20 + 1, 8, 0x20))
+        # records that overlap the only data page
+        self.assertEqual(offsets[0], 0x12000 - 0x18)
+        self.assertEqual(offsets[-1], 0x12ff8)
+        self.assertEqual(len(offsets), (0x1000 + 0x18) // 8)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     # logging.getLogger('searcher').setLevel(logging.DEBUG)
@@ -42,6 +42,14 @@ class Test(unittest.TestCase):
         return
 
 
+    def test_positive_int(self):
+        """test the positive_int helper."""
+        self.assertRaises(argparse.ArgumentTypeError, argparse_utils.positive_int, 'a')
+        self.assertRaises(argparse.ArgumentTypeError, argparse_utils.positive_int, '0')
+        self.assertRaises(argparse.ArgumentTypeError, argparse_utils.positive_int, '-2')
+        self.assertEqual(argparse_utils.positive_int('4'), 4)
+        return
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.WARNING)
     #logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import unittest
 
 from haystack import cli
@@ -49,6 +53,80 @@ class TestCLI(SrcTests):
         return
 
 
+class TestArguments(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.parser = cli.base_argparser('haystack-test', 'test')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_workers(self):
+        opts = self.parser.parse_args(['--workers', '4', 'dir://%s' % self.tmpdir])
+        self.assertEqual(opts.workers, 4)
+        self.assertEqual(self.parser.parse_args(['dir://%s' % self.tmpdir]).workers, 1)
+        for value in ['0', '-2', 'x']:
+            with captured_output():
+                self.assertRaises(SystemExit, self.parser.parse_args, ['--workers', value, 'dir://%s' % self.tmpdir])
+
+
+# modules that a dir:// start must not import
+HEAVY_MODULES = ['pkg_resources', 'importlib.metadata', 'ptrace', 'construct', 'pefile',
+                 'haystack.mappings.minidump', 'haystack.mappings.vol', 'haystack.mappings.rek',
+                 'haystack.mappings.fridaprocess']
+STARTUP_CODE = """
+from haystack import cli
+parser = cli.base_argparser('haystack-test', 'test')
+opts = parser.parse_args(['dir://%s'])
+loader = cli.SUPPORTED_DUMP_URI[opts.target.scheme]
+"""
+
+
+def measure_import_time(code, env=None):
+    """
+    Runs python -X importtime on that code.
+
+    :return: dict of the cumulative import time in microseconds, by module name
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode())
+    timings = dict()
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = int(cumulative)
+    return timings
+
+
+class TestStartup(unittest.TestCase):
+    """Startup benchmark of the console scripts for a dir:// dump"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        self.env['XDG_CACHE_HOME'] = self.tmpdir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_import_time(self):
+        code = STARTUP_CODE % self.tmpdir
+        # the first start reads the plugins entry points
+        measure_import_time(code, self.env)
+        timings = measure_import_time(code, self.env)
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, timings)
+        logging.getLogger('test_cli').info('haystack.cli imported in %d ms', timings['haystack.cli'] // 1000)
+        slowest = sorted(timings.items(), key=lambda x: x[1], reverse=True)[:10]
+        for name, cumulative in slowest:
+            logging.getLogger('test_cli').debug('%8d us %s', cumulative, name)
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     # logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.dbg process_vm_readv reader."""
+
+from __future__ import print_function
+
+import ctypes
+import logging
+import subprocess
+import sys
+import unittest
+
+from haystack import dbg
+
+log = logging.getLogger('test_dbg')
+
+# a child process with a known buffer in its heap
+CHILD = ("import ctypes, sys, time; b = ctypes.create_string_buffer(b'haystack' * 0x2000, 0x10000); "
+         "print(ctypes.addressof(b)); sys.stdout.flush(); time.sleep(60)")
+
+
+def start_child():
+    process = subprocess.Popen([sys.executable, '-c', CHILD], stdout=subprocess.PIPE)
+    address = int(process.stdout.readline())
+    return process, address
+
+
+class TestProcessVMReadv(unittest.TestCase):
+
+    def setUp(self):
+        self.process, self.address = start_child()
+        self.reader = dbg.ProcessVMReadvProcess(self.process.pid)
+        try:
+            self.reader.read_bytes_many([(self.address, 8)])
+        except (OSError, NotImplementedError) as e:
+            self.tearDown()
+            self.skipTest('process_vm_readv is not usable: %s' % e)
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def test_read(self):
+        self.assertEqual(self.reader.read_bytes(self.address + 0xffc, 8), b'tackhays')
+        self.assertEqual(self.reader.read_word(self.address), ctypes.c_uint64.from_buffer_copy(b'haystack').value)
+        record = self.reader.read_struct(self.address + 8, ctypes.c_char * 8)
+        self.assertEqual(record.raw, b'haystack')
+        self.assertEqual(bytes(bytearray(self.reader.read_array(self.address, ctypes.c_ubyte, 3))), b'hay')
+        # bypass the cache
+        self.assertEqual(self.reader.read_bytes(self.address, 0x10000), b'haystack' * 0x2000)
+        self.assertRaises(OSError, self.reader.read_bytes, 0x10, 8)
+
+    def test_read_many(self):
+        ranges = [(self.address, 8), (0x10, 8), (self.address + 0x8000, 0x10)]
+        self.assertEqual(self.reader.read_bytes_many(ranges), [b'haystack', None, b'haystack' * 2])
+        # more ranges than IOV_MAX
+        ranges = [(self.address + i * 8, 8) for i in range(dbg.IOV_MAX + 10)]
+        self.assertEqual(set(self.reader.read_bytes_many(ranges)), set([b'haystack']))
+
+    def test_cache(self):
+        self.reader.read_bytes(self.address, 8)
+        self.reader.read_bytes(self.address + 8, 8)
+        self.assertEqual(self.reader.hits, 1)
+        self.reader.max_age = 0
+        self.reader.read_bytes(self.address + 8, 8)
+        self.assertEqual(self.reader.hits, 1)
+
+    def test_stop(self):
+        debugger = dbg.ProcessVMReadvDebugger(self.process.pid, stop=True)
+        self.assertIn(debugger.get_process()._get_state(), ['T', 't'])
+        debugger.quit()
+        self.assertNotIn(debugger.get_process()._get_state(), ['T', 't'])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
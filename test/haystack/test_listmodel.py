@@ -4,11 +4,20 @@
 """Tests haystack.listmodel ."""
 
 import logging
+import struct
 import sys
+import timeit
 import unittest
 
+import numpy
+
 from haystack import constraints
+from haystack import listmodel
+from haystack import target
+from haystack.mappings import base
 from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.file import LocalMemoryMapping
 from test.haystack import SrcTests
 from test.src import ctypes6
 
@@ -115,6 +124,134 @@ class TestListStructTest6(SrcTests):
         return
 
 
+
+class TestWalkDoubleLinkedLists(unittest.TestCase):
+
+    def setUp(self):
+        self.target = target.TargetPlatform.make_target_platform_local()
+        _ctypes = self.target.get_target_ctypes()
+        self.ws = _ctypes.sizeof(_ctypes.c_void_p)
+
+        class Entry(_ctypes.Structure):
+            _fields_ = [('flink', _ctypes.c_void_p),
+                        ('blink', _ctypes.c_void_p)]
+        self.Entry = Entry
+        memory = bytearray(0x1000)
+        # a circular list
+        self.head = 0x10000
+        self.circular = [0x10100, 0x10200, 0x10300]
+        ring = [self.head] + self.circular
+        self._link(memory, ring[-1:] + ring + ring[:1])
+        # a null terminated list
+        self.terminated = [0x10400, 0x10500]
+        self._link(memory, [0] + self.terminated + [0])
+        # a list with a bad link
+        self._link(memory, [0, 0x10600, 0x90000])
+        mapping = LocalMemoryMapping.fromBytebuffer(AMemoryMapping(0x10000, 0x11000, 'rw-p', 0, 0, 0, 0, ''),
+                                                    bytes(memory))
+        self.memory_handler = base.MemoryHandler([mapping], self.target, 'test')
+
+    def _link(self, memory, nodes):
+        fmt = 'Q' if self.ws == 8 else 'I'
+        for previous, node, following in zip(nodes, nodes[1:], nodes[2:]):
+            struct.pack_into(fmt * 2, memory, node - 0x10000, following, previous)
+
+    def _read_links(self, addr):
+        entry = self.memory_handler.get_mapping_for_address(addr).read_struct(addr, self.Entry)
+        return entry.flink or 0, entry.blink or 0
+
+    def test_walk(self):
+        links = [self._read_links(self.head), self._read_links(0x10500), self._read_links(0x10600), (0, 0)]
+        sentinels = [{self.head}, set(), set(), set()]
+        members, bad_links = listmodel.walk_double_linked_lists(self.memory_handler, links, 2 * self.ws, 0, self.ws,
+                                                                sentinels)
+        self.assertEqual(len(members), 4)
+        self.assertEqual(sorted(members[0].tolist()), self.circular)
+        self.assertEqual(sorted(members[1].tolist()), self.terminated)
+        self.assertEqual(len(members[3]), 0)
+        self.assertEqual(bad_links, {2: 0x90000})
+        # the head is a member of its list, when it is not a sentinel
+        members, bad_links = listmodel.walk_double_linked_lists(self.memory_handler, links[:1], 2 * self.ws, 0, self.ws)
+        self.assertEqual(sorted(members[0].tolist()), [self.head] + self.circular)
+
+    def test_iterate_double_linked_list(self):
+        validator = listmodel.ListModel(self.memory_handler, None)
+        validator.register_double_linked_list_record_type(self.Entry, 'flink', 'blink')
+        head = self.memory_handler.get_mapping_for_address(self.head).read_struct(self.head, self.Entry)
+        nodes = [addr for addr in validator._iterate_double_linked_list(head, {self.head})]
+        self.assertEqual(sorted(nodes), self.circular)
+        self.assertIsNotNone(self.memory_handler.getRef(self.Entry, self.circular[1]))
+        bad = self.memory_handler.get_mapping_for_address(0x10600).read_struct(0x10600, self.Entry)
+        self.assertRaises(ValueError, list, validator._iterate_double_linked_list(bad))
+        heads = [head, bad]
+        members, bad_links = validator.get_double_linked_lists_members(heads, [{self.head}, set()])
+        self.assertEqual(sorted(members[0].tolist()), self.circular)
+        self.assertEqual(bad_links, {1: 0x90000})
+
+    def test_cross_arch(self):
+        """ 32 bits lists in a 64 bits memory handler, the links are read with the validator word size """
+        my_target = target.TargetPlatform.make_target_linux_64()
+        ctypes32 = target.TargetPlatform.make_target_win_32('win7').get_target_ctypes()
+
+        class Entry32(ctypes32.Structure):
+            _fields_ = [('flink', ctypes32.c_void_p),
+                        ('blink', ctypes32.c_void_p)]
+        memory = bytearray(0x10000)
+        # 32 rings of 4 nodes, with the nodes of the rings interleaved
+        rings = [[0x10000 + 0x100 * j + 8 * i for j in range(4)] for i in range(32)]
+        for ring in rings:
+            for previous, node, following in zip(ring[-1:] + ring, ring, ring[1:] + ring[:1]):
+                struct.pack_into('<II', memory, node - 0x10000, following, previous)
+        mapping = LocalMemoryMapping.fromBytebuffer(AMemoryMapping(0x10000, 0x20000, 'rw-p', 0, 0, 0, 0, ''),
+                                                    bytes(memory))
+        memory_handler = base.MemoryHandler([mapping], my_target, 'test')
+        validator = listmodel.ListModel(memory_handler, None, ctypes32)
+        validator.register_double_linked_list_record_type(Entry32, 'flink', 'blink')
+        heads = [mapping.read_struct(ring[0], Entry32) for ring in rings]
+        # one list, walked one node at a time
+        members, bad_links = validator.get_double_linked_lists_members(heads[:1], [{rings[0][0]}])
+        self.assertEqual(bad_links, {})
+        self.assertEqual(sorted(members[0].tolist()), rings[0][1:])
+        # many lists, walked in batches
+        members, bad_links = validator.get_double_linked_lists_members(heads, [{ring[0]} for ring in rings])
+        self.assertEqual(bad_links, {})
+        for ring, ring_members in zip(rings, members):
+            self.assertEqual(sorted(ring_members.tolist()), ring[1:])
+        nodes = [addr for addr in validator._iterate_double_linked_list(heads[0], {rings[0][0]})]
+        self.assertEqual(sorted(nodes), rings[0][1:])
+
+    def _make_long_lists(self, count, length):
+        """ count circular lists of length nodes, the nodes of a list are interleaved with the others """
+        nodes = 0x100000 + numpy.arange(count * length, dtype=numpy.uint64).reshape(length, count).T * (2 * self.ws)
+        flinks = numpy.roll(nodes, -1, axis=1)
+        blinks = numpy.roll(nodes, 1, axis=1)
+        memory = numpy.zeros((count * length, 2), dtype=numpy.dtype('u%d' % self.ws))
+        offsets = ((nodes - 0x100000) // (2 * self.ws)).astype(numpy.intp)
+        memory[offsets, 0] = flinks
+        memory[offsets, 1] = blinks
+        mapping = LocalMemoryMapping.fromBytebuffer(
+            AMemoryMapping(0x100000, 0x100000 + memory.nbytes, 'rw-p', 0, 0, 0, 0, ''), memory.tobytes())
+        memory_handler = base.MemoryHandler([mapping], self.target, 'test')
+        links = [(int(flinks[i, 0]), int(blinks[i, 0])) for i in range(count)]
+        return memory_handler, nodes, links
+
+    def test_walk_long_lists(self):
+        # one long list is walked in linear time
+        memory_handler, nodes, links = self._make_long_lists(1, 32768)
+        members = []
+
+        def walk():
+            members[:] = listmodel.walk_double_linked_lists(memory_handler, links, 2 * self.ws, 0, self.ws)[0]
+        self.assertLess(timeit.timeit(walk, number=1), 2.0)
+        self.assertEqual(sorted(members[0].tolist()), sorted(nodes[0].tolist()))
+        # many long lists are walked in batches
+        memory_handler, nodes, links = self._make_long_lists(64, 1024)
+        self.assertLess(timeit.timeit(walk, number=1), 2.0)
+        self.assertEqual(len(members), 64)
+        for i in range(64):
+            self.assertEqual(sorted(members[i].tolist()), sorted(nodes[i].tolist()))
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     # logging.getLogger("listmodel").setLevel(level=logging.DEBUG)
@@ -15,6 +15,12 @@ import time
 import unittest
 
 from haystack import memory_dumper
+from haystack import target
+from haystack.mappings import delta
+from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from haystack.mappings.base import MemoryHandler
+from haystack.mappings.base import MetadataMemoryMapping
 
 __author__ = "Loic Jaquemet"
 __copyright__ = "Copyright (C) 2012 Loic Jaquemet"
@@ -266,6 +272,178 @@ class TestMemoryDumper32(TestMemoryDumper):
             pass
 
 
+class TestStreamingDumper(unittest.TestCase):
+
+    """Tests the chunked /proc/pid/mem reader and the writer threads, without ptrace."""
+
+    def setUp(self):
+        self.process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+        time.sleep(0.2)
+        self.tgt = tempfile.mkdtemp()
+        if not os.access('/proc/%d/mem' % self.process.pid, os.R_OK):
+            self.tearDown()
+            self.skipTest('/proc/pid/mem is not readable')
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+        shutil.rmtree(self.tgt)
+
+    def _make_memory_handler(self):
+        mappings = []
+        with open('/proc/%d/maps' % self.process.pid) as fin:
+            for line in fin:
+                fields = line.split()
+                start, end = [int(x, 16) for x in fields[0].split('-')]
+                major, minor = [int(x, 16) for x in fields[3].split(':')]
+                pathname = fields[5] if len(fields) > 5 else ''
+                mappings.append(AMemoryMapping(start, end, fields[1], int(fields[2], 16),
+                                               major, minor, int(fields[4]), pathname))
+        return MemoryHandler(mappings, target.TargetPlatform.make_target_linux_64(), 'test')
+
+    def test_dump_chunks(self):
+        dumper = memory_dumper.MemoryDumper(self.process.pid, self.tgt, chunk_size=0x1000, writers=3)
+        dumper._memory_handler = self._make_memory_handler()
+        dumper._dump_all_mappings(self.tgt)
+        self.assertGreater(dumper.stats['bytes'], 0)
+        self.assertIn('throughput', dumper.stats)
+        self.assertIn('skipped_pages', dumper.stats)
+        # the index and the files agree
+        dumped = folder.ProcessMemoryDumpLoader(self.tgt, bits=64, os_name='linux').make_memory_handler()
+        self.assertGreater(len(dumped.get_mappings()), 0)
+        self.assertNotIn('[vvar]', [m.pathname for m in dumped.get_mappings()])
+        fd = os.open('/proc/%d/mem' % self.process.pid, os.O_RDONLY)
+        try:
+            for m in dumped.get_mappings():
+                self.assertEqual(os.path.getsize(os.path.join(self.tgt, '0x%016x-0x%016x' % (m.start, m.end))), len(m))
+                # read only mappings do not change
+                if m.permissions.startswith('r--'):
+                    self.assertEqual(m.read_bytes(m.start, len(m)), os.pread(fd, len(m), m.start))
+        finally:
+            os.close(fd)
+
+    def test_dump_incremental(self):
+        full = os.path.join(self.tgt, 'full')
+        incremental = os.path.join(self.tgt, 'incremental')
+        dumper = memory_dumper.MemoryDumper(self.process.pid, full)
+        dumper._memory_handler = self._make_memory_handler()
+        os.mkdir(full)
+        dumper._dump_all_mappings(full)
+        self.assertFalse(delta.is_delta(full))
+        dumper = memory_dumper.MemoryDumper(self.process.pid, incremental, base=full)
+        dumper._memory_handler = self._make_memory_handler()
+        os.mkdir(incremental)
+        dumper._dump_all_mappings(incremental)
+        self.assertTrue(delta.is_delta(incremental))
+        # a sleeping process does not change much
+        self.assertLess(dumper.stats['changed_pages'], dumper.stats['bytes'] // 0x1000 // 2)
+        # the delta dump is overlaid on the base dump
+        full_handler = folder.ProcessMemoryDumpLoader(full, bits=64, os_name='linux').make_memory_handler()
+        delta_handler = folder.ProcessMemoryDumpLoader(incremental, bits=64, os_name='linux').make_memory_handler()
+        self.assertEqual(len(full_handler.get_mappings()), len(delta_handler.get_mappings()))
+        for m1, m2 in zip(full_handler.get_mappings(), delta_handler.get_mappings()):
+            self.assertEqual((m1.start, m1.end), (m2.start, m2.end))
+            if m1.permissions.startswith('r--'):
+                self.assertEqual(m1.read_bytes(m1.start, len(m1)), m2.read_bytes(m2.start, len(m2)))
+
+    def test_dump_selection(self):
+        dumper = memory_dumper.MemoryDumper(self.process.pid, self.tgt)
+        dumper._memory_handler = self._make_memory_handler()
+        dumper.set_filters(include=['[stack]'])
+        dumper._dump_all_mappings(self.tgt)
+        self.assertGreater(dumper.stats['metadata_only'], 0)
+        for loader in [folder.ProcessMemoryDumpLoader, folder.VeryLazyProcessMemoryDumpLoader]:
+            dumped = loader(self.tgt, bits=64, os_name='linux').make_memory_handler()
+            self.assertEqual(len(dumped.get_mappings()), dumper.stats['metadata_only'] + 1)
+            for m in dumped.get_mappings():
+                if m.pathname == '[stack]':
+                    self.assertNotIsInstance(m, MetadataMemoryMapping)
+                else:
+                    # placeholders
+                    self.assertEqual(type(m), MetadataMemoryMapping)
+                    self.assertFalse(m.get_page_presence().any())
+
+
+    def test_writer_errors(self):
+        dumper = memory_dumper.MemoryDumper(self.process.pid, self.tgt, chunk_size=0x1000)
+        dumper._memory_handler = self._make_memory_handler()
+        stack = [m for m in dumper._memory_handler.get_mappings() if m.pathname == '[stack]'][0]
+        stack_filename = dumper._get_mapping_filename(stack)
+        write_sparse = memory_dumper.write_sparse
+
+        def failing_write_sparse(fd, data, offset, keep=None):
+            if os.readlink('/proc/self/fd/%d' % fd).endswith(stack_filename):
+                raise IOError('No space left on device')
+            return write_sparse(fd, data, offset, keep)
+        memory_dumper.write_sparse = failing_write_sparse
+        try:
+            dumper._dump_all_mappings(self.tgt)
+        finally:
+            memory_dumper.write_sparse = write_sparse
+        # the failed mapping is not in the dump
+        self.assertFalse(os.access(os.path.join(self.tgt, stack_filename), os.F_OK))
+        dumped = folder.ProcessMemoryDumpLoader(self.tgt, bits=64, os_name='linux').make_memory_handler()
+        self.assertGreater(len(dumped.get_mappings()), 0)
+        self.assertNotIn('[stack]', [m.pathname for m in dumped.get_mappings()])
+        self.assertNotIn(stack_filename, delta.load_page_hashes(self.tgt))
+
+    def test_writers(self):
+        self.assertRaises(ValueError, memory_dumper.MemoryDumper, self.process.pid, self.tgt, writers=0)
+        parser = memory_dumper.argparser()
+        self.assertEqual(parser.parse_args(['1', 'dump', '--writers', '3']).writers, 3)
+        with open(os.devnull, 'w') as devnull:
+            stderr = sys.stderr
+            sys.stderr = devnull
+            try:
+                self.assertRaises(SystemExit, parser.parse_args, ['1', 'dump', '--writers', '0'])
+            finally:
+                sys.stderr = stderr
+
+
+class FakeWalker(object):
+    def __init__(self, mappings):
+        self._mappings = mappings
+
+    def list_used_mappings(self):
+        return self._mappings
+
+
+class FakeFinder(object):
+    def __init__(self, walkers):
+        self._walkers = walkers
+
+    def list_heap_walkers(self):
+        return self._walkers
+
+
+class TestDumpFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.mappings = [AMemoryMapping(0x400000, 0x401000, 'r-xp', 0, 0, 0, 0, '/bin/test'),
+                         AMemoryMapping(0x600000, 0x700000, 'rw-p', 0, 0, 0, 0, '[heap]'),
+                         AMemoryMapping(0x800000, 0x810000, 'rw-p', 0, 0, 0, 0, ''),
+                         AMemoryMapping(0x900000, 0x901000, 'r--p', 0, 0, 0, 0, '/usr/lib/libc.so.6'),
+                         AMemoryMapping(0x7ffff000, 0x80001000, 'rw-p', 0, 0, 0, 0, '[stack]')]
+        self.memory_handler = MemoryHandler(self.mappings, target.TargetPlatform.make_target_linux_64(), 'test')
+        self.memory_handler.get_heap_finder = lambda: FakeFinder([FakeWalker(self.mappings[1:3])])
+        self.dumper = memory_dumper.MemoryDumper(1, '/tmp/test')
+        self.dumper._memory_handler = self.memory_handler
+
+    def _selected(self, **filters):
+        self.dumper.set_filters(**filters)
+        return [m.pathname for m in self.mappings if self.dumper._is_selected(m)]
+
+    def test_filters(self):
+        self.assertEqual(len(self._selected()), 5)
+        self.assertEqual(self._selected(include=['[stack]', '*libc*']), ['/usr/lib/libc.so.6', '[stack]'])
+        self.assertEqual(self._selected(heaps_only=True), ['[heap]', ''])
+        self.assertEqual(self._selected(heaps_only=True, include=['[stack]']), ['[heap]', '', '[stack]'])
+        self.assertEqual(self._selected(permissions='rw'), ['[heap]', '', '[stack]'])
+        self.assertEqual(self._selected(anon_only=True), ['[heap]', '', '[stack]'])
+        self.assertEqual(self._selected(anon_only=True, max_size=0x10000), ['', '[stack]'])
+        self.assertEqual(self._selected(permissions='x', include=['/bin/*']), ['/bin/test'])
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.WARNING)
     # logging.basicConfig(level=logging.DEBUG)
@@ -3,10 +3,17 @@
 
 """Tests haystack.model ."""
 
+import ctypes
 import logging
+import threading
 import unittest
 
+import numpy
+
 from haystack import model
+from haystack import target
+from haystack import types
+from haystack import utils
 from haystack.mappings import process
 
 
@@ -71,6 +78,128 @@ class TestCopyModule(unittest.TestCase):
         self.assertIn('Struct2_py', good.__dict__.keys())
 
 
+class TestImportModule(unittest.TestCase):
+
+    def setUp(self):
+        model.clear_imported_modules()
+
+    def tearDown(self):
+        model.clear_imported_modules()
+
+    def test_cache(self):
+        ctypes64 = types.build_ctypes_proxy(8, 8, 16)
+        ctypes32 = types.build_ctypes_proxy(4, 4, 12)
+        mod64 = model.Model(ctypes64).import_module("test.src.ctypes5_gen64")
+        # shared between models of the same target
+        self.assertIs(model.Model(ctypes64).import_module("test.src.ctypes5_gen64"), mod64)
+        mod32 = model.Model(ctypes32).import_module("test.src.ctypes5_gen64")
+        self.assertIsNot(mod32, mod64)
+        self.assertIs(mod64.ctypes, ctypes64)
+        self.assertIs(mod32.ctypes, ctypes32)
+        self.assertIs(model.import_module_for_target_ctypes("test.src.ctypes5_gen64", ctypes64), mod64)
+
+    def test_threads(self):
+        targets = [types.build_ctypes_proxy(8, 8, 16), types.build_ctypes_proxy(4, 4, 12),
+                   types.build_ctypes_proxy(4, 4, 8), types.build_ctypes_proxy(8, 8, 8)]
+        results = {}
+
+        def run(i):
+            _ctypes = targets[i % len(targets)]
+            results[i] = (_ctypes, model.import_module_for_target_ctypes("test.src.ctypes5_gen32", _ctypes))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 16)
+        for _ctypes, mod in results.values():
+            self.assertIs(mod.ctypes, _ctypes)
+        self.assertEqual(len(set([id(mod) for _ctypes, mod in results.values()])), len(targets))
+
+
+
+class TestNumpyDtype(unittest.TestCase):
+
+    def setUp(self):
+        model.clear_numpy_dtypes()
+
+    def _make_record(self, _ctypes):
+        class Sub(_ctypes.Structure):
+            _fields_ = [('a', _ctypes.c_ubyte),
+                        ('b', _ctypes.c_long)]
+
+        class Both(_ctypes.Union):
+            _fields_ = [('i', _ctypes.c_uint32),
+                        ('c', _ctypes.c_char * 4)]
+
+        class Record(_ctypes.Structure):
+            _fields_ = [('flag', _ctypes.c_ubyte),
+                        ('ptr', _ctypes.POINTER(_ctypes.c_int)),
+                        ('vptr', _ctypes.c_void_p),
+                        ('sub', Sub),
+                        ('subs', Sub * 2),
+                        ('both', Both),
+                        ('d', _ctypes.c_double),
+                        ('bits', _ctypes.c_uint, 3),
+                        ('ld', _ctypes.c_longdouble)]
+        return Record
+
+    def test_layout(self):
+        for sizes in [(8, 8, 16), (4, 4, 12), (4, 4, 8)]:
+            _ctypes = types.build_ctypes_proxy(*sizes)
+            Record = self._make_record(_ctypes)
+            dtype = model.Model(_ctypes).get_numpy_dtype(Record)
+            self.assertEqual(dtype.itemsize, _ctypes.sizeof(Record))
+            self.assertEqual(dtype.names, ('flag', 'ptr', 'vptr', 'sub', 'subs', 'both', 'd', 'ld'))
+            for name in dtype.names:
+                self.assertEqual(dtype.fields[name][1], getattr(Record, name).offset)
+            self.assertEqual(dtype['ptr'], numpy.dtype('u%d' % sizes[1]))
+            self.assertEqual(dtype['vptr'], numpy.dtype('u%d' % sizes[1]))
+            self.assertEqual(dtype['sub'].itemsize, _ctypes.sizeof(Record._fields_[3][1]))
+            self.assertEqual(dtype['subs'].shape, (2,))
+            self.assertEqual(dtype['ld'].itemsize, sizes[2])
+            # cached
+            self.assertIs(model.get_numpy_dtype(Record, _ctypes), dtype)
+
+    def test_values(self):
+        for sizes in [(8, 8, 16), (4, 4, 12)]:
+            _ctypes = types.build_ctypes_proxy(*sizes)
+            Record = self._make_record(_ctypes)
+            data = bytes(bytearray([(i * 7) % 256 for i in range(_ctypes.sizeof(Record))]))
+            record = Record.from_buffer_copy(data)
+            array = numpy.frombuffer(data, dtype=model.get_numpy_dtype(Record, _ctypes))
+            self.assertEqual(array['flag'][0], record.flag)
+            self.assertEqual(array['ptr'][0], utils.get_ctypes_utils(_ctypes).get_pointee_address(record.ptr))
+            self.assertEqual(array['sub']['b'][0], record.sub.b)
+            self.assertEqual(array['subs']['b'][0][1], record.subs[1].b)
+            self.assertEqual(array['both']['i'][0], record.both.i)
+            self.assertEqual(array['d'][0], record.d)
+
+    def test_win_profiles(self):
+        # some records have fields declared while their type was incomplete
+        profiles = [(target.TargetPlatform.make_target_win_32('win7'), ['win7_32']),
+                    (target.TargetPlatform.make_target_win_64('win7'), ['win7_64']),
+                    (target.TargetPlatform.make_target_win_32('winxp'), ['winxp_32', 'winxp_32_peb']),
+                    (target.TargetPlatform.make_target_win_64('winxp'), ['winxp_64'])]
+        for _target, module_names in profiles:
+            _ctypes = _target.get_target_ctypes()
+            _model = model.Model(_ctypes)
+            for module_name in module_names:
+                module = _model.import_module('haystack.allocators.win32.%s' % module_name)
+                records = [v for v in vars(module).values()
+                           if isinstance(v, type) and issubclass(v, (ctypes.Structure, ctypes.Union))
+                           and hasattr(v, '_fields_')]
+                self.assertGreater(len(records), 10)
+                for record in records:
+                    dtype = model.get_numpy_dtype(record, _ctypes)
+                    self.assertEqual(dtype.itemsize, _ctypes.sizeof(record))
+        win7_32 = target.TargetPlatform.make_target_win_32('win7')
+        module = model.Model(win7_32.get_target_ctypes()).import_module('haystack.allocators.win32.win7_32')
+        dtype = model.get_numpy_dtype(module.LFH_HEAP, win7_32.get_target_ctypes())
+        self.assertEqual(dtype.itemsize, 784)
+        self.assertNotIn('LocalData', dtype.names)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
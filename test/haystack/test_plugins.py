@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.plugins ."""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from haystack import plugins
+from haystack.mappings import folder
+
+log = logging.getLogger('test_plugins')
+
+
+class TestPluginRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self._xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.tmpdir
+        plugins.clear_entry_points()
+
+    def tearDown(self):
+        if self._xdg_cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self._xdg_cache_home
+        plugins.clear_entry_points()
+        shutil.rmtree(self.tmpdir)
+
+    def test_builtins(self):
+        loaders = plugins.PluginRegistry(plugins.MAPPINGS_LOADER_GROUP, plugins.BUILTIN_MAPPINGS_LOADERS)
+        self.assertIn('dir', loaders)
+        self.assertNotIn('nope', loaders)
+        self.assertEqual(loaders.get_spec('dir'), 'haystack.mappings.folder:FolderLoader')
+        self.assertIs(loaders['dir'], folder.FolderLoader)
+        self.assertIsNone(loaders.get('nope'))
+        self.assertRaises(KeyError, loaders.__getitem__, 'nope')
+        loaders['test'] = folder.FolderLoader
+        self.assertIn('test', loaders.keys())
+        self.assertIs(loaders['test'], folder.FolderLoader)
+
+    def test_cache(self):
+        plugins.get_entry_points(plugins.MAPPINGS_LOADER_GROUP)
+        filename = plugins.get_cache_filename()
+        self.assertTrue(filename.startswith(self.tmpdir))
+        with open(filename) as fin:
+            data = json.load(fin)
+        self.assertEqual(data['format'], plugins.CACHE_FORMAT)
+        # a cached entry point is used
+        data['entry_points'][plugins.MAPPINGS_LOADER_GROUP]['test'] = 'haystack.mappings.folder:FolderLoader'
+        with open(filename, 'w') as fout:
+            json.dump(data, fout)
+        plugins.clear_entry_points()
+        loaders = plugins.PluginRegistry(plugins.MAPPINGS_LOADER_GROUP, plugins.BUILTIN_MAPPINGS_LOADERS)
+        self.assertIs(loaders['test'], folder.FolderLoader)
+        # a stale cache is ignored
+        data['fingerprint'] = []
+        with open(filename, 'w') as fout:
+            json.dump(data, fout)
+        plugins.clear_entry_points()
+        self.assertNotIn('test', plugins.get_entry_points(plugins.MAPPINGS_LOADER_GROUP))
+
+    def test_load_object(self):
+        self.assertIs(plugins.load_object('haystack.mappings.folder:FolderLoader'), folder.FolderLoader)
+        self.assertIs(plugins.load_object('haystack.mappings.folder'), folder)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests haystack.target ."""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from haystack import cli
+from haystack import target
+from haystack.mappings import folder
+from haystack.mappings.base import AMemoryMapping
+from test.haystack.mappings.test_container import make_folder_dump
+
+log = logging.getLogger('test_target')
+
+
+def make_elf_header(e_machine):
+    head = bytearray(0x1000)
+    head[0:4] = b'\x7fELF'
+    head[4] = 2 if e_machine == 62 else 1
+    struct.pack_into('<HH', head, 16, 3, e_machine)
+    return bytes(head)
+
+
+def make_pe_header(magic):
+    head = bytearray(0x1000)
+    head[0:2] = b'MZ'
+    struct.pack_into('<I', head, 0x3c, 0x80)
+    head[0x80:0x84] = b'PE\x00\x00'
+    struct.pack_into('<HHIIIHH', head, 0x84, 0x14c if magic == 0x10b else 0x8664, 0, 0, 0, 0,
+                     0xe0 if magic == 0x10b else 0xf0, 0x2102)
+    struct.pack_into('<H', head, 0x98, magic)
+    return bytes(head)
+
+
+class TestTargetDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dumpname = os.path.join(self.tmpdir, 'test.dump')
+        mappings = [(0x400000, 0x401000, 'r-xp', '/bin/test', None)]
+        for i in range(64):
+            start = 0x600000 + i * 0x10000
+            mappings.append((start, start + 0x1000, 'rw-p', '/usr/share/locale/%d' % i, b'\x00' * 0x1000))
+        mappings.append((0x7f0000000000, 0x7f0000001000, 'r--p', '/usr/lib/x86_64-linux-gnu/libc.so.6',
+                         make_elf_header(62)))
+        make_folder_dump(self.dumpname, mappings)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self, bits=None, os_name=None):
+        return folder.ProcessMemoryDumpLoader(self.dumpname, bits=bits, os_name=os_name).make_memory_handler()
+
+    def test_probe_mappings(self):
+        mappings = [AMemoryMapping(0x1000, 0x2000, 'rw-p', 0, 0, 0, 0, ''),
+                    AMemoryMapping(0x2000, 0x3000, 'r--p', 0, 0, 0, 0, '/usr/share/locale/fr'),
+                    AMemoryMapping(0x3000, 0x4000, 'r-xp', 0, 0, 0, 0, '/bin/test'),
+                    AMemoryMapping(0x4000, 0x5000, 'r-xp', 0x1000, 0, 0, 0, 'C:\\Windows\\System32\\ntdll.dll'),
+                    AMemoryMapping(0x5000, 0x6000, 'r--p', 0, 0, 0, 0, 'C:\\Windows\\System32\\ntdll.dll')]
+        probed = target.TargetPlatform._probe_mappings(mappings * 10)
+        self.assertEqual(len(probed), target.MAX_PROBED_MAPPINGS)
+        self.assertEqual([m.start for m in probed[:10]], [0x5000] * 10)
+        self.assertEqual([m.start for m in probed[10:]], [0x4000] * 6)
+        probed = target.TargetPlatform._probe_mappings(mappings)
+        self.assertEqual([m.start for m in probed], [0x5000, 0x4000, 0x3000, 0x2000, 0x1000])
+
+    def test_detect(self):
+        platform = self._load().get_target_platform()
+        self.assertEqual(platform.get_os_name(), target.TargetPlatform.LINUX)
+        self.assertEqual(platform.get_cpu_bits(), 64)
+        self.assertEqual(platform.get_word_size(), 8)
+        report = platform.get_detection_report()
+        self.assertEqual([r[0] for r in report], ['os_name', 'cpu_bits', 'word_size', 'ptr_size', 'ld_size'])
+        self.assertEqual(set([r[2] for r in report]), set(['detected']))
+        for name, value, source, seconds, probed in report:
+            self.assertLessEqual(probed, target.MAX_PROBED_MAPPINGS)
+        # libc is read first
+        self.assertEqual(report[1][4], 1)
+        self.assertIn('cpu_bits   64', cli.format_detection_report(platform))
+
+    def test_cache(self):
+        self._load()
+        filename = os.path.join(self.dumpname + '.d', target.DETECTION_FILENAME)
+        self.assertTrue(os.access(filename, os.F_OK))
+        platform = self._load().get_target_platform()
+        self.assertEqual(platform.get_cpu_bits(), 64)
+        self.assertEqual(platform.get_detection_report()[4][1:3], (16, 'cached'))
+        self.assertEqual(sum([r[4] for r in platform.get_detection_report()]), 0)
+        # a verdict that contradicts a forced value is ignored
+        platform = self._load(bits=32).get_target_platform()
+        self.assertEqual(platform.get_detection_report()[0][2], 'detected')
+        self.assertEqual(platform.get_detection_report()[4][:3], ('ld_size', 12, 'detected'))
+        # a stale verdict is ignored
+        with open(filename) as fin:
+            data = json.load(fin)
+        data['fingerprint'] = '0'
+        data['cpu_bits'] = 32
+        with open(filename, 'w') as fout:
+            json.dump(data, fout)
+        platform = self._load().get_target_platform()
+        self.assertEqual(platform.get_cpu_bits(), 64)
+        self.assertEqual(platform.get_detection_report()[1][2], 'detected')
+
+
+class TestWindowsDetection(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dumpname = os.path.join(self.tmpdir, 'test.dump')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_dump(self, heap):
+        # many anonymous mappings before the heap, some of them not dumped
+        mappings = [(0x10000, 0x11000, 'r--p', 'C:\\Windows\\System32\\locale.nls', b'\x00' * 0x1000)]
+        for i in range(32):
+            start = 0x100000 + i * 0x10000
+            mappings.append((start, start + 0x1000, 'rw-p', '', None if i % 2 else b'\x00' * 0x1000))
+        for i in range(8):
+            start = 0x400000 + i * 0x10000
+            mappings.append((start, start + 0x1000, 'r--p', '', b'\x00' * 0x1000))
+        if heap is not None:
+            mappings.append((0x800000, 0x801000, 'rw-p', '', heap))
+        mappings.append((0x7c900000, 0x7c901000, 'r-xp', 'C:\\Windows\\System32\\ntdll.dll', make_pe_header(0x10b)))
+        make_folder_dump(self.dumpname, mappings)
+        return folder.ProcessMemoryDumpLoader(self.dumpname).make_memory_handler()
+
+    def test_heap_signature(self):
+        heap = bytearray(0x1000)
+        struct.pack_into('<I', heap, 100, 0xeeffeeff)
+        platform = self._make_dump(bytes(heap)).get_target_platform()
+        self.assertEqual(platform.get_os_name(), target.TargetPlatform.WIN7)
+        self.assertEqual(platform.get_cpu_bits(), 32)
+        # only the dumped mappings are read, the writable ones first
+        self.assertEqual(platform.get_detection_report()[0][4], 17)
+        self.assertTrue(os.access(os.path.join(self.dumpname + '.d', target.DETECTION_FILENAME), os.F_OK))
+
+    def test_pathnames(self):
+        mappings = [AMemoryMapping(0x1000, 0x2000, 'r--p', 0, 0, 0, 0, 'C:\\Documents and Settings\\user\\ntuser.dat')]
+        self.assertEqual(target.TargetPlatform._detect_os(mappings), target.TargetPlatform.WINXP)
+        mappings = [AMemoryMapping(0x1000, 0x2000, 'r--p', 0, 0, 0, 0, 'C:\\Windows\\SysWOW64\\wow64.dll')]
+        self.assertEqual(target.TargetPlatform._detect_os(mappings), target.TargetPlatform.WIN7)
+
+    def test_tie(self):
+        """A verdict reached by a tie is not cached"""
+        memory_handler = self._make_dump(None)
+        mappings = memory_handler.get_mappings()
+        ties = []
+        target.TargetPlatform._detect_os(mappings, ties=ties)
+        self.assertEqual(sorted(ties), ['win7', 'winxp'])
+        self.assertEqual(memory_handler.get_target_platform().get_cpu_bits(), 32)
+        self.assertFalse(os.access(os.path.join(self.dumpname + '.d', target.DETECTION_FILENAME), os.F_OK))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
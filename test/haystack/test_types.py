@@ -12,8 +12,12 @@ __status__ = "Production"
 
 
 import logging
+import threading
 import unittest
 
+from past.builtins import long
+
+from haystack import target
 from haystack import types
 
 
@@ -236,6 +240,39 @@ class TestReload(unittest.TestCase):
         return
 
 
+class TestProxyCache(unittest.TestCase):
+
+    """Tests the proxies are interned per sizes."""
+
+    def test_shared(self):
+        platforms = [target.TargetPlatform.make_target_win_32('winxp') for i in range(10)]
+        proxy = platforms[0].get_target_ctypes()
+        self.assertIs(types.build_ctypes_proxy(4, 4, 8), proxy)
+        # long is a long
+        self.assertIs(types.build_ctypes_proxy(long(4), 4, 8), proxy)
+        for p in platforms:
+            self.assertIs(p.get_target_ctypes(), proxy)
+            self.assertIs(p.get_target_ctypes_utils(), platforms[0].get_target_ctypes_utils())
+        # one pointer type cache
+        class X(proxy.Structure):
+            _fields_ = [('a', proxy.c_int)]
+        self.assertIs(platforms[5].get_target_ctypes().POINTER(X), proxy.POINTER(X))
+        self.assertIsNot(target.TargetPlatform.make_target_linux_64().get_target_ctypes(), proxy)
+
+    def test_threads(self):
+        proxies = []
+
+        def run():
+            proxies.append(types.build_ctypes_proxy(8, 8, 8))
+
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set([id(p) for p in proxies])), 1)
+
+
 class TestBasicFunctions(unittest.TestCase):
 
     """Tests basic haystack.types functions on base types."""
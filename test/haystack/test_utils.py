@@ -193,6 +193,52 @@ class TestHelpers(unittest.TestCase):
 
         pass
 
+    def test_get_pointee_address_fast_path(self):
+        """the per-type readers return the same address as the generic path, faster"""
+        import timeit
+        for sizes in [(4, 4, 8), (8, 8, 16)]:
+            my_ctypes = types.build_ctypes_proxy(*sizes)
+            my_utils = utils.Utils(my_ctypes)
+            value = 0x11223344
+            c_int = my_ctypes.c_int(1)
+            lp_int = my_ctypes.POINTER(my_ctypes.c_int)
+            pointers = [lp_int.from_buffer_copy(value.to_bytes(sizes[1], 'little')),
+                        lp_int.from_buffer_copy(b'\x00' * sizes[1]),
+                        my_ctypes.c_void_p(value),
+                        my_ctypes.c_void_p(0),
+                        value,
+                        c_int]
+            if sizes[1] == ctypes.sizeof(ctypes.c_void_p):
+                # host pointers
+                pointers.extend([ctypes.pointer(c_int),
+                                 ctypes.POINTER(ctypes.c_int)(),
+                                 ctypes.CFUNCTYPE(None)()])
+            for p in pointers:
+                # twice, to use the cached reader
+                self.assertEqual(my_utils.get_pointee_address(p), my_utils._get_pointee_address(p) or 0)
+                self.assertEqual(my_utils.get_pointee_address(p), my_utils._get_pointee_address(p) or 0)
+            self.assertEqual(my_utils.get_pointee_address(pointers[0]), value)
+            if sizes[1] == ctypes.sizeof(ctypes.c_void_p):
+                self.assertEqual(my_utils.get_pointee_address(pointers[6]), ctypes.addressof(c_int))
+            # micro benchmark
+            p = pointers[0]
+            generic = timeit.timeit(lambda: my_utils._get_pointee_address(p), number=20000)
+            fast = timeit.timeit(lambda: my_utils.get_pointee_address(p), number=20000)
+            logging.getLogger('test_utils').info('get_pointee_address %s generic:%0.4fs fast:%0.4fs',
+                                                 my_ctypes.__name__, generic, fast)
+
+    def test_shared_utils(self):
+        """the mappings and the validators share the readers cache of their ctypes proxy"""
+        from haystack import basicmodel
+        from haystack.mappings import base
+        my_target = target.TargetPlatform.make_target_linux_64()
+        my_ctypes = my_target.get_target_ctypes()
+        mapping = base.AMemoryMapping(0x1000, 0x2000, 'rw-p', 0, 0, 0, 0, '')
+        memory_handler = base.MemoryHandler([mapping], my_target, 'test')
+        validator = basicmodel.CTypesRecordConstraintValidator(memory_handler, None)
+        self.assertIs(mapping._utils, utils.get_ctypes_utils(my_ctypes))
+        self.assertIs(validator._utils, my_target.get_target_ctypes_utils())
+
     def test_offsetof(self):
         """returns the offset of a member fields in a record"""
         my_ctypes = types.build_ctypes_proxy(4, 4, 8)